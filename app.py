@@ -3,61 +3,345 @@
 Finance Tracker - Flask приложение с базой данных
 """
 
-from flask import Flask, render_template, request, jsonify
-from models import force_update_exchange_rates, get_current_exchange_rates
+from flask import Flask, Request, Response, g, render_template, request, jsonify, make_response, send_file
+from flask.json.provider import DefaultJSONProvider
+from models import force_update_exchange_rates, get_current_exchange_rates, get_cached_exchange_rates_version, get_revaluation_version
 from core import finance_tracker_core
+from events import event_broker, change_listener, format_sse, SSE_HEARTBEAT_INTERVAL
+from partitions import start_partition_maintenance
+from profiling import start_profile, finish_profile, profiled, list_profiles, profile_path
+from metrics import Counter, Histogram, render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from ratelimit import ocr_rate_limiter, ocr_gate, Throttled
+from cache import shared_cache, CHART_CACHE_TTL
+from werkzeug.middleware.proxy_fix import ProxyFix
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import asyncio
+import contextvars
+import functools
+import gzip
 import os
+import queue
+import secrets
+import time
+from tempfile import SpooledTemporaryFile
 
-app = Flask(__name__)
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работает стандартный json
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # без brotli отдаем только gzip
+    brotli = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask на orjson (быстрее стандартного json в несколько раз)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+# Лимит размера загрузки и порог, после которого файл уходит из памяти во временный файл
+MAX_UPLOAD_BYTES = int(float(os.environ.get('MAX_UPLOAD_MB', '10')) * 1024 * 1024)
+UPLOAD_SPOOL_THRESHOLD = int(os.environ.get('UPLOAD_SPOOL_KB', '256')) * 1024
+
+class UploadRequest(Request):
+    """Запрос, который держит в памяти не больше UPLOAD_SPOOL_THRESHOLD байт каждого файла"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, mode='rb+')
+
+# Прокси перед приложением (Railway - один): request.remote_addr берется из их X-Forwarded-For.
+# Без прокси - 0, иначе клиент подставит любой адрес и обойдет лимит запросов
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+
+class FinanceTrackerFlask(Flask):
+    """Flask, который выполняет async-представления в собственном цикле событий потока запроса
+
+    По умолчанию Flask (через asgiref) под uvicorn отправляет корутину представления
+    в главный цикл событий процесса: любая блокировка в ней задержала бы SSE и
+    остальные запросы. Здесь представление живет в потоке своего запроса
+    (ASGI_THREADS или поток gunicorn) и блокирует только его.
+    """
+
+    def async_to_sync(self, func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            return asyncio.run(func(*args, **kwargs))
+        return run
+
+app = FinanceTrackerFlask(__name__)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# Сжатие ответов: минимальный размер и сжимаемые типы
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '500'))
+COMPRESS_MIMETYPES = {
+    'application/json', 'text/html', 'text/css', 'text/plain',
+    'application/javascript', 'text/javascript', 'image/svg+xml'
+}
+
+# Отдельный пул для блокирующей работы (OCR, БД, курсы валют) из async-представлений.
+# Он не пересекается с пулом, в котором ASGI-адаптер выполняет сами запросы.
+blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('BLOCKING_THREADS', '8')),
+    thread_name_prefix='ft-blocking'
+)
+
+async def run_blocking(func, *args, **kwargs):
+    """Выполняет блокирующую функцию в пуле blocking_executor
+
+    Контекст (в том числе включенный профиль запроса) переносится в поток пула.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, profiled(func), *args, **kwargs)
+    return await loop.run_in_executor(blocking_executor, call)
+
+# Профилирование по запросу: X-Profile: <PROFILE_TOKEN> или ?profile=<PROFILE_TOKEN>.
+# Без PROFILE_TOKEN профилирование выключено
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+
+def has_profile_token():
+    """Запрос несет верный PROFILE_TOKEN"""
+    supplied = request.headers.get('X-Profile') or request.args.get('profile')
+    return bool(PROFILE_TOKEN and supplied and secrets.compare_digest(supplied, PROFILE_TOKEN))
+
+def choose_encoding():
+    """Выбирает кодировку сжатия по Accept-Encoding: br, затем gzip"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+HTTP_REQUESTS_TOTAL = Counter(
+    'ft_http_requests_total', 'HTTP-запросы к веб-приложению', ['method', 'endpoint', 'status']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'ft_http_request_seconds', 'Время обработки HTTP-запроса', ['endpoint']
+)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def start_request_profile():
+    if has_profile_token() and not request.path.startswith('/api/profiles'):
+        g.profile = start_profile(f"{request.method} {request.path}")
+
+@app.after_request
+def finish_request_profile(response):
+    """Сохраняет профиль запроса и отдает ссылку на него в заголовках"""
+    profile = g.pop('profile', None)
+    if profile:
+        profile_id = finish_profile(*profile)
+        response.headers['X-Profile-Id'] = profile_id
+        response.headers['X-Profile-Url'] = f"/api/profiles/{profile_id}"
+    return response
+
+@app.teardown_request
+def discard_request_profile(error=None):
+    # Запрос упал до after_request: профиль все равно сохраняем
+    profile = g.pop('profile', None)
+    if profile:
+        finish_profile(*profile)
+
+@app.after_request
+def record_request_metrics(response):
+    """Счетчик и длительность запросов по шаблону маршрута (а не по URL - без взрыва меток)"""
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUESTS_TOTAL.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    started = g.get('request_started')
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Сжимает ответы (gzip/brotli) по Accept-Encoding"""
+    response.vary.add('Accept-Encoding')
+    
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    
+    encoding = choose_encoding()
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    
+    response.headers['Content-Encoding'] = encoding
+    # У сжатого представления свой строгий ETag
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak=weak)
+    return response
 
 @app.route('/')
 def index():
     """Главная страница"""
     return render_template('index.html')
 
+def accounts_version():
+    """Версия данных для /api/accounts: id последней транзакции + курсы последнего пересчета balance_usd"""
+    return f"tx{finance_tracker_core.get_data_version()}-rv{get_revaluation_version()}"
+
+def balance_history_version():
+    """Версия данных для /api/balance_history: транзакции + снимок курсов"""
+    return finance_tracker_core.balance_history_version()
+
+def exchange_rates_version():
+    """Версия данных для /api/exchange_rates: снимок курсов из памяти без похода в API
+    (None, пока процесс еще не загружал курсы)"""
+    version = get_cached_exchange_rates_version()
+    return f"fx{version}" if version else None
+
+def conditional_get(version_func, cache_control='private, no-cache'):
+    """Добавляет строгий ETag и отвечает 304 на If-None-Match до выполнения тяжелого запроса
+
+    Посчитанная версия доступна представлению как g.data_version (ключ общего кэша).
+    Ответы с ошибкой ({'success': False}) и ответы без версии (None) ETag не получают.
+    """
+    def decorator(view):
+        def not_modified_or_none(etag):
+            if etag is None:
+                return None
+            # Сжатый ответ несет ETag с суффиксом кодировки (см. compress_response):
+            # 304 возвращает тот вариант, который прислал клиент
+            for variant in (etag, f"{etag}-gzip", f"{etag}-br"):
+                if request.if_none_match.contains(variant):
+                    response = make_response('', 304)
+                    response.set_etag(variant)
+                    response.headers['Cache-Control'] = cache_control
+                    return response
+            return None
+        
+        def finalize(response, etag):
+            response = make_response(response)
+            if etag is None or response.status_code != 200:
+                return response
+            if response.is_json and (response.get_json(silent=True) or {}).get('success') is False:
+                return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+            return response
+        
+        def make_etag():
+            return f"{view.__name__}-{g.data_version}" if g.data_version is not None else None
+        
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(*args, **kwargs):
+                g.data_version = await run_blocking(version_func)
+                etag = make_etag()
+                return not_modified_or_none(etag) or finalize(await view(*args, **kwargs), etag)
+        else:
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                g.data_version = version_func()
+                etag = make_etag()
+                return not_modified_or_none(etag) or finalize(view(*args, **kwargs), etag)
+        
+        return wrapper
+    return decorator
+
+def uploaded_image():
+    """Файл image из multipart-тела запроса или None"""
+    return request.files.get('image')
+
 @app.route('/api/process_image', methods=['POST'])
-def api_process_image():
+async def api_process_image():
     """API для обработки изображения"""
-    if 'image' not in request.files:
-        return jsonify({'success': False, 'error': 'Файл не найден'})
-    
-    file = request.files['image']
-    if file.filename == '':
-        return jsonify({'success': False, 'error': 'Файл не выбран'})
+    # До разбора multipart (он читает тело и пишет файл на диск) - только заголовки:
+    # отклоненный запрос не должен стоить загрузки целиком
+    if request.content_length is None:
+        return jsonify({'success': False, 'error': 'Нужен заголовок Content-Length'}), 411
+    if request.content_length > MAX_UPLOAD_BYTES:
+        return request_entity_too_large(None)
     
     try:
-        image_content = file.read()
+        # Бэкенд ограничителя может быть файлом SQLite - в пуле, как и остальной ввод-вывод
+        await run_blocking(ocr_rate_limiter.hit, f'ip:{request.remote_addr}')
         
-        # Обрабатываем изображение
-        result = finance_tracker_core.process_image(image_content)
+        # Разбор multipart читает тело и пишет файл на диск (UploadRequest) - тоже в пуле
+        file = await run_blocking(uploaded_image)
+        if file is None:
+            return jsonify({'success': False, 'error': 'Файл не найден'})
         
-        if result['success']:
-            # Обновляем баланс в базе данных
-            transaction_result = finance_tracker_core.update_account_balance_from_image(
-                result['main_balance'], 
-                result['full_text'],
-                source='web'
-            )
-            
-            if transaction_result['success']:
-                return jsonify({
-                    'success': True,
-                    'main_balance': result['main_balance'],
-                    'all_balances': result['all_balances'],
-                    'account': transaction_result['account'],
-                    'text_lines': result['text_lines'],
-                    'full_text': result['full_text']
-                })
-            else:
-                return jsonify({'success': False, 'error': transaction_result['error']})
+        if file.filename == '':
+            return jsonify({'success': False, 'error': 'Файл не выбран'})
+        
+        # ?include_text=0 убирает из ответа сырой текст OCR (text_lines, full_text)
+        include_text = request.values.get('include_text', '1') not in ('0', 'false', 'no')
+        # ?async=1 (или INGEST_MODE=queue) - только поставить в очередь, ответ 202 с id задачи
+        queued = request.values.get('async', '1' if finance_tracker_core.ingest_mode == 'queue' else '0') in ('1', 'true', 'yes')
+        
+        if queued:
+            job = await run_blocking(finance_tracker_core.enqueue_image, file.stream, 'web')
+            if not job['success']:
+                return jsonify(job)
+            return jsonify({
+                'success': True,
+                'queued': True,
+                'job_id': job['job_id'],
+                'status_url': f"/api/jobs/{job['job_id']}"
+            }), 202
+        
+        # Передаем поток файла как есть: он читается в память уже в пуле обработки,
+        # так что одновременно материализовано не больше BLOCKING_THREADS изображений
+        async with ocr_gate.slot():
+            return jsonify(await run_blocking(finance_tracker_core.ingest_image, file.stream, 'web', include_text))
+    
+    except Throttled as e:
+        if e.reason == 'busy':
+            error = f'Сервер занят распознаванием, повторите через {e.retry_after} с'
         else:
-            return jsonify(result)
+            error = f'Слишком много запросов, повторите через {e.retry_after} с'
+        response = jsonify({'success': False, 'error': error, 'retry_after': e.retry_after})
+        headers = {'Retry-After': str(e.retry_after)}
+        if e.reason == 'rate_limit':
+            # Тело не прочитано: соединение закрывается, а не дочитывается ради keep-alive
+            headers['Connection'] = 'close'
+        return response, 503 if e.reason == 'busy' else 429, headers
             
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/jobs/<int:job_id>')
+async def api_job_status(job_id):
+    """API для проверки статуса задачи распознавания"""
+    job = await run_blocking(finance_tracker_core.get_ingest_job, job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
+    return jsonify({'success': True, 'job': job})
+
 @app.route('/api/accounts')
+@conditional_get(accounts_version)
 def api_accounts():
     """API для получения списка счетов"""
     return jsonify(finance_tracker_core.get_accounts_for_api())
@@ -71,10 +355,11 @@ def api_vision_status():
     })
 
 @app.route('/api/exchange_rates')
-def api_exchange_rates():
+@conditional_get(exchange_rates_version, cache_control='private, max-age=300')
+async def api_exchange_rates():
     """API для получения текущих курсов валют"""
     try:
-        rates = get_current_exchange_rates()
+        rates = await run_blocking(get_current_exchange_rates)
         return jsonify({
             'success': True,
             'rates': rates
@@ -83,10 +368,10 @@ def api_exchange_rates():
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/force_update_rates')
-def api_force_update_rates():
+async def api_force_update_rates():
     """API для принудительного обновления курсов валют"""
     try:
-        force_update_exchange_rates()
+        await run_blocking(force_update_exchange_rates)
         return jsonify({
             'success': True,
             'message': 'Курсы валют успешно обновлены'
@@ -95,9 +380,136 @@ def api_force_update_rates():
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/balance_history')
-def api_balance_history():
+@conditional_get(balance_history_version)
+async def api_balance_history():
     """API для получения истории общего баланса"""
-    return jsonify(finance_tracker_core.get_balance_history())
+    return jsonify(await run_blocking(finance_tracker_core.get_balance_history, g.data_version))
+
+# Форматы графика общей динамики и их MIME-типы; sparkline - только данные в JSON
+CHART_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'webp': 'image/webp',
+    'sparkline': 'application/json'
+}
+CHART_MIN_SIZE, CHART_MAX_SIZE = 100, 4000
+CHART_MIN_DPI, CHART_MAX_DPI = 50, 300
+
+def chart_int_arg(name, low, high, default=None):
+    """Целочисленный параметр запроса в пределах [low, high]"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f'{name} должен быть целым числом')
+    if not low <= value <= high:
+        raise ValueError(f'{name} должен быть от {low} до {high}')
+    return value
+
+@app.route('/api/charts/total_history')
+@conditional_get(balance_history_version)
+async def api_chart_total_history():
+    """График общей динамики: ?format=svg|webp|png|sparkline&width=&height=&dpi=
+
+    width и height - в пикселях; для sparkline width - максимум точек.
+    """
+    image_format = request.args.get('format', 'png').lower()
+    if image_format not in CHART_FORMATS:
+        return jsonify({'success': False, 'error': f"Неизвестный формат: {image_format}"}), 400
+    
+    try:
+        width = chart_int_arg('width', CHART_MIN_SIZE if image_format != 'sparkline' else 2, CHART_MAX_SIZE)
+        height = chart_int_arg('height', CHART_MIN_SIZE, CHART_MAX_SIZE)
+        dpi = chart_int_arg('dpi', CHART_MIN_DPI, CHART_MAX_DPI, default=100 if width else 150)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    if image_format == 'sparkline':
+        return jsonify(await run_blocking(finance_tracker_core.get_balance_sparkline, width))
+    
+    if width and not height:
+        height = round(width * 2 / 3)
+    elif height and not width:
+        width = round(height * 3 / 2)
+    
+    def render():
+        chart_buffer = finance_tracker_core.create_total_balance_history_chart(image_format, width, height, dpi)
+        return chart_buffer.getvalue() if chart_buffer else None
+    
+    # Один и тот же график на тех же данных строится один раз на все процессы
+    chart = await run_blocking(
+        shared_cache.get_or_set,
+        f"chart:total_history:{image_format}:{width}x{height}@{dpi}:{g.data_version}",
+        render,
+        CHART_CACHE_TTL
+    )
+    if not chart:
+        return jsonify({'success': False, 'error': 'Нет данных для графика'}), 404
+    
+    return Response(chart, mimetype=CHART_FORMATS[image_format])
+
+# Заголовки потока SSE (общие для WSGI и нативного ASGI-обработчика)
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+@app.route('/api/stream')
+def api_stream():
+    """SSE-поток обновлений счетов и общего баланса
+
+    В режиме ASGI (asgi.py) этот путь обслуживается без потока на клиента;
+    здесь - запасной вариант для gunicorn, который держит worker на соединение.
+    """
+    subscription = event_broker.subscribe()
+    
+    def generate():
+        try:
+            yield b'retry: 5000\n\n'
+            while True:
+                try:
+                    yield format_sse(subscription.get(timeout=SSE_HEARTBEAT_INTERVAL))
+                except queue.Empty:
+                    yield b': ping\n\n'
+        finally:
+            event_broker.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    """Ответ на загрузку больше MAX_UPLOAD_MB"""
+    limit_mb = MAX_UPLOAD_BYTES / (1024 * 1024)
+    return jsonify({'success': False, 'error': f'Файл слишком большой (максимум {limit_mb:g} МБ)'}), 413
+
+@app.route('/api/profiles')
+def api_profiles():
+    """Список сохраненных профилей (нужен PROFILE_TOKEN)"""
+    if not has_profile_token():
+        return jsonify({'success': False, 'error': 'Нет доступа'}), 403
+    return jsonify({'success': True, 'profiles': list_profiles()})
+
+@app.route('/api/profiles/<profile_id>')
+def api_profile_download(profile_id):
+    """Отчет профиля (?format=prof - статистика pstats для snakeviz)"""
+    if not has_profile_token():
+        return jsonify({'success': False, 'error': 'Нет доступа'}), 403
+    
+    kind = request.args.get('format', 'txt')
+    path = profile_path(profile_id, kind)
+    if not path:
+        return jsonify({'success': False, 'error': 'Профиль не найден'}), 404
+    
+    if kind == 'prof':
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True)
+    return send_file(path, mimetype='text/plain')
+
+@app.route('/metrics')
+def metrics():
+    """Метрики процесса в формате Prometheus"""
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
 
 @app.route('/health')
 def health():
@@ -113,4 +525,6 @@ if __name__ == '__main__':
     except Exception as e:
         print(f"⚠️ Не удалось создать таблицы: {e}")
     
+    change_listener.start()
+    start_partition_maintenance()
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000))) 
\ No newline at end of file
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+ASGI точка входа Finance Tracker (uvicorn), по желанию; по умолчанию - gunicorn app:app
+
+Запуск:
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers $WEB_CONCURRENCY
+"""
+
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from app import app as flask_app, SSE_HEADERS, MAX_UPLOAD_BYTES, UPLOAD_SPOOL_THRESHOLD
+from events import event_broker, change_listener, format_sse, SSE_HEARTBEAT_INTERVAL
+from partitions import start_partition_maintenance
+
+# Потоки, в которых ASGI-адаптер выполняет Flask-запросы (на один процесс uvicorn)
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '32'))
+
+def build_environ(scope, body):
+    """WSGI environ из ASGI scope (PEP 3333: строки в latin-1)"""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin1')
+        # Повторяющиеся заголовки WSGI получает через запятую
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+class PooledWsgiApp:
+    """ASGI-обертка Flask: тело запроса принимает цикл событий, сам запрос
+    выполняется в пуле из max_workers потоков
+
+    Свой небольшой адаптер вместо asgiref.wsgi.WsgiToAsgi: тот гонит все запросы
+    процесса через один общий поток, а заменить это можно только через его
+    внутренности, которые меняются от версии к версии.
+    """
+
+    def __init__(self, wsgi_application, max_workers):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ft-asgi')
+
+    async def __call__(self, scope, receive, send):
+        # Медленная загрузка ждет на цикле событий, а не в потоке пула
+        body = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, mode='w+b')
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.run_wsgi_app, scope, body, loop, send)
+        finally:
+            body.close()
+
+    def run_wsgi_app(self, scope, body, loop, send):
+        """Выполняет Flask-запрос в потоке пула; ответ уходит через цикл событий"""
+        def send_sync(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+        
+        response = {'started': False}
+        
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response['started']:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+        
+        def start():
+            if not response['started']:
+                send_sync({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                response['started'] = True
+        
+        result = self.wsgi_application(build_environ(scope, body), start_response)
+        try:
+            for chunk in result:
+                start()
+                if chunk:
+                    send_sync({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            start()
+            send_sync({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+class FinanceTrackerASGI:
+    """ASGI-приложение: Flask-маршруты /api/* в пуле ASGI_THREADS потоков (PooledWsgiApp),
+    SSE-поток - нативно на цикле событий uvicorn"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = PooledWsgiApp(wsgi_app, ASGI_THREADS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        
+        if scope['type'] == 'http' and scope['path'] == '/api/stream':
+            await self.stream(receive, send)
+            return
+        
+        if scope['type'] == 'http' and self._declared_length(scope) > MAX_UPLOAD_BYTES:
+            # Отказываем до чтения тела: PooledWsgiApp иначе сначала сохранит его целиком
+            await self.reject_too_large(send)
+            return
+        
+        await self.wsgi_app(scope, receive, send)
+
+    async def stream(self, receive, send):
+        """SSE-поток /api/stream на корутинах: соединение не занимает поток"""
+        subscription = event_broker.subscribe_async()
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        
+        try:
+            headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+            headers += [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in SSE_HEADERS.items()]
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+            
+            while not disconnected.done():
+                next_event = asyncio.ensure_future(subscription.get())
+                done, _ = await asyncio.wait(
+                    {next_event, disconnected},
+                    timeout=SSE_HEARTBEAT_INTERVAL,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                
+                if next_event in done:
+                    chunk = format_sse(next_event.result())
+                else:
+                    next_event.cancel()
+                    if disconnected in done:
+                        break
+                    chunk = b': ping\n\n'
+                
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            disconnected.cancel()
+            event_broker.unsubscribe(subscription)
+
+    def _declared_length(self, scope):
+        for name, value in scope.get('headers', []):
+            if name == b'content-length':
+                try:
+                    return int(value)
+                except ValueError:
+                    return 0
+        return 0
+
+    async def reject_too_large(self, send):
+        """Отвечает 413 на запрос с Content-Length больше MAX_UPLOAD_MB"""
+        limit_mb = MAX_UPLOAD_BYTES / (1024 * 1024)
+        body = json.dumps(
+            {'success': False, 'error': f'Файл слишком большой (максимум {limit_mb:g} МБ)'},
+            ensure_ascii=False
+        ).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode('latin1')),
+                (b'connection', b'close')
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _wait_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    async def lifespan(self, receive, send):
+        """Запускает слушателя изменений и обслуживание секций на старте процесса"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Записи бота и других воркеров сбрасывают кэши этого процесса и уходят в SSE
+                change_listener.start()
+                start_partition_maintenance()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+app = FinanceTrackerASGI(flask_app)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Минимальный сервер с протоколом Redis для локальной проверки CACHE_BACKEND=redis://
+
+Понимает PING, AUTH, SELECT, GET, SET (с EX/PX), DEL, EXISTS, DBSIZE и FLUSHDB;
+данные живут в памяти процесса. Для тестов и бенчмарков, не для работы.
+
+Пример:
+    python benchmarks/fake_redis.py --port 6390
+    CACHE_BACKEND=redis://127.0.0.1:6390/0 python app.py
+    CACHE_BACKEND=redis://127.0.0.1:6390/0 python telegram_bot_with_graphs.py
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+_databases = {}
+_lock = threading.Lock()
+
+def _encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    return f'+{value}\r\n'.encode('utf-8')
+
+def _read_command(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # Inline-команда (redis-cli, telnet)
+        return line.strip().split()
+    args = []
+    for _ in range(int(line[1:])):
+        length = int(reader.readline()[1:])
+        args.append(reader.read(length + 2)[:-2])
+    return args
+
+def _alive(db, key):
+    entry = db.get(key)
+    if entry is not None and entry[1] is not None and time.time() >= entry[1]:
+        del db[key]
+        return None
+    return entry
+
+def execute(db_index, args):
+    """Выполняет команду; возвращает (ответ, новый номер БД)"""
+    name = args[0].decode().upper()
+    with _lock:
+        db = _databases.setdefault(db_index, {})
+        if name == 'PING':
+            return 'PONG', db_index
+        if name == 'AUTH':
+            return 'OK', db_index
+        if name == 'SELECT':
+            return 'OK', int(args[1])
+        if name == 'GET':
+            entry = _alive(db, args[1])
+            return (entry[0] if entry else None), db_index
+        if name == 'SET':
+            expires_at = None
+            options = [arg.decode().upper() for arg in args[3::2]]
+            for option, amount in zip(options, args[4::2]):
+                if option == 'EX':
+                    expires_at = time.time() + int(amount)
+                elif option == 'PX':
+                    expires_at = time.time() + int(amount) / 1000
+            db[args[1]] = (args[2], expires_at)
+            return 'OK', db_index
+        if name in ('DEL', 'EXISTS'):
+            keys = [key for key in args[1:] if _alive(db, key) is not None]
+            if name == 'DEL':
+                for key in keys:
+                    del db[key]
+            return len(keys), db_index
+        if name == 'DBSIZE':
+            return len(db), db_index
+        if name == 'FLUSHDB':
+            db.clear()
+            return 'OK', db_index
+    return ValueError(f"ERR unknown command '{name}'"), db_index
+
+class RedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        db_index = 0
+        while True:
+            args = _read_command(self.rfile)
+            if not args:
+                return
+            reply, db_index = execute(db_index, args)
+            if isinstance(reply, Exception):
+                self.wfile.write(f'-{reply}\r\n'.encode('utf-8'))
+            else:
+                self.wfile.write(_encode(reply))
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start(port=0, host='127.0.0.1'):
+    """Запускает сервер в фоновом потоке; возвращает (server, port)"""
+    server = FakeRedisServer((host, port), RedisHandler)
+    threading.Thread(target=server.serve_forever, name='fake-redis', daemon=True).start()
+    return server, server.server_address[1]
+
+def main():
+    parser = argparse.ArgumentParser(description='Минимальный сервер с протоколом Redis для тестов')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+
+    server = FakeRedisServer((args.host, args.port), RedisHandler)
+    print(f"🧪 Fake Redis на {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Простой нагрузочный тест HTTP API Finance Tracker
+
+Запускает N параллельных клиентов против уже поднятого сервера и печатает
+RPS и задержки (p50/p95/p99) по каждому эндпоинту в JSON.
+
+Пример:
+    python benchmarks/loadtest.py --base-url http://127.0.0.1:8000 --concurrency 32 --duration 15
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+
+DEFAULT_ENDPOINTS = ['/api/accounts', '/api/balance_history', '/api/exchange_rates']
+
+def percentile(values, pct):
+    """Возвращает перцентиль pct (0-100) из списка значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def run_endpoint(base_url, path, concurrency, duration):
+    """Нагружает один эндпоинт concurrency потоками в течение duration секунд"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        local_latencies = []
+        local_errors = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base_url + path, timeout=30) as response:
+                    response.read()
+                local_latencies.append(time.perf_counter() - started)
+            except (urllib.error.URLError, OSError):
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'endpoint': path,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест API Finance Tracker')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--endpoint', action='append', dest='endpoints',
+                        help='Эндпоинт для нагрузки (можно указать несколько раз)')
+    parser.add_argument('--label', default='', help='Метка прогона (например, gunicorn-sync или uvicorn-asgi)')
+    args = parser.parse_args()
+
+    results = [
+        run_endpoint(args.base_url, path, args.concurrency, args.duration)
+        for path in (args.endpoints or DEFAULT_ENDPOINTS)
+    ]
+
+    print(json.dumps({
+        'label': args.label,
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'results': results
+    }, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк путей чтения истории: время и память на 100k транзакций
+
+Сравнивает загрузку ORM-объектов Transaction с выборкой кортежей колонок и
+замеряет методы чтения ядра (get_balance_history, get_accounts_for_api) на
+большой истории. Память - пик tracemalloc за один вызов (отдельным прогоном,
+чтобы трассировка не искажала время). Время и память приводятся к 100k строк.
+
+Примеры:
+    python benchmarks/read_paths.py --transactions 20000 --output before.json
+    python benchmarks/read_paths.py --transactions 20000 --compare before.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from run import bench, compare, git_revision
+
+PER_ROWS = 100000
+
+def peak_memory(func):
+    """Пик выделенной памяти Python за один вызов func, байты"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_suite(args):
+    import seed
+    seed.pin_fixed_exchange_rates()
+    data = seed.seed_database(args.accounts, args.transactions, args.days, args.seed, args.reset)
+
+    from core import finance_tracker_core as core
+    from models import create_session, Transaction
+
+    rows = data['transactions']
+    scale = PER_ROWS / rows
+
+    def orm_entities():
+        session = create_session()
+        try:
+            return session.query(Transaction).order_by(Transaction.timestamp).all()
+        finally:
+            session.close()
+
+    def column_tuples():
+        session = create_session()
+        try:
+            return session.query(
+                Transaction.timestamp, Transaction.account_id, Transaction.new_balance
+            ).order_by(Transaction.timestamp).all()
+        finally:
+            session.close()
+
+    cases = [
+        ('Transaction: ORM-объекты', 'query', orm_entities),
+        ('Transaction: кортежи колонок', 'query', column_tuples),
+        ('get_balance_history (uncached)', 'core', core.build_balance_history),
+        ('get_accounts_for_api', 'core', core.get_accounts_for_api)
+    ]
+
+    results = []
+    for name, group, func in cases:
+        result = bench(name, group, func, args.repeat)
+        peak = peak_memory(func)
+        result.update({
+            'rows': rows,
+            'median_ms_per_100k': round(result['median_ms'] * scale, 3),
+            'peak_kb': round(peak / 1024, 1),
+            'peak_kb_per_100k': round(peak / 1024 * scale, 1)
+        })
+        results.append(result)
+    return data, results
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк путей чтения истории (время и память на 100k строк)')
+    parser.add_argument('--accounts', type=int, default=5)
+    parser.add_argument('--transactions', type=int, default=20000, help='Транзакций на счет')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--reset', action='store_true', help='Очистить счета и транзакции в DATABASE_URL')
+    parser.add_argument('--output', help='Записать JSON в файл (иначе stdout)')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        database_path = os.path.join(tempfile.gettempdir(), f'finance-tracker-read-paths-{args.seed}.db')
+        if os.path.exists(database_path):
+            os.remove(database_path)
+        os.environ['DATABASE_URL'] = f'sqlite:///{database_path}'
+
+    with contextlib.redirect_stdout(sys.stderr):
+        data, results = run_suite(args)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    from models import get_engine
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'database': get_engine().dialect.name,
+            'repeat': args.repeat,
+            **data
+        },
+        'results': results
+    }
+
+    payload = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(payload + '\n')
+    print(payload)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Набор бенчмарков горячих путей Finance Tracker
+
+Заполняет БД синтетическими данными (seed.py), затем замеряет методы ядра,
+разбор OCR-текста, построение графиков и эндпоинты /api/* через тестовый
+клиент Flask. Результат - JSON; с --compare добавляется отношение к прошлому прогону.
+
+Примеры:
+    python benchmarks/run.py --accounts 5 --transactions 2000 --output before.json
+    python benchmarks/run.py --accounts 5 --transactions 2000 --compare before.json
+    DATABASE_URL=postgresql://... python benchmarks/run.py --reset
+
+Без DATABASE_URL используется свежий файл SQLite во временном каталоге.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def bench(name, group, func, repeat, inner=1):
+    """Замер func: первый (холодный) вызов отдельно, затем repeat прогонов по inner вызовов"""
+    started = time.perf_counter()
+    func()
+    first = time.perf_counter() - started
+
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(inner):
+            func()
+        runs.append((time.perf_counter() - started) / inner)
+
+    return {
+        'name': name,
+        'group': group,
+        'runs': repeat,
+        'first_ms': round(first * 1000, 3),
+        'min_ms': round(min(runs) * 1000, 3),
+        'median_ms': round(statistics.median(runs) * 1000, 3),
+        'mean_ms': round(statistics.mean(runs) * 1000, 3),
+        'p95_ms': round(percentile(runs, 95) * 1000, 3)
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_suite(args):
+    import seed
+    seed.pin_fixed_exchange_rates()
+    data = seed.seed_database(args.accounts, args.transactions, args.days, args.seed, args.reset)
+
+    from core import finance_tracker_core as core
+    from telegram_bot_with_graphs import finance_tracker as bot_tracker
+    from app import app
+    from models import create_session, Account
+
+    session = create_session()
+    try:
+        first_account_id = session.query(Account.id).order_by(Account.id).first()[0]
+    finally:
+        session.close()
+
+    corpus = seed.make_ocr_corpus(args.corpus, args.seed)
+    repeat = args.repeat
+    results = []
+
+    # Ядро
+    results.append(bench('get_accounts_for_api', 'core', core.get_accounts_for_api, repeat))
+    results.append(bench('get_balance_history (uncached)', 'core', core.build_balance_history, repeat))
+    results.append(bench('get_balance_history (shared cache)', 'core', core.get_balance_history, repeat))
+    results.append(bench('get_accounts_snapshot (uncached)', 'core',
+                         lambda: (core.invalidate_accounts_snapshot(), core.get_accounts_snapshot()), repeat))
+    results.append(bench(f'extract_balance_from_text x{len(corpus)}', 'ocr',
+                         lambda: [core.extract_balance_from_text(lines) for lines in corpus], repeat))
+
+    # Графики
+    if not args.skip_charts:
+        chart_repeat = max(1, repeat // 3)
+        results.append(bench('create_balance_chart', 'charts', bot_tracker.create_balance_chart, chart_repeat))
+        results.append(bench('create_account_history_chart', 'charts',
+                             lambda: bot_tracker.create_account_history_chart(first_account_id), chart_repeat))
+        results.append(bench('create_total_balance_history_chart png', 'charts',
+                             core.create_total_balance_history_chart, chart_repeat))
+        results.append(bench('create_total_balance_history_chart svg 600x300', 'charts',
+                             lambda: core.create_total_balance_history_chart('svg', 600, 300, 100), chart_repeat))
+
+    # HTTP через тестовый клиент (без сети, но с сериализацией, ETag и сжатием)
+    client = app.test_client()
+    headers = {'Accept-Encoding': 'gzip, br'}
+
+    def endpoint(path):
+        def call():
+            response = client.get(path, headers=headers)
+            if response.status_code != 200:
+                raise RuntimeError(f'{path}: HTTP {response.status_code}')
+        return call
+
+    for path in ['/api/accounts', '/api/balance_history', '/api/exchange_rates',
+                 '/api/charts/total_history?format=sparkline&width=60']:
+        results.append(bench(f'GET {path}', 'http', endpoint(path), repeat))
+
+    return data, results
+
+def compare(results, baseline_path):
+    """Добавляет к результатам медиану прошлого прогона и отношение new/old"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {item['name']: item for item in json.load(f)['results']}
+    for item in results:
+        old = baseline.get(item['name'])
+        if old and old['median_ms']:
+            item['baseline_median_ms'] = old['median_ms']
+            item['ratio'] = round(item['median_ms'] / old['median_ms'], 3)
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки горячих путей Finance Tracker')
+    parser.add_argument('--accounts', type=int, default=5)
+    parser.add_argument('--transactions', type=int, default=1000, help='Транзакций на счет')
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--corpus', type=int, default=200, help='Размер корпуса OCR-текстов')
+    parser.add_argument('--skip-charts', action='store_true', help='Не замерять графики (самая медленная часть)')
+    parser.add_argument('--reset', action='store_true', help='Очистить счета и транзакции в DATABASE_URL')
+    parser.add_argument('--output', help='Записать JSON в файл (иначе stdout)')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        database_path = os.path.join(tempfile.gettempdir(), f'finance-tracker-bench-{args.seed}.db')
+        if os.path.exists(database_path):
+            os.remove(database_path)
+        os.environ['DATABASE_URL'] = f'sqlite:///{database_path}'
+
+    # Диагностические print() приложения уводим в stderr, stdout - только JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        data, results = run_suite(args)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    from models import get_engine
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': get_engine().dialect.name,
+            'repeat': args.repeat,
+            'corpus': args.corpus,
+            **data
+        },
+        'results': results
+    }
+
+    payload = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(payload + '\n')
+    print(payload)
+
+if __name__ == '__main__':
+    main()
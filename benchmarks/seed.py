@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Детерминированный генератор синтетических данных Finance Tracker
+
+Создает N счетов (по одному на валюту, как в приложении) и M транзакций на
+каждый счет со случайным блужданием баланса. При одинаковом --seed данные
+совпадают байт в байт. Работает с любой БД из DATABASE_URL (SQLite, PostgreSQL).
+
+Пример:
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/seed.py --accounts 5 --transactions 2000 --reset
+"""
+
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Валюта, название счета, типичный баланс
+CURRENCIES = [
+    ('RUB', 'Сбербанк', 250000),
+    ('USD', 'Chase', 8000),
+    ('EUR', 'Revolut', 5000),
+    ('AED', 'Emirates NBD', 30000),
+    ('IDR', 'BCA', 45000000)
+]
+SOURCES = ['telegram', 'web']
+# Конец временной шкалы фиксирован, чтобы даты не зависели от дня запуска
+TIMELINE_END = datetime(2024, 1, 1)
+
+def format_amount(amount, currency):
+    """Сумма в том виде, в каком ее показывают банковские приложения"""
+    if currency == 'RUB':
+        whole, cents = f"{amount:,.2f}".split('.')
+        return f"{whole.replace(',', ' ')},{cents} ₽"
+    if currency == 'USD':
+        return f"${amount:,.2f}"
+    if currency == 'EUR':
+        return f"€{amount:,.2f}".replace(',', ' ')
+    if currency == 'AED':
+        return f"{amount:,.2f} AED"
+    return f"Rp {amount:,.3f}"
+
+def make_ocr_text(rng, amount, currency, bank):
+    """Правдоподобный текст OCR главного экрана банковского приложения"""
+    noise = rng.sample([
+        '9:41', 'LTE', '87%', 'Главная', 'Платежи', 'История', 'Home', 'Cards',
+        'Переводы', 'Кэшбэк 1 250', 'Карта •• 4821', 'Показать все', 'Accounts', 'Settings'
+    ], 6)
+    keyword = rng.choice(['Баланс', 'Доступно', 'Основной счет', 'Balance', 'Available', 'Total'])
+    lines = noise[:3] + [bank, keyword, format_amount(amount, currency)] + noise[3:]
+    return '\n'.join(lines)
+
+def make_ocr_corpus(count, seed=42):
+    """Корпус текстов OCR для замера extract_balance_from_text: список списков строк"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        currency, bank, typical = rng.choice(CURRENCIES)
+        amount = round(typical * rng.uniform(0.1, 3), 2)
+        corpus.append(make_ocr_text(rng, amount, currency, bank).split('\n'))
+    return corpus
+
+def reset_data(session):
+    """Удаляет счета, транзакции и тексты OCR (только для БД, отданной под бенчмарк)"""
+    from models import Account, Transaction, OcrDocument
+    session.query(Transaction).delete()
+    session.query(OcrDocument).delete()
+    session.query(Account).delete()
+    session.commit()
+
+def seed_database(accounts=5, transactions=1000, days=90, seed=42, reset=False, chunk_size=5000):
+    """Заполняет БД из DATABASE_URL; возвращает сводку сгенерированных данных"""
+    from sqlalchemy import insert
+    from models import create_tables, create_session, Account, Transaction, OcrDocument, convert_to_usd, encode_ocr_text
+
+    if accounts > len(CURRENCIES):
+        raise ValueError(f"Счетов не больше {len(CURRENCIES)}: в приложении один счет на валюту")
+
+    create_tables()
+    rng = random.Random(seed)
+    session = create_session()
+    try:
+        if reset:
+            reset_data(session)
+        elif session.query(Account).count():
+            raise RuntimeError("В БД уже есть счета; для бенчмарка нужна пустая БД или --reset")
+
+        start = TIMELINE_END - timedelta(days=days)
+        total_rows = 0
+        document_ids = {}
+        
+        def insert_transactions(rows):
+            # Тексты OCR - в ocr_documents (по одному на содержимое), в транзакции - ссылка
+            documents = {}
+            for row in rows:
+                document = encode_ocr_text(row.pop('original_text'))
+                row['ocr_document_sha256'] = document['sha256']
+                if document['sha256'] not in document_ids:
+                    documents[document['sha256']] = dict(document, created_at=row['timestamp'])
+            if documents:
+                inserted = session.execute(
+                    insert(OcrDocument).returning(OcrDocument.id, OcrDocument.sha256, sort_by_parameter_order=True),
+                    list(documents.values())
+                )
+                document_ids.update((sha256, document_id) for document_id, sha256 in inserted)
+            for row in rows:
+                row['ocr_document_id'] = document_ids[row.pop('ocr_document_sha256')]
+            session.execute(insert(Transaction), rows)
+
+        for currency, bank, typical in CURRENCIES[:accounts]:
+            account = Account(name=f"{bank} ({currency})", currency=currency, balance=0.0, balance_usd=0.0)
+            session.add(account)
+            session.flush()
+
+            # Случайные моменты времени в пределах окна, по возрастанию
+            moments = sorted(rng.random() for _ in range(transactions))
+            balance = 0.0
+            rows = []
+            for moment in moments:
+                new_balance = round(max(0.0, typical * rng.uniform(0.2, 2.5)), 2)
+                rows.append({
+                    'account_id': account.id,
+                    'timestamp': start + timedelta(seconds=moment * days * 86400),
+                    'old_balance': balance,
+                    'new_balance': new_balance,
+                    'change': round(new_balance - balance, 2),
+                    'source': rng.choice(SOURCES),
+                    'original_text': make_ocr_text(rng, new_balance, currency, bank)
+                })
+                balance = new_balance
+
+                if len(rows) >= chunk_size:
+                    insert_transactions(rows)
+                    total_rows += len(rows)
+                    rows = []
+
+            if rows:
+                insert_transactions(rows)
+                total_rows += len(rows)
+
+            account.balance = balance
+            account.balance_usd = convert_to_usd(balance, currency)
+            account.last_updated = TIMELINE_END
+
+        session.commit()
+        return {'accounts': accounts, 'transactions': total_rows, 'days': days, 'seed': seed}
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def pin_fixed_exchange_rates():
+    """Фиксирует курсы валют, чтобы результаты не зависели от сети и API курсов"""
+    import models
+    models._exchange_rates_cache = models._get_fixed_rates()
+    models._exchange_rates_version = models._rates_version(models._exchange_rates_cache)
+    models._cache_expiry = datetime.utcnow() + timedelta(days=365)
+
+def main():
+    parser = argparse.ArgumentParser(description='Синтетические данные для бенчмарков Finance Tracker')
+    parser.add_argument('--accounts', type=int, default=5, help=f'Счетов (не больше {len(CURRENCIES)})')
+    parser.add_argument('--transactions', type=int, default=1000, help='Транзакций на счет')
+    parser.add_argument('--days', type=int, default=90, help='Длина истории в днях')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true', help='Удалить существующие счета и транзакции')
+    args = parser.parse_args()
+
+    pin_fixed_exchange_rates()
+    print(seed_database(args.accounts, args.transactions, args.days, args.seed, args.reset))
+
+if __name__ == '__main__':
+    main()
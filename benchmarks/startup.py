@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Замер времени холодного импорта модулей Finance Tracker
+
+Каждый модуль импортируется в отдельном процессе с `python -X importtime`,
+печатается JSON: общее время импорта, время процесса целиком и самые тяжелые
+зависимости. С --budget-ms скрипт завершается с кодом 1, если модуль не уложился.
+
+Пример:
+    python benchmarks/startup.py --repeat 5 --budget-ms 1500
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULES = ['models', 'core', 'app', 'asgi', 'worker', 'telegram_bot_with_graphs']
+
+def parse_importtime(stderr):
+    """Разбирает вывод -X importtime: {модуль: (self_us, cumulative_us)} для модулей верхнего уровня вложенности"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        # Вложенность показана отступом имени; нас интересуют пакеты целиком
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return modules
+
+def measure(module, env):
+    """Один холодный импорт модуля: (время процесса, разобранный importtime)"""
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    elapsed = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{completed.stderr[-2000:]}')
+    return elapsed, parse_importtime(completed.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Время холодного старта модулей Finance Tracker')
+    parser.add_argument('--module', action='append', dest='modules',
+                        help='Модуль для замера (можно указать несколько раз)')
+    parser.add_argument('--repeat', type=int, default=3, help='Повторов на модуль (берется медиана)')
+    parser.add_argument('--top', type=int, default=8, help='Сколько самых тяжелых зависимостей показать')
+    parser.add_argument('--budget-ms', type=float, help='Бюджет времени импорта одного модуля (мс)')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+
+    results = []
+    over_budget = False
+    for module in args.modules or DEFAULT_MODULES:
+        runs = [measure(module, env) for _ in range(args.repeat)]
+        wall = statistics.median(run[0] for run in runs)
+        imports = runs[-1][1]
+        import_ms = statistics.median(run[1].get(module, (0, 0, 0))[1] for run in runs) / 1000
+
+        top_level = sorted(
+            ((name, cumulative) for name, (_, cumulative, depth) in imports.items() if depth == 1 and name != module),
+            key=lambda item: item[1], reverse=True
+        )
+        result = {
+            'module': module,
+            'import_ms': round(import_ms, 1),
+            'process_ms': round(wall * 1000, 1),
+            'heaviest': [{'name': name, 'ms': round(us / 1000, 1)} for name, us in top_level[:args.top]],
+            'loaded': {name: name in imports for name in ('matplotlib', 'google.cloud.vision', 'requests')}
+        }
+        if args.budget_ms is not None:
+            result['within_budget'] = import_ms <= args.budget_ms
+            over_budget = over_budget or not result['within_budget']
+        results.append(result)
+
+    print(json.dumps({'python': sys.version.split()[0], 'repeat': args.repeat, 'results': results},
+                     ensure_ascii=False, indent=2))
+    sys.exit(1 if over_budget else 0)
+
+if __name__ == '__main__':
+    main()
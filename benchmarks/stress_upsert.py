@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Стресс-тест параллельной записи балансов (upsert счета + транзакция)
+
+T потоков одновременно пишут балансы в небольшое число валют через
+FinanceTrackerCore.update_account_balance_from_image. Затем проверяются
+инварианты:
+- на валюту ровно один счет;
+- транзакций столько же, сколько успешных записей;
+- цепочка old_balance -> new_balance у каждого счета непрерывна;
+- баланс счета равен new_balance его последней транзакции.
+Печатает JSON и завершается с кодом 1 при нарушении.
+
+С --coalesce-window записи одной валюты внутри окна склеиваются
+(COALESCE_WINDOW_SECONDS, отложенная запись): транзакций и коммитов становится
+меньше, чем записей, а поглощенные записи считает ft_balance_writes_coalesced_total.
+
+Пример:
+    python benchmarks/stress_upsert.py --threads 16 --writes 50 --currencies 2
+    python benchmarks/stress_upsert.py --threads 16 --writes 50 --currencies 2 --coalesce-window 0.05
+    DATABASE_URL=postgresql://... python benchmarks/stress_upsert.py --reset
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CURRENCIES = ['RUB', 'USD', 'EUR', 'AED', 'IDR']
+
+def check_invariants(currencies, expected_transactions):
+    """Список нарушений инвариантов (пустой - все в порядке)"""
+    from models import create_session, Account, Transaction
+
+    problems = []
+    session = create_session()
+    try:
+        for currency in currencies:
+            accounts = session.query(Account).filter_by(currency=currency).all()
+            if len(accounts) != 1:
+                problems.append(f'{currency}: {len(accounts)} счетов')
+                continue
+
+            account = accounts[0]
+            transactions = session.query(Transaction.old_balance, Transaction.new_balance).filter_by(
+                account_id=account.id
+            ).order_by(Transaction.id).all()
+
+            previous = 0.0
+            for index, (old_balance, new_balance) in enumerate(transactions):
+                if abs(old_balance - previous) > 1e-9:
+                    problems.append(f'{currency}: транзакция #{index} old_balance={old_balance}, ожидалось {previous}')
+                    break
+                previous = new_balance
+
+            if transactions and abs(account.balance - previous) > 1e-9:
+                problems.append(f'{currency}: баланс счета {account.balance}, последняя транзакция {previous}')
+
+        total = session.query(Transaction).count()
+        if total != expected_transactions:
+            problems.append(f'транзакций {total}, ожидалось {expected_transactions}')
+    finally:
+        session.close()
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Стресс-тест параллельных upsert балансов')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=50, help='Записей на поток')
+    parser.add_argument('--currencies', type=int, default=2, help='Сколько валют делят потоки (меньше - больше конфликтов)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true', help='Очистить счета и транзакции в DATABASE_URL')
+    parser.add_argument('--coalesce-window', type=float, default=0.0,
+                        help='COALESCE_WINDOW_SECONDS (0 - каждая запись отдельно)')
+    args = parser.parse_args()
+    os.environ['COALESCE_WINDOW_SECONDS'] = str(args.coalesce_window)
+
+    if not os.environ.get('DATABASE_URL'):
+        database_path = os.path.join(tempfile.gettempdir(), 'finance-tracker-stress.db')
+        if os.path.exists(database_path):
+            os.remove(database_path)
+        os.environ['DATABASE_URL'] = f'sqlite:///{database_path}'
+
+    with contextlib.redirect_stdout(sys.stderr):
+        import seed
+        from sqlalchemy import event
+        from models import create_tables, create_session, get_engine, Account
+
+        seed.pin_fixed_exchange_rates()
+        create_tables()
+        session = create_session()
+        try:
+            if args.reset:
+                seed.reset_data(session)
+            elif session.query(Account).count():
+                raise SystemExit('В БД уже есть счета; нужна пустая БД или --reset')
+        finally:
+            session.close()
+
+        from core import finance_tracker_core
+        from metrics import BALANCE_WRITES_COALESCED_TOTAL
+
+        # Запросы к БД на одну запись (upsert + пересборка снимка счетов) и коммиты
+        statements = [0]
+        commits = [0]
+        statements_lock = threading.Lock()
+
+        @event.listens_for(get_engine(), 'before_cursor_execute')
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            with statements_lock:
+                statements[0] += 1
+
+        @event.listens_for(get_engine(), 'commit')
+        def count_commit(conn):
+            with statements_lock:
+                commits[0] += 1
+
+        currencies = CURRENCIES[:args.currencies]
+        successes = [0]
+        errors = []
+        latencies = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(args.threads)
+
+        def writer(index):
+            rng = random.Random(args.seed + index)
+            barrier.wait()
+            for _ in range(args.writes):
+                balance = {'currency': rng.choice(currencies), 'value': f"{rng.uniform(1, 100000):.2f}"}
+                started = time.perf_counter()
+                result = finance_tracker_core.update_account_balance_from_image(balance, 'stress', source='stress')
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    if result['success']:
+                        successes[0] += 1
+                    else:
+                        errors.append(result['error'])
+
+        coalesced_before = BALANCE_WRITES_COALESCED_TOTAL.value()
+        threads = [threading.Thread(target=writer, args=(index,)) for index in range(args.threads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Отложенные балансы последнего окна
+        finance_tracker_core.flush_pending_writes()
+        elapsed = time.perf_counter() - started
+
+        # Каждая успешная запись - транзакция, кроме поглощенных более поздней
+        expected_transactions = successes[0] - (BALANCE_WRITES_COALESCED_TOTAL.value() - coalesced_before)
+        problems = check_invariants(currencies, expected_transactions)
+
+    latencies.sort()
+    total_writes = args.threads * args.writes
+    report = {
+        'database': get_engine().dialect.name,
+        'threads': args.threads,
+        'writes': total_writes,
+        'currencies': currencies,
+        'successful': successes[0],
+        'coalesce_window': args.coalesce_window,
+        'transactions': expected_transactions,
+        'commits_per_write': round(commits[0] / total_writes, 2),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'writes_per_sec': round(successes[0] / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+        'statements_per_write': round(statements[0] / total_writes, 2),
+        'invariant_violations': problems,
+        'ok': not problems and not errors
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    sys.exit(0 if report['ok'] else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Общий кэш веб-приложения, бота и воркера
+
+Бэкенд выбирается CACHE_BACKEND:
+- memory (по умолчанию) - LRU в памяти процесса на CACHE_MAX_ENTRIES записей;
+- sqlite:///путь/к/cache.db - файл на диске: общий для процессов хоста и
+  переживает перезапуск;
+- redis://[:пароль@]хост:порт/номер_бд - любой сервер с протоколом Redis
+  (GET/SET PX/DEL), общий для процессов на разных хостах.
+
+В кэше лежат курсы валют, история баланса, построенные графики и file_id
+графиков бота, так что работа одного процесса прогревает остальные. Ключи
+содержат версию данных, поэтому устаревшие значения просто перестают читаться
+и вытесняются по TTL. Значения в sqlite/redis хранятся через pickle: бэкенд
+должен быть доверенным, как и сама БД. Ошибки sqlite/redis не ломают вызов:
+чтение считается промахом, запись пропускается.
+"""
+
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+from metrics import Counter
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '256'))
+# Префикс ключей: несколько приложений могут делить один Redis
+CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'ft:')
+# Сколько хранить историю баланса и готовые графики (сек); ключи и так меняются с данными,
+# TTL нужен для изменений без новой транзакции (сжатие и архивация истории)
+HISTORY_CACHE_TTL = float(os.environ.get('HISTORY_CACHE_TTL', '3600'))
+CHART_CACHE_TTL = float(os.environ.get('CHART_CACHE_TTL', '3600'))
+
+CACHE_REQUESTS_TOTAL = Counter(
+    'ft_cache_requests_total', 'Обращения к общему кэшу по пространству ключей и результату', ['namespace', 'result']
+)
+
+def _namespace(key):
+    return key.split(':', 1)[0]
+
+class MemoryCache:
+    """LRU в памяти процесса; значения хранятся как есть, без копирования"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class SQLiteCache:
+    """Кэш в файле SQLite: общий для процессов на одном хосте"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._connection().execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires_at REAL
+            )
+        """)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value, expires_at FROM cache_entries WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and time.time() >= row[1]):
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            'INSERT INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl if ttl else None)
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            conn.execute('DELETE FROM cache_entries WHERE expires_at < ?', (now,))
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+
+class RedisError(Exception):
+    """Ошибка, которую вернул сервер Redis"""
+
+class RedisCache:
+    """Кэш на сервере с протоколом Redis (RESP2): достаточно GET, SET PX и DEL
+
+    Клиент встроенный - на сокетах стандартной библиотеки, по соединению на поток.
+    """
+
+    def __init__(self, url, timeout=1.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._local.sock, self._local.reader = sock, sock.makefile('rb')
+        if self.password:
+            self._roundtrip('AUTH', self.password)
+        if self.db:
+            self._roundtrip('SELECT', self.db)
+
+    def _disconnect(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = self._local.reader = None
+        if sock is not None:
+            sock.close()
+
+    def _roundtrip(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self._local.sock.sendall(b''.join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        reader = self._local.reader
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('Redis закрыл соединение')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            return None if length < 0 else reader.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [self._read_reply() for _ in range(length)]
+        raise ConnectionError(f'Непонятный ответ Redis: {line[:20]!r}')
+
+    def command(self, *args):
+        """Выполняет команду; разорванное соединение переоткрывается один раз"""
+        for attempt in range(2):
+            try:
+                if getattr(self._local, 'sock', None) is None:
+                    self._connect()
+                return self._roundtrip(*args)
+            except (OSError, ConnectionError):
+                self._disconnect()
+                if attempt:
+                    raise
+
+    def get(self, key):
+        data = self.command('GET', key)
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if ttl:
+            self.command('SET', key, data, 'PX', int(ttl * 1000))
+        else:
+            self.command('SET', key, data)
+
+    def delete(self, key):
+        self.command('DEL', key)
+
+class Cache:
+    """Фасад над бэкендом: префикс ключей, метрики и ошибки бэкенда как промахи"""
+
+    def __init__(self, backend, prefix=CACHE_KEY_PREFIX):
+        self.backend = backend
+        self.prefix = prefix
+
+    def get(self, key):
+        """Значение по ключу или None"""
+        try:
+            value = self.backend.get(self.prefix + key)
+        except Exception as e:
+            print(f"⚠️ Ошибка чтения кэша {key}: {e}")
+            CACHE_REQUESTS_TOTAL.inc(namespace=_namespace(key), result='error')
+            return None
+        CACHE_REQUESTS_TOTAL.inc(namespace=_namespace(key), result='miss' if value is None else 'hit')
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Кладет значение (не None) на ttl секунд (без ttl - до вытеснения)"""
+        try:
+            self.backend.set(self.prefix + key, value, ttl)
+        except Exception as e:
+            print(f"⚠️ Ошибка записи кэша {key}: {e}")
+
+    def delete(self, key):
+        try:
+            self.backend.delete(self.prefix + key)
+        except Exception as e:
+            print(f"⚠️ Ошибка удаления из кэша {key}: {e}")
+
+    def get_or_set(self, key, compute, ttl=None, store_if=None):
+        """Значение из кэша, иначе compute() с записью в кэш
+
+        store_if(value) решает, сохранять ли результат (например, только успешные).
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if value is not None and (store_if is None or store_if(value)):
+                self.set(key, value, ttl)
+        return value
+
+def create_backend(url):
+    """Бэкенд по CACHE_BACKEND: memory, sqlite:///путь или redis://хост:порт/бд"""
+    if url == 'memory':
+        return MemoryCache()
+    if url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):])
+    if url.startswith('redis://'):
+        return RedisCache(url)
+    raise ValueError(f"Неизвестный CACHE_BACKEND: {url}")
+
+# Глобальный экземпляр
+shared_cache = Cache(create_backend(CACHE_BACKEND))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Сжатие старой истории транзакций
+
+Скриншоты часто присылают повторно, поэтому в transactions копятся записи с
+нулевым изменением и по нескольку обновлений за день, а get_balance_history
+все равно берет последний баланс счета за день. Для дней старше
+COMPACTION_RETENTION_DAYS:
+- несколько транзакций счета за день сворачиваются в одну - последнюю за день,
+  с old_balance первой (цепочка old_balance -> new_balance не рвется);
+- день счета, в котором баланс в итоге не изменился, удаляется целиком
+  (на истории это только пропавшие точки «без изменений»).
+По каждому затронутому дню счета пишется запись в transaction_compactions.
+
+Работа идет пачками по COMPACTION_BATCH_DAYS дней, каждая - своя короткая
+транзакция; там же сдвигается курсор в system_info, поэтому прерванный запуск
+продолжается с места остановки. Курсор входит в версию истории
+(core.get_history_version): кэши истории и графиков после сжатия устаревают.
+Запуск: python manage.py compact
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import insert, text, update
+from models import create_session, Transaction, TransactionCompaction, OcrDocument, SystemInfo
+
+# Моложе стольких дней история не трогается
+COMPACTION_RETENTION_DAYS = int(os.environ.get('COMPACTION_RETENTION_DAYS', '30'))
+# Дней в одной транзакции сжатия
+COMPACTION_BATCH_DAYS = int(os.environ.get('COMPACTION_BATCH_DAYS', '7'))
+
+CURSOR_KEY = 'compaction_cursor'
+# Размер списков id в DELETE ... WHERE id IN (...)
+DELETE_CHUNK = 500
+BALANCE_EPSILON = 1e-9
+
+def _day_start(day):
+    return datetime(day.year, day.month, day.day)
+
+def get_cursor(session):
+    """Первый еще не обработанный день или None"""
+    value = session.query(SystemInfo.value).filter_by(key=CURSOR_KEY).scalar()
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+def _set_cursor(session, day):
+    info = session.query(SystemInfo).filter_by(key=CURSOR_KEY).first()
+    if info is None:
+        info = SystemInfo(key=CURSOR_KEY)
+        session.add(info)
+    info.value = day.isoformat()
+    info.updated_at = datetime.utcnow()
+
+def plan_compaction(rows):
+    """По транзакциям (id, account_id, timestamp, old_balance, new_balance, ocr_document_id),
+    упорядоченным по счету и времени, возвращает (delete_ids, updates, audits)"""
+    groups = {}
+    for row in rows:
+        groups.setdefault((row.account_id, row.timestamp.date()), []).append(row)
+
+    delete_ids, updates, audits = [], [], []
+    for (account_id, day), group in groups.items():
+        first, last = group[0], group[-1]
+        unchanged = abs(last.new_balance - first.old_balance) < BALANCE_EPSILON
+        if len(group) == 1 and not unchanged:
+            continue
+
+        delete_ids.extend(row.id for row in group[:-1])
+        if unchanged:
+            delete_ids.append(last.id)
+        elif first.old_balance != last.old_balance:
+            updates.append({
+                'id': last.id,
+                'old_balance': first.old_balance,
+                'change': last.new_balance - first.old_balance
+            })
+
+        audits.append({
+            'account_id': account_id,
+            'day': day,
+            'rows_before': len(group),
+            'rows_after': 0 if unchanged else 1,
+            'old_balance': first.old_balance,
+            'new_balance': last.new_balance,
+            'first_transaction_id': first.id,
+            'last_transaction_id': last.id
+        })
+    return delete_ids, updates, audits
+
+def compact_batch(session, start_day, end_day):
+    """Сжимает дни [start_day, end_day) в текущей транзакции; коммит - на вызывающем"""
+    start, end = _day_start(start_day), _day_start(end_day)
+    in_range = (Transaction.timestamp >= start, Transaction.timestamp < end)
+
+    rows = session.query(
+        Transaction.id, Transaction.account_id, Transaction.timestamp,
+        Transaction.old_balance, Transaction.new_balance, Transaction.ocr_document_id
+    ).filter(*in_range).order_by(Transaction.account_id, Transaction.timestamp, Transaction.id).all()
+
+    delete_ids, updates, audits = plan_compaction(rows)
+    deleted = set(delete_ids)
+    # Тексты OCR удаленных транзакций, если на них больше никто не ссылается
+    document_ids = {row.ocr_document_id for row in rows if row.id in deleted and row.ocr_document_id}
+
+    for index in range(0, len(delete_ids), DELETE_CHUNK):
+        # Фильтр по времени оставляет PostgreSQL только секции этих дней
+        session.query(Transaction).filter(
+            Transaction.id.in_(delete_ids[index:index + DELETE_CHUNK]), *in_range
+        ).delete(synchronize_session=False)
+    if updates:
+        session.execute(update(Transaction), updates)
+    if audits:
+        session.execute(insert(TransactionCompaction), audits)
+
+    documents_deleted = 0
+    if document_ids:
+        if session.get_bind().dialect.name == 'postgresql':
+            # Запись баланса переиспользует документ по sha256 (ON CONFLICT) и ссылается на
+            # него новой транзакцией. Блокировка ждет такие записи до их коммита и не пускает
+            # новые до конца пачки: проверка ссылок ниже видит все транзакции
+            session.execute(text("LOCK TABLE ocr_documents IN SHARE ROW EXCLUSIVE MODE"))
+        # Проверка ссылок и удаление - один запрос, без окна между ними
+        documents_deleted = session.query(OcrDocument).filter(
+            OcrDocument.id.in_(document_ids),
+            ~session.query(Transaction.id).filter(Transaction.ocr_document_id == OcrDocument.id).exists()
+        ).delete(synchronize_session=False)
+
+    return {
+        'rows': len(rows),
+        'rows_deleted': len(delete_ids),
+        'rows_updated': len(updates),
+        'days_compacted': len(audits),
+        'documents_deleted': documents_deleted
+    }
+
+def compact_history(retention_days=None, batch_days=None, pause=0.0, dry_run=False, now=None):
+    """Сжимает историю старше retention_days пачками по batch_days дней; возвращает итоги
+
+    dry_run - все посчитать, но откатить каждую пачку и не двигать курсор.
+    pause - пауза между пачками (сек), чтобы не занимать БД надолго.
+    """
+    retention_days = COMPACTION_RETENTION_DAYS if retention_days is None else retention_days
+    batch_days = batch_days or COMPACTION_BATCH_DAYS
+    until = (now or datetime.utcnow()).date() - timedelta(days=retention_days)
+
+    totals = {'batches': 0, 'rows': 0, 'rows_deleted': 0, 'rows_updated': 0, 'days_compacted': 0, 'documents_deleted': 0}
+    session = create_session()
+    try:
+        day = get_cursor(session)
+        if day is None:
+            first = session.query(Transaction.timestamp).order_by(Transaction.timestamp).first()
+            day = first[0].date() if first else until
+        session.rollback()
+
+        while day < until:
+            batch_end = min(day + timedelta(days=batch_days), until)
+            result = compact_batch(session, day, batch_end)
+            if dry_run:
+                session.rollback()
+            else:
+                _set_cursor(session, batch_end)
+                session.commit()
+
+            totals['batches'] += 1
+            for key, value in result.items():
+                totals[key] += value
+            print(f"🧹 {day} .. {batch_end}: удалено {result['rows_deleted']}, "
+                  f"изменено {result['rows_updated']} из {result['rows']} транзакций")
+
+            day = batch_end
+            if pause and day < until:
+                time.sleep(pause)
+
+        totals['compacted_until'] = day.isoformat()
+        return totals
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
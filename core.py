@@ -3,19 +3,31 @@
 Общая логика для Finance Tracker
 """
 
+import atexit
+import io
+import json
 import os
 import re
-from datetime import datetime
-from google.cloud import vision
-from models import create_session, Account, Transaction, SystemInfo, convert_to_usd
+import threading
+import time
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from sqlalchemy import func
+from models import create_session, Account, Transaction, SystemInfo, IngestJob, convert_to_usd, upsert_account_balance, add_revaluation_listener, get_exchange_rates_version, notify_change
+from events import event_broker, change_listener
+from cache import shared_cache, HISTORY_CACHE_TTL
+from compaction import CURSOR_KEY as COMPACTION_CURSOR_KEY
+from metrics import timed, VISION_OCR_SECONDS, BALANCE_EXTRACTION_SECONDS, DB_METHOD_SECONDS, CHART_RENDER_SECONDS, BALANCE_WRITES_COALESCED_TOTAL
 
 class FinanceTrackerCore:
     """Общая логика для веб-приложения и телеграм бота"""
     
     def __init__(self):
         """Инициализация общего трекера"""
-        # Инициализация Google Vision API
-        self.vision_client = self._init_vision_client()
+        # Google Vision API подключается при первом обращении (см. vision_client)
+        self._vision_client = None
+        self._vision_client_ready = False
+        self._vision_client_lock = threading.Lock()
         
         # Паттерны для всех валют
         self.currency_patterns = {
@@ -51,6 +63,57 @@ class FinanceTrackerCore:
             'balance', 'total', 'available', 'current', 'main', 'cash',
             'баланс', 'доступно', 'основной', 'текущий', 'общий', 'наличные'
         ]
+        
+        # Кэш снимка счетов (итоги + детали), сбрасывается при записи
+        self._accounts_snapshot = None
+        self._accounts_snapshot_expiry = 0
+        self._accounts_snapshot_ttl = float(os.environ.get('ACCOUNTS_SNAPSHOT_TTL', '30'))
+        self._accounts_snapshot_lock = threading.Lock()
+        # Растет при каждом сбросе: снимок, прочитанный до записи, не кладется после нее
+        self._accounts_snapshot_generation = 0
+        # После пересчета balance_usd по новым курсам снимок устарел
+        add_revaluation_listener(self.invalidate_accounts_snapshot)
+        # И после записи баланса другим процессом (NOTIFY или строка версии)
+        change_listener.add_callback(lambda change: self.invalidate_accounts_snapshot())
+        
+        # Склейка частых записей баланса одной валюты (write-behind): в памяти
+        # держится последний баланс валюты, через окно в БД уходит одна запись.
+        # 0 - каждая запись сразу: см. update_account_balance_from_image
+        self._coalesce_window = float(os.environ.get('COALESCE_WINDOW_SECONDS', '1'))
+        self._pending_writes = {}
+        self._pending_writes_lock = threading.Lock()
+        # Отложенные и прямые записи при включенной склейке идут по одной,
+        # чтобы более поздний баланс валюты не обогнал более ранний
+        self._flush_lock = threading.Lock()
+        atexit.register(self.flush_pending_writes)
+        
+        # Окно истории баланса в днях (0 - вся история): запросы истории ограничены
+        # по timestamp, и PostgreSQL читает только секции transactions из окна
+        self.history_days = int(os.environ.get('HISTORY_DAYS', '730'))
+        
+        # sync - распознавать в запросе, queue - ставить в очередь ingest_jobs (worker.py)
+        self.ingest_mode = os.environ.get('INGEST_MODE', 'sync')
+        self.ingest_max_attempts = int(os.environ.get('INGEST_MAX_ATTEMPTS', '5'))
+
+    @property
+    def vision_client(self):
+        """Клиент Google Vision; создается при первом обращении
+
+        Импорт google.cloud.vision и gRPC-канал стоят сотни миллисекунд старта,
+        а процессам, которые не распознают скриншоты (веб при INGEST_MODE=queue),
+        не нужны вовсе.
+        """
+        if not self._vision_client_ready:
+            with self._vision_client_lock:
+                if not self._vision_client_ready:
+                    self._vision_client = self._init_vision_client()
+                    self._vision_client_ready = True
+        return self._vision_client
+
+    @vision_client.setter
+    def vision_client(self, client):
+        self._vision_client = client
+        self._vision_client_ready = True
 
     def _init_vision_client(self):
         """Инициализация Google Vision API"""
@@ -66,6 +129,7 @@ class FinanceTrackerCore:
                     print(f"📝 Создан временный файл: {temp_credentials_path}")
                 
                 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = temp_credentials_path
+                from google.cloud import vision
                 vision_client = vision.ImageAnnotatorClient()
                 print("✅ Google Vision API подключен через GOOGLE_CREDENTIALS_CONTENT!")
                 return vision_client
@@ -93,6 +157,7 @@ class FinanceTrackerCore:
                     pass
         return None
 
+    @timed(BALANCE_EXTRACTION_SECONDS)
     def extract_balance_from_text(self, text_lines):
         """Извлекаем баланс из распознанного текста"""
         balances = []
@@ -139,14 +204,35 @@ class FinanceTrackerCore:
         
         return balances
 
+    def read_image_content(self, image):
+        """Возвращает содержимое изображения как bytes, копируя данные не более одного раза
+
+        Принимает bytes (проходят как есть), bytearray/memoryview, BytesIO
+        (getvalue() отдает внутренний буфер без копии) или файловый объект
+        (например, загрузка, сброшенная во временный файл).
+        """
+        if isinstance(image, bytes):
+            return image
+        if isinstance(image, (bytearray, memoryview)):
+            return bytes(image)
+        if isinstance(image, io.BytesIO):
+            return image.getvalue()
+        
+        image.seek(0)
+        return image.read()
+
     def process_image(self, image_content):
         """Обрабатываем изображение через Google Vision"""
         if not self.vision_client:
             return {'success': False, 'error': 'Google Vision недоступен'}
         
         try:
-            image = vision.Image(content=image_content)
-            response = self.vision_client.text_detection(image=image)
+            # Vision принимает только bytes: материализуем файл один раз здесь,
+            # в пуле обработки, а не в потоке запроса
+            from google.cloud import vision
+            image = vision.Image(content=self.read_image_content(image_content))
+            with VISION_OCR_SECONDS.time():
+                response = self.vision_client.text_detection(image=image)
             texts = response.text_annotations
             
             if not texts:
@@ -192,98 +278,383 @@ class FinanceTrackerCore:
                 'error': str(e)
             }
 
-    def update_account_balance_from_image(self, balance_data, image_text, source='web'):
-        """Обновляем баланс счета в БД на основе распознанного изображения"""
+    def update_account_balance_from_image(self, balance_data, image_text, source='web', on_write=None):
+        """Обновляем баланс счета в БД на основе распознанного изображения
+
+        on_write(session, result) вызывается в той же транзакции БД перед коммитом
+        (воркер отмечает так задачу очереди); исключение в нем откатывает запись.
+
+        При COALESCE_WINDOW_SECONDS > 0 запись отложенная (write-behind): последний
+        баланс каждой валюты держится в памяти процесса и через окно пишется в БД
+        одной транзакцией, прежние значения серии уходят в intermediate_values.
+        Вызов окна не ждет и сразу получает результат с pending=True, поэтому
+        склеиваются и скриншоты одного чата, которые бот обрабатывает по очереди.
+
+        Сразу пишутся первый баланс новой валюты (счету нужен id) и записи с on_write
+        (отметка задачи очереди должна быть в той же транзакции); отложенный баланс
+        своей валюты они забирают в intermediate_values.
+        """
+        callbacks = [on_write] if on_write else []
+        if self._coalesce_window <= 0:
+            return self._write_account_balance(balance_data, image_text, source, on_write=callbacks)
+        
+        if not on_write:
+            result = self._buffer_account_balance(balance_data, image_text, source)
+            if result is not None:
+                return result
+        
+        with self._flush_lock:
+            pending = self._pop_pending_write(balance_data['currency'])
+            intermediate_values = None
+            if pending is not None:
+                pending['timer'].cancel()
+                intermediate_values = pending['intermediate_values'] + [float(pending['balance_data']['value'])]
+                BALANCE_WRITES_COALESCED_TOTAL.inc(len(intermediate_values))
+            return self._write_account_balance(balance_data, image_text, source, intermediate_values, on_write=callbacks)
+
+    def _buffer_account_balance(self, balance_data, image_text, source):
+        """Откладывает запись баланса на окно склейки; None - счета еще нет, писать сразу"""
+        currency = balance_data['currency']
+        new_balance = float(balance_data['value'])
+        
+        session = create_session()
         try:
-            session = create_session()
-            
-            # Ищем существующий аккаунт по валюте
-            account = session.query(Account).filter_by(
-                currency=balance_data['currency']
-            ).first()
-            
-            if not account:
-                # Создаем новый аккаунт
-                account_names = {
-                    'RUB': 'Российский счет',
-                    'USD': 'Долларовый счет',
-                    'EUR': 'Евро счет',
-                    'AED': 'Дирхамовый счет',
-                    'IDR': 'Рупиевый счет'
-                }
-                
-                account_name = account_names.get(balance_data['currency'], f'Счет в {balance_data["currency"]}')
-                
-                account = Account(
-                    name=account_name,
-                    currency=balance_data['currency'],
-                    balance=0,
-                    balance_usd=0,
-                    last_updated=datetime.utcnow()
-                )
-                session.add(account)
-                session.flush()  # Получаем ID
-            
-            # Обновляем баланс
-            old_balance = account.balance
-            account.balance = float(balance_data['value'])
-            account.balance_usd = convert_to_usd(account.balance, account.currency)
-            account.last_updated = datetime.utcnow()
-            
-            # Создаем транзакцию
-            transaction = Transaction(
-                account_id=account.id,
-                timestamp=datetime.utcnow(),
-                old_balance=old_balance,
-                new_balance=account.balance,
-                change=account.balance - old_balance,
+            account = session.query(
+                Account.id, Account.name, Account.balance, Account.balance_usd
+            ).filter_by(currency=currency).first()
+        finally:
+            session.close()
+        
+        if account is None:
+            return None
+        
+        with self._pending_writes_lock:
+            pending = self._pending_writes.get(currency)
+            if pending is None:
+                previous = account.balance
+                timer = threading.Timer(self._coalesce_window, self._flush_pending_write, args=(currency,))
+                timer.daemon = True
+                pending = self._pending_writes[currency] = {'intermediate_values': [], 'timer': timer}
+                timer.start()
+            else:
+                previous = float(pending['balance_data']['value'])
+                pending['intermediate_values'].append(previous)
+            pending.update(balance_data=balance_data, image_text=image_text, source=source)
+        
+        balance_usd = convert_to_usd(new_balance, currency)
+        return {
+            'success': True,
+            'pending': True,
+            'account': {
+                'id': account.id,
+                'name': account.name,
+                'currency': currency,
+                'balance': new_balance,
+                'balance_usd': balance_usd,
+                'last_updated': datetime.utcnow().isoformat()
+            },
+            'change': new_balance - previous,
+            'total_balance_usd': self.get_accounts_summary()['total_balance_usd'] - account.balance_usd + balance_usd
+        }
+
+    def _pop_pending_write(self, currency):
+        """Забирает отложенную запись валюты из буфера (None - ее нет)"""
+        with self._pending_writes_lock:
+            return self._pending_writes.pop(currency, None)
+
+    def _flush_pending_write(self, currency):
+        """Пишет отложенный баланс валюты одной транзакцией (по таймеру окна)"""
+        with self._flush_lock:
+            pending = self._pop_pending_write(currency)
+            if pending is None:
+                # Уже забрала прямая запись или flush_pending_writes
+                return
+            
+            BALANCE_WRITES_COALESCED_TOTAL.inc(len(pending['intermediate_values']))
+            result = self._write_account_balance(
+                pending['balance_data'], pending['image_text'], pending['source'],
+                pending['intermediate_values'] or None
+            )
+            if not result['success']:
+                print(f"❌ Отложенная запись баланса {currency} не удалась: {result['error']}")
+
+    def flush_pending_writes(self):
+        """Сразу пишет все отложенные балансы (при остановке процесса и в тестах)"""
+        with self._pending_writes_lock:
+            currencies = list(self._pending_writes)
+        for currency in currencies:
+            self._flush_pending_write(currency)
+
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def _write_account_balance(self, balance_data, image_text, source='web', intermediate_values=None, on_write=()):
+        """Записывает баланс счета и транзакцию, обновляет снимок и сообщает подписчикам SSE
+        (своим - напрямую, другим процессам - через notify_change)"""
+        session = create_session()
+        try:
+            account_names = {
+                'RUB': 'Российский счет',
+                'USD': 'Долларовый счет',
+                'EUR': 'Евро счет',
+                'AED': 'Дирхамовый счет',
+                'IDR': 'Рупиевый счет'
+            }
+            currency = balance_data['currency']
+            new_balance = float(balance_data['value'])
+            
+            # Счет создается или обновляется вместе с транзакцией одним upsert
+            # (уникальность валюты защищает от дублей при параллельных скриншотах)
+            row = upsert_account_balance(
+                session,
+                currency=currency,
+                name=account_names.get(currency, f'Счет в {currency}'),
+                balance=new_balance,
+                balance_usd=convert_to_usd(new_balance, currency),
                 source=source,
-                original_text=image_text
+                original_text=image_text,
+                intermediate_values=intermediate_values
             )
-            session.add(transaction)
-            
-            session.commit()
-            
-            print(f"✅ Обновлен баланс счета {account.id}: {account.balance} {account.currency} (${account.balance_usd:.2f})")
-            
-            return {
+            account_data = {
+                'id': row['id'],
+                'name': row['name'],
+                'currency': row['currency'],
+                'balance': row['balance'],
+                'balance_usd': row['balance_usd'],
+                'last_updated': row['last_updated'].isoformat()
+            }
+            result = {
                 'success': True,
-                'account': {
-                    'id': account.id,
-                    'name': account.name,
-                    'currency': account.currency,
-                    'balance': account.balance,
-                    'balance_usd': account.balance_usd,
-                    'last_updated': account.last_updated.isoformat()
-                },
-                'change': account.balance - old_balance
+                'account': account_data,
+                'change': row['balance'] - row['old_balance']
             }
+            for callback in on_write:
+                callback(session, result)
+            
+            # Другие процессы узнают о записи сразу после коммита
+            notify_change(session, {'version': row['transaction_id'], 'account_id': row['id']})
+            
+            session.commit()
+            # Своя версия: слушатель изменений не раздает ее повторно
+            change_listener.mark_own(row['transaction_id'])
             
         except Exception as e:
             print(f"❌ Ошибка обновления баланса из изображения: {e}")
             session.rollback()
+            session.close()
             return {
                 'success': False,
                 'error': str(e)
             }
+        
+        print(f"✅ Обновлен баланс счета {row['id']}: {row['balance']} {row['currency']} (${row['balance_usd']:.2f})")
+        
+        # Баланс уже записан: ошибка дальше не превращает запись в неудачу,
+        # снимок просто строится заново при следующем чтении
+        try:
+            # Запись сбрасывает снимок; сразу строим новый в той же сессии,
+            # чтобы следующий экран бота не ходил в БД
+            generation = self.invalidate_accounts_snapshot()
+            snapshot = self._build_accounts_snapshot(session)
+            self._store_accounts_snapshot(snapshot, generation)
+            
+            # Сообщаем подписчикам SSE этого процесса об изменении
+            event_broker.publish({
+                'type': 'accounts_update',
+                'version': row['transaction_id'],
+                'accounts': [account_data],
+                'total_balance_usd': round(snapshot['total_balance_usd'], 2)
+            })
+        except Exception as e:
+            print(f"⚠️ Баланс записан, но снимок счетов не обновлен: {e}")
+            self.invalidate_accounts_snapshot()
         finally:
             session.close()
+        
+        return result
 
-    def get_accounts_summary(self):
-        """Получает сводку по всем счетам"""
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def _build_accounts_snapshot(self, session):
+        """Строит снимок счетов одним запросом: итоги и детали вместе
+
+        Снимок только для чтения (MappingProxyType): один и тот же объект отдается
+        всем вызывающим из кэша, и правка по месту испортила бы его для остальных.
+        """
+        accounts = session.query(
+            Account.id, Account.name, Account.currency, Account.balance, Account.balance_usd, Account.last_updated
+        ).all()
+        
+        accounts_details = {}
+        total_balance_usd = 0
+        for account in accounts:
+            accounts_details[account.id] = MappingProxyType({
+                'name': account.name,
+                'currency': account.currency,
+                'balance': account.balance,
+                'balance_usd': account.balance_usd,
+                'last_updated': account.last_updated.isoformat() if account.last_updated else None
+            })
+            total_balance_usd += account.balance_usd
+        
+        return MappingProxyType({
+            'total_balance_usd': total_balance_usd,
+            'accounts_count': len(accounts),
+            'accounts': MappingProxyType(accounts_details)
+        })
+
+    def _store_accounts_snapshot(self, snapshot, generation):
+        """Кладет снимок счетов в кэш на ACCOUNTS_SNAPSHOT_TTL секунд
+
+        generation - поколение кэша, взятое до чтения счетов из БД. Если с тех пор
+        кэш сбрасывали (была запись), снимок мог прочитать старые балансы и не
+        кладется, иначе он перекрыл бы более новый на весь TTL.
+        """
+        with self._accounts_snapshot_lock:
+            if generation != self._accounts_snapshot_generation:
+                return False
+            self._accounts_snapshot = snapshot
+            self._accounts_snapshot_expiry = time.monotonic() + self._accounts_snapshot_ttl
+            return True
+
+    def invalidate_accounts_snapshot(self):
+        """Сбрасывает кэш снимка счетов, возвращает новое поколение кэша"""
+        with self._accounts_snapshot_lock:
+            self._accounts_snapshot = None
+            self._accounts_snapshot_expiry = 0
+            self._accounts_snapshot_generation += 1
+            return self._accounts_snapshot_generation
+
+    def ingest_image(self, image_content, source='web', include_text=True, on_write=None):
+        """Распознает изображение и обновляет баланс счета (OCR + запись в БД)"""
+        result = self.process_image(image_content)
+        
+        if result['success']:
+            transaction_result = self.update_account_balance_from_image(
+                result['main_balance'], 
+                result['full_text'],
+                source=source,
+                on_write=on_write
+            )
+            
+            if not transaction_result['success']:
+                return {'success': False, 'error': transaction_result['error'], 'update_failed': True}
+            
+            result['account'] = transaction_result['account']
+            result['change'] = transaction_result['change']
+            if transaction_result.get('pending'):
+                # Баланс еще в буфере склейки: итог посчитан с его учетом
+                result['pending'] = True
+                result['total_balance_usd'] = transaction_result['total_balance_usd']
+            else:
+                result['total_balance_usd'] = self.get_accounts_summary()['total_balance_usd']
+        
+        if not include_text:
+            # Сырой текст OCR - самая тяжелая часть ответа
+            result.pop('text_lines', None)
+            result.pop('full_text', None)
+        
+        return result
+
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def enqueue_image(self, image_content, source='web'):
+        """Ставит изображение в очередь распознавания, возвращает id задачи"""
         try:
             session = create_session()
-            accounts = session.query(Account).all()
+            now = datetime.utcnow()
             
-            total_balance_usd = sum(account.balance_usd for account in accounts)
+            job = IngestJob(
+                status='queued',
+                source=source,
+                image=self.read_image_content(image_content),
+                attempts=0,
+                max_attempts=self.ingest_max_attempts,
+                run_after=now,
+                created_at=now,
+                updated_at=now
+            )
+            session.add(job)
+            session.commit()
+            
+            return {'success': True, 'job_id': job.id, 'status': job.status}
+            
+        except Exception as e:
+            print(f"❌ Ошибка постановки изображения в очередь: {e}")
+            session.rollback()
+            return {'success': False, 'error': str(e)}
+        finally:
+            session.close()
+
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def get_ingest_job(self, job_id):
+        """Возвращает статус задачи распознавания или None, если задачи нет"""
+        try:
+            session = create_session()
+            job = session.query(IngestJob).filter_by(id=job_id).first()
+            
+            if not job:
+                return None
             
             return {
-                'total_balance_usd': total_balance_usd,
-                'accounts_count': len(accounts)
+                'id': job.id,
+                'status': job.status,
+                'source': job.source,
+                'attempts': job.attempts,
+                'max_attempts': job.max_attempts,
+                'last_error': job.last_error,
+                'result': json.loads(job.result) if job.result else None,
+                'created_at': job.created_at.isoformat() if job.created_at else None,
+                'updated_at': job.updated_at.isoformat() if job.updated_at else None
             }
+        finally:
+            session.close()
+
+    def get_accounts_snapshot(self):
+        """Получает сводку и детали по всем счетам (AccountsSnapshot) из кэша или одним запросом"""
+        with self._accounts_snapshot_lock:
+            if self._accounts_snapshot is not None and time.monotonic() < self._accounts_snapshot_expiry:
+                return self._accounts_snapshot
+            generation = self._accounts_snapshot_generation
+        
+        try:
+            session = create_session()
+            snapshot = self._build_accounts_snapshot(session)
+            self._store_accounts_snapshot(snapshot, generation)
+            return snapshot
             
         except Exception as e:
-            print(f"❌ Ошибка получения сводки по счетам: {e}")
+            print(f"❌ Ошибка получения снимка счетов: {e}")
+            return MappingProxyType({
+                'total_balance_usd': 0,
+                'accounts_count': 0,
+                'accounts': MappingProxyType({})
+            })
+        finally:
+            session.close()
+
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def get_accounts_summary(self):
+        """Получает сводку по всем счетам: из снимка в кэше или одним SUM по accounts
+
+        balance_usd пересчитывается при каждом обновлении курсов (revalue_accounts),
+        поэтому итог - просто сумма колонки, без конвертации по счетам.
+        """
+        with self._accounts_snapshot_lock:
+            snapshot = self._accounts_snapshot
+            if snapshot is not None and time.monotonic() < self._accounts_snapshot_expiry:
+                return {
+                    'total_balance_usd': snapshot['total_balance_usd'],
+                    'accounts_count': snapshot['accounts_count']
+                }
+        
+        try:
+            session = create_session()
+            total_balance_usd, accounts_count = session.query(
+                func.coalesce(func.sum(Account.balance_usd), 0.0), func.count(Account.id)
+            ).one()
+            return {
+                'total_balance_usd': total_balance_usd,
+                'accounts_count': accounts_count
+            }
+        except Exception as e:
+            print(f"❌ Ошибка получения сводки счетов: {e}")
             return {
                 'total_balance_usd': 0,
                 'accounts_count': 0
@@ -293,54 +664,111 @@ class FinanceTrackerCore:
 
     def get_accounts_details(self):
         """Получает детальную информацию по всем счетам"""
+        return self.get_accounts_snapshot()['accounts']
+
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def get_data_version(self, account_id=None):
+        """Версия данных счетов: id последней транзакции (всех счетов или одного)"""
         try:
             session = create_session()
-            accounts = session.query(Account).all()
-            
-            accounts_details = {}
-            for account in accounts:
-                accounts_details[account.id] = {
-                    'name': account.name,
-                    'currency': account.currency,
-                    'balance': account.balance,
-                    'balance_usd': account.balance_usd,
-                    'last_updated': account.last_updated.isoformat() if account.last_updated else None
-                }
+            query = session.query(func.max(Transaction.id))
+            if account_id is not None:
+                query = query.filter(Transaction.account_id == account_id)
+            return query.scalar() or 0
+        finally:
+            session.close()
+
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def get_history_version(self, account_id=None):
+        """Версия истории транзакций (всех счетов или одного): id последней транзакции
+        и курсор сжатия истории - compaction.py меняет старые транзакции, не трогая последний id"""
+        try:
+            session = create_session()
+            last_transaction = session.query(func.max(Transaction.id))
+            if account_id is not None:
+                last_transaction = last_transaction.filter(Transaction.account_id == account_id)
+            compacted_until = session.query(SystemInfo.value).filter_by(key=COMPACTION_CURSOR_KEY)
+            last_id, cursor = session.query(last_transaction.scalar_subquery(), compacted_until.scalar_subquery()).one()
+            return f"tx{last_id or 0}-c{cursor}" if cursor else f"tx{last_id or 0}"
+        finally:
+            session.close()
+
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def get_account_updates_since(self, version, exclude_versions=()):
+        """Возвращает счета, изменившиеся после версии version, или None, если изменений нет
+        
+        exclude_versions - id транзакций, которые не учитываются (записи самого процесса,
+        уже разосланные писателем).
+        """
+        try:
+            session = create_session()
+            new_version = session.query(func.max(Transaction.id)).scalar() or 0
             
-            return accounts_details
+            if new_version <= version:
+                return None
             
-        except Exception as e:
-            print(f"❌ Ошибка получения деталей по счетам: {e}")
-            return {}
+            changed = session.query(Transaction.account_id).filter(Transaction.id > version)
+            if exclude_versions:
+                changed = changed.filter(Transaction.id.notin_(list(exclude_versions)))
+            accounts = session.query(
+                Account.id, Account.name, Account.currency, Account.balance, Account.balance_usd, Account.last_updated
+            ).filter(Account.id.in_(changed)).all()
+            
+            # Запись пришла из другого процесса: наш снимок устарел
+            generation = self.invalidate_accounts_snapshot()
+            snapshot = self._build_accounts_snapshot(session)
+            self._store_accounts_snapshot(snapshot, generation)
+            
+            if not accounts:
+                return None
+            
+            return {
+                'type': 'accounts_update',
+                'version': new_version,
+                'accounts': [
+                    {
+                        'id': account.id,
+                        'name': account.name,
+                        'currency': account.currency,
+                        'balance': account.balance,
+                        'balance_usd': account.balance_usd,
+                        'last_updated': account.last_updated.isoformat() if account.last_updated else None
+                    }
+                    for account in accounts
+                ],
+                'total_balance_usd': round(snapshot['total_balance_usd'], 2)
+            }
         finally:
             session.close()
 
+    @timed(DB_METHOD_SECONDS, name_label='method')
     def get_accounts_for_api(self):
         """Получает список счетов для API"""
         try:
             session = create_session()
-            accounts = session.query(Account).all()
+            
+            # Дата последней транзакции каждого счета - одним запросом вместе со счетами
+            last_transactions = session.query(
+                Transaction.account_id, func.max(Transaction.timestamp).label('timestamp')
+            ).group_by(Transaction.account_id).subquery()
+            accounts = session.query(
+                Account.id, Account.name, Account.currency, Account.balance, Account.balance_usd,
+                func.coalesce(last_transactions.c.timestamp, Account.last_updated)
+            ).outerjoin(last_transactions, last_transactions.c.account_id == Account.id).all()
             
             accounts_data = []
             total_balance_usd = 0
             
-            for account in accounts:
-                # Получаем дату последней транзакции для этого счета
-                last_transaction = session.query(Transaction).filter_by(
-                    account_id=account.id
-                ).order_by(Transaction.timestamp.desc()).first()
-                
-                last_updated = last_transaction.timestamp if last_transaction else account.last_updated
-                
+            for account_id, name, currency, balance, balance_usd, last_updated in accounts:
                 accounts_data.append({
-                    'id': account.id,
-                    'name': account.name,
-                    'currency': account.currency,
-                    'balance': account.balance,
-                    'balance_usd': account.balance_usd,
+                    'id': account_id,
+                    'name': name,
+                    'currency': currency,
+                    'balance': balance,
+                    'balance_usd': balance_usd,
                     'last_updated': last_updated.isoformat() if last_updated else None
                 })
-                total_balance_usd += account.balance_usd
+                total_balance_usd += balance_usd
             
             return {
                 'success': True,
@@ -353,88 +781,118 @@ class FinanceTrackerCore:
         finally:
             session.close()
 
-    def get_balance_history(self):
-        """Получает историю общего баланса"""
+    def history_start(self):
+        """Начало окна истории баланса (полночь UTC) или None, если окно не ограничено"""
+        if self.history_days <= 0:
+            return None
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        return today - timedelta(days=self.history_days)
+
+    def balance_history_version(self):
+        """Версия данных истории общего баланса: транзакции и их сжатие + снимок курсов (+ начало окна истории)"""
+        version = f"{self.get_history_version()}-fx{get_exchange_rates_version()}"
+        start = self.history_start()
+        return f"{version}-d{start:%Y%m%d}" if start else version
+
+    def get_balance_history(self, version=None):
+        """История общего баланса из общего кэша (по версии данных), иначе build_balance_history"""
+        version = version or self.balance_history_version()
+        return shared_cache.get_or_set(
+            f"balance_history:{version}", self.build_balance_history,
+            ttl=HISTORY_CACHE_TTL, store_if=lambda result: result['success']
+        )
+
+    @timed(DB_METHOD_SECONDS, name_label='method')
+    def build_balance_history(self):
+        """Строит историю общего баланса
+        
+        Один проход по транзакциям (только нужные колонки, по времени): на конец
+        каждого дня общий баланс - сумма последних известных балансов счетов в USD.
+        С окном HISTORY_DAYS читаются только транзакции окна; балансы счетов на его
+        начало - old_balance первой транзакции счета в окне, а у счетов без
+        транзакций в окне - текущий баланс.
+        """
         try:
             session = create_session()
+            start = self.history_start()
+            
+            transactions = session.query(
+                Transaction.timestamp, Transaction.account_id, Transaction.new_balance, Account.currency
+            ).join(Account).order_by(Transaction.timestamp, Transaction.id)
+            
+            # Последний известный баланс каждого счета в USD
+            balances_usd = {}
+            if start is not None:
+                transactions = transactions.filter(Transaction.timestamp >= start)
+                first_in_window = session.query(Transaction.old_balance).filter(
+                    Transaction.account_id == Account.id, Transaction.timestamp >= start
+                ).order_by(Transaction.timestamp, Transaction.id).limit(1).correlate(Account).scalar_subquery()
+                for account_id, balance, currency in session.query(
+                    Account.id, func.coalesce(first_in_window, Account.balance), Account.currency
+                ):
+                    balances_usd[account_id] = convert_to_usd(balance, currency)
+            
+            balance_history = []
+            # Балансы, изменившиеся за текущий день: (баланс, валюта)
+            day_balances = {}
+            current_day = None
+            
+            def close_day():
+                for account_id, (balance, currency) in day_balances.items():
+                    balances_usd[account_id] = convert_to_usd(balance, currency)
+                day_balances.clear()
+                # Порядок суммирования как у запроса счетов - по id
+                total_usd = sum(balances_usd[account_id] for account_id in sorted(balances_usd))
+                balance_history.append({'date': current_day.strftime('%Y-%m-%d'), 'balance': round(total_usd, 2)})
+            
+            for timestamp, account_id, new_balance, currency in transactions:
+                day = timestamp.date()
+                if day != current_day:
+                    if current_day is not None:
+                        close_day()
+                    current_day = day
+                day_balances[account_id] = (new_balance, currency)
+            
+            if current_day is not None:
+                close_day()
+                return {
+                    'success': True,
+                    'history': balance_history
+                }
             
-            # Получаем все транзакции, отсортированные по времени
-            transactions = session.query(Transaction).join(Account).order_by(Transaction.timestamp).all()
-            
-            if not transactions:
-                # Если нет транзакций, возвращаем текущий общий баланс
-                accounts = session.query(Account).all()
-                total_balance_usd = sum(convert_to_usd(account.balance, account.currency) for account in accounts)
-                
-                if total_balance_usd > 0:
-                    # Возвращаем текущий баланс как одну точку
-                    today = datetime.utcnow().strftime('%Y-%m-%d')
-                    return {
-                        'success': True,
-                        'history': [{'date': today, 'balance': round(total_balance_usd, 2)}]
-                    }
-                else:
-                    return {
-                        'success': True,
-                        'history': []
-                    }
-            
-            # Создаем временную шкалу всех дат с транзакциями
-            all_dates = sorted(list(set(t.timestamp.strftime('%Y-%m-%d') for t in transactions)))
-            
-            # Для каждой даты считаем общий баланс всех счетов
-            balance_history = {}
-            
-            # Отслеживаем последний известный баланс каждого счета
-            last_known_balances = {}
-            
-            for date_str in all_dates:
-                # Получаем все транзакции на эту дату
-                date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-                start_of_day = date_obj.replace(hour=0, minute=0, second=0, microsecond=0)
-                end_of_day = date_obj.replace(hour=23, minute=59, second=59, microsecond=999999)
-                
-                # Получаем транзакции на эту дату
-                day_transactions = session.query(Transaction).filter(
-                    Transaction.timestamp >= start_of_day,
-                    Transaction.timestamp <= end_of_day
-                ).order_by(Transaction.timestamp).all()
-                
-                # Обновляем последние известные балансы для счетов с транзакциями на эту дату
-                for transaction in day_transactions:
-                    last_known_balances[transaction.account_id] = transaction.new_balance
-                
-                # Считаем общий баланс в USD на эту дату
-                total_usd = 0
-                for account in session.query(Account).all():
-                    # Используем последний известный баланс или 0, если транзакций не было
-                    balance = last_known_balances.get(account.id, 0)
-                    total_usd += convert_to_usd(balance, account.currency)
-                
-                balance_history[date_str] = round(total_usd, 2)
-            
-            # Преобразуем в список для графика
-            history_data = [
-                {'date': date, 'balance': balance} 
-                for date, balance in sorted(balance_history.items())
-            ]
+            # Если нет транзакций, возвращаем текущий общий баланс
+            total_balance_usd = session.query(func.coalesce(func.sum(Account.balance_usd), 0.0)).scalar()
             
-            return {
-                'success': True,
-                'history': history_data
-            }
+            if total_balance_usd > 0:
+                # Возвращаем текущий баланс как одну точку
+                today = datetime.utcnow().strftime('%Y-%m-%d')
+                return {
+                    'success': True,
+                    'history': [{'date': today, 'balance': round(total_balance_usd, 2)}]
+                }
+            else:
+                return {
+                    'success': True,
+                    'history': []
+                }
             
         except Exception as e:
             return {'success': False, 'error': str(e)}
         finally:
             session.close()
 
-    def create_total_balance_history_chart(self):
-        """Создаем график общей динамики всех счетов в USD"""
+    @timed(CHART_RENDER_SECONDS, chart='total_history')
+    def create_total_balance_history_chart(self, image_format='png', width=None, height=None, dpi=150):
+        """Создаем график общей динамики всех счетов в USD
+
+        image_format - png, svg или webp; width и height - размер в пикселях.
+        Без размера строится прежний график 12x8 дюймов с обрезкой полей (bbox tight).
+        """
         try:
-            import matplotlib.pyplot as plt
+            # Figure без pyplot: не трогает глобальное состояние и безопасна в потоках
+            from matplotlib.figure import Figure
             import matplotlib.dates as mdates
-            import io
+            from matplotlib import rc_context
             
             # Используем ту же логику, что и get_balance_history
             history_result = self.get_balance_history()
@@ -452,48 +910,84 @@ class FinanceTrackerCore:
             dates = [datetime.strptime(item['date'], '%Y-%m-%d') for item in history_data]
             balances = [item['balance'] for item in history_data]
             
-            fig, ax = plt.subplots(figsize=(12, 8))
+            sized = width is not None and height is not None
+            figsize = (width / dpi, height / dpi) if sized else (12, 8)
+            # Мелкие картинки: шрифты и маркеры уменьшаем вместе с размером
+            scale = min(1.0, figsize[0] / 12)
+            
+            fig = Figure(figsize=figsize, dpi=dpi)
+            ax = fig.subplots()
             
             # График общей динамики
-            ax.plot(dates, balances, 'o-', linewidth=2, markersize=6, color='#36A2EB')
+            ax.plot(dates, balances, 'o-', linewidth=2 * scale, markersize=6 * scale, color='#36A2EB')
             ax.fill_between(dates, balances, alpha=0.3, color='#36A2EB')
             
-            ax.set_title('Динамика общего баланса (все счета)', fontsize=16, fontweight='bold')
-            ax.set_ylabel('Общий баланс (USD)', fontsize=12)
-            ax.set_xlabel('Дата', fontsize=12)
+            ax.set_title('Динамика общего баланса (все счета)', fontsize=max(8, 16 * scale), fontweight='bold')
+            ax.set_ylabel('Общий баланс (USD)', fontsize=max(7, 12 * scale))
+            ax.set_xlabel('Дата', fontsize=max(7, 12 * scale))
+            ax.tick_params(labelsize=max(6, 10 * scale))
             ax.grid(True, alpha=0.3)
             
-            # Форматирование дат
+            # Форматирование дат; на длинной истории подпись не у каждого дня
             ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
-            ax.xaxis.set_major_locator(mdates.DayLocator(interval=1))
-            plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
+            if sized:
+                ax.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=max(3, int(width / 60))))
+            else:
+                ax.xaxis.set_major_locator(mdates.DayLocator(interval=1))
+            ax.tick_params(axis='x', labelrotation=45)
             
             # Получаем текущий общий баланс
             current_total = balances[-1] if balances else 0
             
             ax.text(0.02, 0.98, f'Текущий баланс: ${current_total:,.2f}', 
-                   transform=ax.transAxes, fontsize=12, fontweight='bold',
+                   transform=ax.transAxes, fontsize=max(7, 12 * scale), fontweight='bold',
                    bbox=dict(boxstyle="round,pad=0.3", facecolor="lightblue", alpha=0.7),
                    verticalalignment='top')
             
-            plt.tight_layout()
+            fig.tight_layout()
             
-            # Сохраняем в байты
+            # Сохраняем в байты; в SVG текст остается текстом, а не кривыми глифов
             img_buffer = io.BytesIO()
-            plt.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
+            save_kwargs = {'format': image_format, 'dpi': dpi}
+            if not sized:
+                save_kwargs['bbox_inches'] = 'tight'
+            if image_format == 'webp':
+                save_kwargs['pil_kwargs'] = {'quality': 80, 'method': 4}
+            with rc_context({'svg.fonttype': 'none', 'svg.hashsalt': 'finance-tracker'}):
+                fig.savefig(img_buffer, **save_kwargs)
             img_buffer.seek(0)
-            plt.close(fig)
             
             return img_buffer
             
         except Exception as e:
             print(f"❌ Ошибка создания графика общей динамики: {e}")
-            # Закрываем фигуру в случае ошибки
-            try:
-                plt.close('all')
-            except:
-                pass
             return None
 
+    def get_balance_sparkline(self, points=None):
+        """Данные для спарклайна общего баланса: только значения, без рендеринга
+
+        points ограничивает число точек (берутся равномерно, последняя точка сохраняется).
+        """
+        history_result = self.get_balance_history()
+        if not history_result['success']:
+            return history_result
+        
+        history_data = history_result['history']
+        if points and len(history_data) > points:
+            step = (len(history_data) - 1) / (points - 1) if points > 1 else 0
+            indexes = sorted({round(i * step) for i in range(points)} | {len(history_data) - 1})
+            history_data = [history_data[i] for i in indexes]
+        
+        values = [item['balance'] for item in history_data]
+        return {
+            'success': True,
+            'start': history_data[0]['date'] if history_data else None,
+            'end': history_data[-1]['date'] if history_data else None,
+            'min': min(values) if values else None,
+            'max': max(values) if values else None,
+            'current': values[-1] if values else None,
+            'values': values
+        }
+
 # Создаем глобальный экземпляр
 finance_tracker_core = FinanceTrackerCore() 
\ No newline at end of file
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Push-события об изменении счетов (Server-Sent Events) для Finance Tracker
+
+Записи других процессов (бот, другие воркеры uvicorn) приходят через
+ChangeListener: на PostgreSQL - LISTEN на канале NOTIFY, который
+update_account_balance_from_image отправляет при коммите, на SQLite - опрос
+строки версии в system_info.
+"""
+
+import asyncio
+import collections
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+# Как часто (сек) опрашивать строку версии изменений, если БД не PostgreSQL
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', '2'))
+# Сколько (сек) слушать канал без уведомлений, прежде чем проверить соединение запросом
+CHANGES_KEEPALIVE_INTERVAL = 60
+# Пауза перед переподключением слушателя после ошибки
+CHANGES_RETRY_INTERVAL = 5
+# Интервал комментария-пинга, чтобы прокси не закрывали соединение
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', '15'))
+# Максимум неотправленных событий на подписчика; лишние отбрасываются
+SSE_QUEUE_SIZE = 100
+# Сколько последних версий (id транзакций), записанных самим процессом, помнит слушатель
+OWN_VERSIONS_KEPT = 1000
+
+def format_sse(event):
+    """Форматирует событие в кадр text/event-stream"""
+    payload = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+    return f"event: {event.get('type', 'message')}\ndata: {payload}\n\n".encode('utf-8')
+
+class AsyncSubscription:
+    """Подписка для корутин: события доставляются в asyncio.Queue своего цикла"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+
+    def put(self, event):
+        self.loop.call_soon_threadsafe(self._put_nowait, event)
+
+    def _put_nowait(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self):
+        return await self.queue.get()
+
+class ThreadSubscription:
+    """Подписка для потоков (WSGI-генераторов): события в queue.Queue"""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            pass
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+class ChangeListener:
+    """Слушает изменения данных, сделанные другими процессами, и вызывает колбэки
+
+    Колбэк получает dict изменения: version - id последней транзакции, since -
+    версия, после которой изменения могли быть (если известна), или пустой dict,
+    если пропущенные изменения неизвестны (переподключение к БД). Колбэки
+    вызываются в потоке слушателя (один на процесс). Записи самого процесса
+    не раздаются: их подписчикам уже отправил писатель (core), он же отмечает
+    их версии через mark_own.
+    """
+
+    def __init__(self):
+        self._callbacks = []
+        self._thread = None
+        self._lock = threading.Lock()
+        self._own_versions = collections.deque(maxlen=OWN_VERSIONS_KEPT)
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def mark_own(self, version):
+        """Запоминает версию, записанную этим процессом (после коммита)"""
+        self._own_versions.append(version)
+
+    def own_versions(self, since=None):
+        """Версии этого процесса новее since"""
+        return {version for version in list(self._own_versions) if since is None or version > since}
+
+    def _only_own(self, since, version):
+        """True, если все версии из (since, version] записал этот процесс"""
+        if since is None or version - since > OWN_VERSIONS_KEPT:
+            return False
+        own = self.own_versions(since)
+        return all(candidate in own for candidate in range(since + 1, version + 1))
+
+    def start(self):
+        """Запускает слушателя (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='ft-changes', daemon=True)
+            self._thread.start()
+
+    def _dispatch(self, change):
+        for callback in list(self._callbacks):
+            try:
+                callback(change)
+            except Exception as e:
+                print(f"⚠️ Ошибка обработки изменения {change}: {e}")
+
+    def _run(self):
+        from models import get_engine
+
+        while True:
+            try:
+                engine = get_engine()
+                if engine.dialect.name == 'postgresql':
+                    self._listen(engine)
+                else:
+                    self._poll()
+            except Exception as e:
+                print(f"⚠️ Слушатель изменений остановился: {e}, переподключаемся через {CHANGES_RETRY_INTERVAL} с")
+            time.sleep(CHANGES_RETRY_INTERVAL)
+
+    def _listen(self, engine):
+        """LISTEN на отдельном соединении (вне пула): уведомления приходят сразу после COMMIT"""
+        from models import CHANGES_CHANNEL
+
+        connection = engine.raw_connection()
+        connection.detach()
+        try:
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"LISTEN {CHANGES_CHANNEL}")
+            # Пока слушателя не было, уведомления терялись: считаем, что изменилось что угодно
+            self._dispatch({})
+
+            while True:
+                if not select.select([dbapi_connection], [], [], CHANGES_KEEPALIVE_INTERVAL)[0]:
+                    # Тишина: убеждаемся, что соединение живо (иначе ошибка и переподключение)
+                    cursor.execute("SELECT 1")
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    change = json.loads(dbapi_connection.notifies.pop(0).payload)
+                    if change.get('pid') != os.getpid():
+                        self._dispatch(change)
+        finally:
+            connection.close()
+
+    def _poll(self):
+        """Опрос строки changes_version: изменения между опросами склеиваются в одно
+
+        Строка хранит только последнее изменение, поэтому продвинувшаяся версия
+        раздается, даже если последней была своя запись: до нее могли быть чужие.
+        Свои версии отфильтрует читатель (EventBroker по own_versions); целиком
+        пропускается только опрос, все версии которого записал этот процесс.
+        """
+        from models import get_last_change
+
+        last_version = None
+        polled = False
+        while True:
+            change = get_last_change() or {}
+            version = change.get('version')
+            if not polled:
+                # Что изменилось до запуска слушателя, неизвестно (как при переподключении LISTEN)
+                self._dispatch({})
+            elif version is not None and version != last_version:
+                # Строки изменений еще не было - значит, изменения идут с самого начала
+                since = last_version if last_version is not None else 0
+                if not (change.get('pid') == os.getpid() and self._only_own(since, version)):
+                    self._dispatch({**change, 'since': since})
+            last_version, polled = version, True
+            time.sleep(CHANGES_POLL_INTERVAL)
+
+class EventBroker:
+    """Рассылает события об обновлении счетов всем подписчикам процесса"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._last_version = None
+        change_listener.add_callback(self._on_change)
+
+    def subscribe(self):
+        """Подписка из потока (генератор Flask-ответа)"""
+        return self._add(ThreadSubscription())
+
+    def subscribe_async(self, loop=None):
+        """Подписка из корутины (нативный ASGI-обработчик)"""
+        return self._add(AsyncSubscription(loop or asyncio.get_running_loop()))
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscribers_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event):
+        """Отправляет событие всем подписчикам; версии не старше уже отправленной пропускаются
+
+        Так запись, закоммиченная раньше, но дошедшая сюда позже, не затирает у
+        клиентов более новый баланс.
+        """
+        self._send(event, skip_stale=True)
+
+    def _send(self, event, skip_stale):
+        with self._lock:
+            version = event.get('version')
+            if version is not None:
+                if skip_stale and self._last_version is not None and version <= self._last_version:
+                    return
+                self._last_version = max(version, self._last_version or version)
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def _add(self, subscription):
+        with self._lock:
+            self._subscribers.add(subscription)
+        change_listener.start()
+        return subscription
+
+    def _on_change(self, change):
+        """Запись другого процесса: рассылает подписчикам изменившиеся счета
+
+        Читаются счета с транзакциями новее since, кроме транзакций самого процесса
+        (их подписчикам уже отправил писатель). Уведомление LISTEN - одна транзакция
+        (since = version - 1); после переподключения пропущенное неизвестно, и
+        чтение идет от последней отправленной версии.
+        """
+        if not self.subscribers_count():
+            # Без подписчиков БД не читаем
+            return
+
+        version = change.get('version')
+        since = change.get('since')
+        if since is None and version is not None:
+            since = version - 1
+        if since is None:
+            with self._lock:
+                since = self._last_version
+        if since is None or (version is not None and version <= since):
+            return
+
+        from core import finance_tracker_core
+        update = finance_tracker_core.get_account_updates_since(since, exclude_versions=change_listener.own_versions(since))
+        if update:
+            # Счета только что прочитаны из БД: их состояние не старше отправленного
+            self._send(update, skip_stale=False)
+
+# Слушатель изменений и брокер процесса
+change_listener = ChangeListener()
+event_broker = EventBroker()
@@ -0,0 +1,11 @@
+"""
+Настройки gunicorn (gunicorn читает этот файл из текущего каталога сам)
+"""
+
+def post_worker_init(worker):
+    """Как lifespan в asgi.py: каждый воркер слушает записи бота и других процессов
+    и следит, чтобы секции transactions на будущие месяцы были созданы"""
+    from events import change_listener
+    from partitions import start_partition_maintenance
+    change_listener.start()
+    start_partition_maintenance()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Служебные команды Finance Tracker
+
+    python manage.py partitions status
+    python manage.py partitions ensure [--months-ahead 3]
+    python manage.py partitions archive [--older-than-months 24] [--dir archive] [--dry-run]
+    python manage.py partitions restore archive/transactions_2023_01.csv.gz
+    python manage.py compact [--retention-days 30] [--batch-days 7] [--pause 0.5] [--dry-run]
+"""
+
+import argparse
+import sys
+
+def partitions_command(args):
+    import partitions
+    from models import get_engine
+
+    with get_engine().connect() as conn:
+        if not partitions.is_partitioned(conn):
+            print("ℹ️ Таблица transactions не секционирована (нужна PostgreSQL и миграция 005)")
+            sys.exit(1 if args.action == 'restore' else 0)
+        existing = partitions.list_partitions(conn)
+
+    if args.action == 'status':
+        for partition in existing:
+            period = f"{partition['start']:%Y-%m}" if partition['start'] else 'default'
+            print(f"{partition['name']:<28} {period:<8} ~{partition['rows']} строк")
+    elif args.action == 'ensure':
+        created = partitions.ensure_partitions(args.months_ahead)
+        if not created:
+            print("✅ Все нужные секции уже есть")
+    elif args.action == 'archive':
+        paths = partitions.archive_partitions(args.older_than_months, args.dir, args.dry_run)
+        if args.dry_run:
+            for path in paths:
+                print(f"📦 будет выгружено: {path}")
+        if not paths:
+            print("✅ Секций для архивации нет")
+    elif args.action == 'restore':
+        partitions.restore_partition(args.path)
+
+def compact_command(args):
+    from compaction import compact_history
+
+    totals = compact_history(args.retention_days, args.batch_days, args.pause, args.dry_run)
+    prefix = "🔎 Без записи: " if args.dry_run else "✅ "
+    print(f"{prefix}удалено {totals['rows_deleted']} и изменено {totals['rows_updated']} транзакций "
+          f"в {totals['days_compacted']} днях счетов, удалено текстов OCR: {totals['documents_deleted']}; "
+          f"история сжата до {totals['compacted_until']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Служебные команды Finance Tracker')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    partitions_parser = commands.add_parser('partitions', help='Помесячные секции таблицы transactions (PostgreSQL)')
+    actions = partitions_parser.add_subparsers(dest='action', required=True)
+    actions.add_parser('status', help='Список секций с оценкой числа строк')
+    ensure = actions.add_parser('ensure', help='Создать секции текущего и следующих месяцев')
+    ensure.add_argument('--months-ahead', type=int, help='Сколько будущих месяцев (по умолчанию PARTITION_MONTHS_AHEAD)')
+    archive = actions.add_parser('archive', help='Выгрузить старые секции в CSV.gz и удалить из БД')
+    archive.add_argument('--older-than-months', type=int, help='Возраст секций (по умолчанию ARCHIVE_AFTER_MONTHS)')
+    archive.add_argument('--dir', help='Каталог архивов (по умолчанию ARCHIVE_DIR)')
+    archive.add_argument('--dry-run', action='store_true', help='Только показать, что будет выгружено')
+    restore = actions.add_parser('restore', help='Вернуть секцию из архива')
+    restore.add_argument('path', help='Файл transactions_YYYY_MM.csv.gz')
+    partitions_parser.set_defaults(handler=partitions_command)
+
+    compact = commands.add_parser('compact', help='Сжать старую историю транзакций (одна запись на счет за день)')
+    compact.add_argument('--retention-days', type=int, help='Не трогать последние N дней (по умолчанию COMPACTION_RETENTION_DAYS)')
+    compact.add_argument('--batch-days', type=int, help='Дней в одной транзакции (по умолчанию COMPACTION_BATCH_DAYS)')
+    compact.add_argument('--pause', type=float, default=0.0, help='Пауза между пачками, сек')
+    compact.add_argument('--dry-run', action='store_true', help='Посчитать, но ничего не менять')
+    compact.set_defaults(handler=compact_command)
+
+    args = parser.parse_args()
+    try:
+        args.handler(args)
+    except Exception as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
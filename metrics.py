@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Метрики Finance Tracker в текстовом формате Prometheus
+
+Небольшая реализация счетчиков, gauge и гистограмм без внешних зависимостей.
+Значения живут в памяти процесса: при нескольких процессах (uvicorn --workers N)
+каждый отдает свои метрики, суммирует их Prometheus.
+"""
+
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограмм (сек)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Для микросекундных операций: регулярки, конвертация валют, пул соединений
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    """Базовая метрика: имя, описание, имена меток и значения по набору меток"""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        with _registry_lock:
+            if name in _registry:
+                raise ValueError(f'Метрика {name} уже зарегистрирована')
+            _registry[name] = self
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames) or any(name not in labels for name in self.labelnames):
+            raise ValueError(f'{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    """Текущее значение (глубина очереди, занятые слоты)"""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Histogram(Metric):
+    """Распределение длительностей по корзинам, плюс сумма и количество"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счетчики по корзинам (последняя - +Inf), сумма, количество
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self, **labels):
+        """(количество, сумма) наблюдений для набора меток"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return (state[2], state[1]) if state else (0, 0.0)
+
+    def _render_sample(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+def timed(histogram, name_label=None, **labels):
+    """Декоратор: время выполнения функции попадает в histogram
+
+    name_label - метка, в которую подставляется имя функции
+    (одна гистограмма на много методов, например DB_METHOD_SECONDS).
+    """
+    def decorator(func):
+        observed_labels = dict(labels)
+        if name_label:
+            observed_labels[name_label] = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **observed_labels)
+        return wrapper
+    return decorator
+
+def render_metrics():
+    """Все метрики процесса в текстовом формате Prometheus"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=None, addr='0.0.0.0'):
+    """HTTP-сервер /metrics в фоновом потоке для процессов без веб-сервера (бот)
+
+    Порт берется из METRICS_PORT; без него сервер не запускается.
+    """
+    port = port or os.environ.get('METRICS_PORT')
+    if not port:
+        return None
+
+    server = ThreadingHTTPServer((addr, int(port)), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='ft-metrics', daemon=True).start()
+    print(f"📊 Метрики доступны на :{port}/metrics")
+    return server
+
+# Метрики горячих путей (общие для веба, бота и воркера)
+VISION_OCR_SECONDS = Histogram(
+    'ft_vision_ocr_seconds', 'Распознавание скриншота в Google Vision'
+)
+BALANCE_EXTRACTION_SECONDS = Histogram(
+    'ft_balance_extraction_seconds', 'Поиск баланса в тексте регулярными выражениями', buckets=FAST_BUCKETS
+)
+DB_METHOD_SECONDS = Histogram(
+    'ft_db_method_seconds', 'Методы FinanceTrackerCore, работающие с БД', ['method']
+)
+CHART_RENDER_SECONDS = Histogram(
+    'ft_chart_render_seconds', 'Построение графика matplotlib', ['chart']
+)
+CURRENCY_CONVERSION_SECONDS = Histogram(
+    'ft_currency_conversion_seconds', 'Конвертация суммы в USD', buckets=FAST_BUCKETS
+)
+EXCHANGE_RATE_CACHE_TOTAL = Counter(
+    'ft_exchange_rate_cache_total', 'Обращения к кэшу курсов валют (hit/miss)', ['result']
+)
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    'ft_db_pool_checkout_seconds', 'Ожидание свободного соединения в пуле', buckets=FAST_BUCKETS
+)
+BALANCE_WRITES_COALESCED_TOTAL = Counter(
+    'ft_balance_writes_coalesced_total', 'Записи баланса, поглощенные более поздней записью той же валюты'
+)
+OCR_THROTTLED_TOTAL = Counter(
+    'ft_ocr_throttled_total', 'Отклоненные запросы распознавания: rate_limit - лимит клиента, busy - нет свободного слота', ['reason']
+)
@@ -76,8 +76,9 @@ def run_migrations_online() -> None:
     # Получаем URL из переменных окружения
     database_url = get_database_url()
     
-    # Обновляем конфигурацию
-    config.set_main_option("sqlalchemy.url", database_url)
+    # Обновляем конфигурацию; % в URL (экранированные пароли, host=%2Ftmp) для
+    # configparser - начало подстановки, его нужно удвоить
+    config.set_main_option("sqlalchemy.url", database_url.replace('%', '%%'))
     
     # Railway использует PostgreSQL, который может требовать SSL
     if database_url.startswith('postgresql://') and 'railway.app' in database_url:
@@ -86,7 +87,7 @@ def run_migrations_online() -> None:
             database_url += '?sslmode=require'
         else:
             database_url += '&sslmode=require'
-        config.set_main_option("sqlalchemy.url", database_url)
+        config.set_main_option("sqlalchemy.url", database_url.replace('%', '%%'))
     
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
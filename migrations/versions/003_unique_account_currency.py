@@ -0,0 +1,58 @@
+"""Unique account per currency
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '003'
+down_revision = '002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Гонка параллельных скриншотов могла создать несколько счетов одной валюты.
+    # Оставляем самый старый счет (на его id могут ссылаться клиенты), переносим
+    # на него транзакции дублей и последний известный баланс, дубли удаляем.
+    conn = op.get_bind()
+    duplicated = conn.execute(sa.text(
+        "SELECT currency FROM accounts GROUP BY currency HAVING COUNT(*) > 1"
+    )).scalars().all()
+
+    for currency in duplicated:
+        accounts = conn.execute(sa.text(
+            "SELECT id, balance, balance_usd, last_updated FROM accounts WHERE currency = :currency ORDER BY id"
+        ), {'currency': currency}).mappings().all()
+
+        keep = accounts[0]
+        latest = max(accounts, key=lambda account: (account['last_updated'] is not None, account['last_updated'], account['id']))
+        duplicate_ids = [account['id'] for account in accounts[1:]]
+
+        conn.execute(sa.text(
+            "UPDATE transactions SET account_id = :keep_id WHERE account_id IN :duplicate_ids"
+        ).bindparams(sa.bindparam('duplicate_ids', expanding=True)),
+            {'keep_id': keep['id'], 'duplicate_ids': duplicate_ids})
+        conn.execute(sa.text(
+            "UPDATE accounts SET balance = :balance, balance_usd = :balance_usd, last_updated = :last_updated WHERE id = :keep_id"
+        ), {
+            'balance': latest['balance'],
+            'balance_usd': latest['balance_usd'],
+            'last_updated': latest['last_updated'],
+            'keep_id': keep['id']
+        })
+        conn.execute(sa.text(
+            "DELETE FROM accounts WHERE id IN :duplicate_ids"
+        ).bindparams(sa.bindparam('duplicate_ids', expanding=True)), {'duplicate_ids': duplicate_ids})
+
+    op.create_index('uq_accounts_currency', 'accounts', ['currency'], unique=True)
+
+
+def downgrade() -> None:
+    # Слияние дублей необратимо; снимаем только ограничение
+    op.drop_index('uq_accounts_currency', table_name='accounts')
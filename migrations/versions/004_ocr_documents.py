@@ -0,0 +1,106 @@
+"""Move OCR text to ocr_documents
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+import hashlib
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '004'
+down_revision = '003'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade() -> None:
+    op.create_table('ocr_documents',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('codec', sa.String(length=10), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('content', sa.LargeBinary(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('uq_ocr_documents_sha256', 'ocr_documents', ['sha256'], unique=True)
+    op.add_column('transactions', sa.Column('ocr_document_id', sa.Integer(), nullable=True))
+
+    # Переносим тексты пачками по id; одинаковые тексты сжимаются и хранятся один раз.
+    # Сжатие здесь zlib (или без сжатия для коротких текстов): миграция
+    # не зависит от необязательного zstandard
+    conn = op.get_bind()
+    document_ids = {}
+    last_id = 0
+    while True:
+        rows = conn.execute(sa.text(
+            "SELECT id, original_text, timestamp FROM transactions "
+            "WHERE id > :last_id AND original_text IS NOT NULL AND original_text != '' "
+            "ORDER BY id LIMIT :limit"
+        ), {'last_id': last_id, 'limit': BATCH_SIZE}).all()
+        if not rows:
+            break
+
+        updates = []
+        for transaction_id, original_text, timestamp in rows:
+            raw = original_text.encode('utf-8')
+            sha256 = hashlib.sha256(raw).hexdigest()
+            if sha256 not in document_ids:
+                codec, content = 'zlib', zlib.compress(raw, 9)
+                if len(content) >= len(raw):
+                    codec, content = 'none', raw
+                document_ids[sha256] = conn.execute(sa.text(
+                    "INSERT INTO ocr_documents (sha256, codec, size, content, created_at) "
+                    "VALUES (:sha256, :codec, :size, :content, :created_at) RETURNING id"
+                ).bindparams(sa.bindparam('content', type_=sa.LargeBinary)), {
+                    'sha256': sha256,
+                    'codec': codec,
+                    'size': len(raw),
+                    'content': content,
+                    'created_at': timestamp
+                }).scalar_one()
+            updates.append({'id': transaction_id, 'document_id': document_ids[sha256]})
+
+        conn.execute(sa.text(
+            "UPDATE transactions SET ocr_document_id = :document_id WHERE id = :id"
+        ), updates)
+        last_id = rows[-1][0]
+
+    with op.batch_alter_table('transactions') as batch_op:
+        batch_op.create_foreign_key('fk_transactions_ocr_document_id', 'ocr_documents', ['ocr_document_id'], ['id'])
+        batch_op.drop_column('original_text')
+
+
+def downgrade() -> None:
+    op.add_column('transactions', sa.Column('original_text', sa.Text(), nullable=True))
+
+    conn = op.get_bind()
+    documents = conn.execute(sa.text(
+        "SELECT id, codec, content FROM ocr_documents WHERE id IN (SELECT ocr_document_id FROM transactions)"
+    )).all()
+    for document_id, codec, content in documents:
+        if codec == 'none':
+            original_text = bytes(content).decode('utf-8')
+        elif codec == 'zstd':
+            import zstandard
+            original_text = zstandard.ZstdDecompressor().decompress(content).decode('utf-8')
+        else:
+            original_text = zlib.decompress(content).decode('utf-8')
+        conn.execute(sa.text(
+            "UPDATE transactions SET original_text = :original_text WHERE ocr_document_id = :document_id"
+        ), {'original_text': original_text, 'document_id': document_id})
+
+    with op.batch_alter_table('transactions') as batch_op:
+        batch_op.drop_constraint('fk_transactions_ocr_document_id', type_='foreignkey')
+        batch_op.drop_column('ocr_document_id')
+
+    op.drop_index('uq_ocr_documents_sha256', table_name='ocr_documents')
+    op.drop_table('ocr_documents')
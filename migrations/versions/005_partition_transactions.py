@@ -0,0 +1,123 @@
+"""Monthly range partitions for transactions
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+# Сколько будущих месяцев создать сразу (дальше их создает partitions.ensure_partitions)
+MONTHS_AHEAD = 3
+
+COLUMNS = 'id, account_id, timestamp, old_balance, new_balance, change, source, ocr_document_id'
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    if conn.dialect.name != 'postgresql':
+        # Секционирование есть только в PostgreSQL; на SQLite - тот же NOT NULL для timestamp
+        # (модель его объявляет) и индекс для истории счета
+        op.execute("""
+            UPDATE transactions SET timestamp = COALESCE(
+                (SELECT MAX(p.timestamp) FROM transactions p WHERE p.id < transactions.id), CURRENT_TIMESTAMP
+            )
+            WHERE timestamp IS NULL
+        """)
+        # SQLite не меняет NOT NULL у колонки: batch пересоздает таблицу
+        with op.batch_alter_table('transactions') as batch_op:
+            batch_op.alter_column('timestamp', existing_type=sa.DateTime(), nullable=False)
+        op.create_index('ix_transactions_account_id_timestamp', 'transactions', ['account_id', 'timestamp'])
+        return
+
+    # Ключ секционирования должен входить в первичный ключ и не может быть NULL.
+    # Строкам без времени (ORM всегда его ставит) даем время предыдущей транзакции
+    op.execute("""
+        UPDATE transactions t SET timestamp = COALESCE(
+            (SELECT MAX(p.timestamp) FROM transactions p WHERE p.id < t.id), now()
+        )
+        WHERE t.timestamp IS NULL
+    """)
+
+    op.execute("ALTER TABLE transactions RENAME TO transactions_unpartitioned")
+    op.execute("ALTER TABLE transactions_unpartitioned RENAME CONSTRAINT transactions_pkey TO transactions_unpartitioned_pkey")
+
+    op.execute("""
+        CREATE TABLE transactions (
+            id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+            account_id INTEGER NOT NULL REFERENCES accounts (id),
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            old_balance DOUBLE PRECISION,
+            new_balance DOUBLE PRECISION,
+            change DOUBLE PRECISION,
+            source VARCHAR(50),
+            ocr_document_id INTEGER,
+            PRIMARY KEY (id, timestamp),
+            CONSTRAINT fk_transactions_ocr_document_id FOREIGN KEY (ocr_document_id) REFERENCES ocr_documents (id)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+    op.execute("CREATE INDEX ix_transactions_account_id_timestamp ON transactions (account_id, timestamp)")
+    op.execute("CREATE TABLE transactions_default PARTITION OF transactions DEFAULT")
+
+    first = conn.execute(sa.text("SELECT MIN(timestamp) FROM transactions_unpartitioned")).scalar()
+    now = datetime.utcnow()
+    month = datetime((first or now).year, (first or now).month, 1)
+    last = add_months(datetime(now.year, now.month, 1), MONTHS_AHEAD)
+    while month <= last:
+        end = add_months(month, 1)
+        op.execute(
+            f"CREATE TABLE transactions_{month:%Y_%m} PARTITION OF transactions "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        )
+        month = end
+
+    op.execute(f"INSERT INTO transactions ({COLUMNS}) SELECT {COLUMNS} FROM transactions_unpartitioned")
+    # Последовательность id переходит к новой таблице, иначе DROP удалит ее вместе со старой
+    op.execute("ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id")
+    op.execute("DROP TABLE transactions_unpartitioned")
+    op.execute("ANALYZE transactions")
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    if conn.dialect.name != 'postgresql':
+        op.drop_index('ix_transactions_account_id_timestamp', table_name='transactions')
+        with op.batch_alter_table('transactions') as batch_op:
+            batch_op.alter_column('timestamp', existing_type=sa.DateTime(), nullable=True)
+        return
+
+    # Секции, выгруженные в архив (manage.py partitions archive), сюда не возвращаются
+    op.execute("ALTER TABLE transactions RENAME TO transactions_partitioned")
+    op.execute("ALTER TABLE transactions_partitioned RENAME CONSTRAINT transactions_pkey TO transactions_partitioned_pkey")
+    op.execute("""
+        CREATE TABLE transactions (
+            id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+            account_id INTEGER NOT NULL REFERENCES accounts (id),
+            timestamp TIMESTAMP WITHOUT TIME ZONE,
+            old_balance DOUBLE PRECISION,
+            new_balance DOUBLE PRECISION,
+            change DOUBLE PRECISION,
+            source VARCHAR(50),
+            ocr_document_id INTEGER,
+            CONSTRAINT transactions_pkey PRIMARY KEY (id),
+            CONSTRAINT fk_transactions_ocr_document_id FOREIGN KEY (ocr_document_id) REFERENCES ocr_documents (id)
+        )
+    """)
+    op.execute(f"INSERT INTO transactions ({COLUMNS}) SELECT {COLUMNS} FROM transactions_partitioned")
+    op.execute("ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id")
+    op.execute("DROP TABLE transactions_partitioned CASCADE")
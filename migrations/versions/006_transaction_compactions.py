@@ -0,0 +1,37 @@
+"""Transaction compaction audit
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '006'
+down_revision = '005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('transaction_compactions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('rows_before', sa.Integer(), nullable=False),
+    sa.Column('rows_after', sa.Integer(), nullable=False),
+    sa.Column('old_balance', sa.Float(), nullable=True),
+    sa.Column('new_balance', sa.Float(), nullable=True),
+    sa.Column('first_transaction_id', sa.Integer(), nullable=False),
+    sa.Column('last_transaction_id', sa.Integer(), nullable=False),
+    sa.Column('compacted_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('transaction_compactions')
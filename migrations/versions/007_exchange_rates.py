@@ -0,0 +1,29 @@
+"""Exchange rates table for batch USD revaluation
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '007'
+down_revision = '006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('exchange_rates',
+    sa.Column('currency', sa.String(length=10), nullable=False),
+    sa.Column('usd_rate', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('currency')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('exchange_rates')
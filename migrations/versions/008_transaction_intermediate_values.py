@@ -0,0 +1,26 @@
+"""Intermediate values of coalesced balance writes
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '008'
+down_revision = '007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # На секционированной таблице PostgreSQL колонка добавляется во все секции
+    op.add_column('transactions', sa.Column('intermediate_values', sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('transactions') as batch_op:
+        batch_op.drop_column('intermediate_values')
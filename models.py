@@ -5,17 +5,36 @@ SQLAlchemy модели для Finance Tracker
 
 import os
 import sys
+import hashlib
+import threading
+import time
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, DateTime, Text, ForeignKey, LargeBinary, Index
+from sqlalchemy import func, insert, text, update
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+from metrics import timed, CURRENCY_CONVERSION_SECONDS, EXCHANGE_RATE_CACHE_TOTAL, DB_POOL_CHECKOUT_SECONDS
+from cache import shared_cache
 import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstandard необязателен: без него тексты OCR сжимаются zlib
+    zstandard = None
 
 # Кэш для курсов валют
 _exchange_rates_cache = {}
+_exchange_rates_version = None
 _cache_expiry = None
 _cache_duration = timedelta(hours=1)  # Обновляем курсы каждый час
+# Фоновое обновление курсов (get_cached_exchange_rates_version) - одно на процесс
+_rates_refresh_lock = threading.Lock()
+# Ключ курсов в общем кэше: процесс, первым сходивший в API, делится курсами с остальными
+RATES_CACHE_KEY = 'exchange_rates'
+_revaluation_listeners = []
 
 # Создаем базовый класс для моделей
 Base = declarative_base()
@@ -34,6 +53,11 @@ class Account(Base):
     # Связь с транзакциями
     transactions = relationship("Transaction", back_populates="account", cascade="all, delete-orphan")
     
+    # Один счет на валюту; индекс нужен и для INSERT ... ON CONFLICT (currency)
+    __table_args__ = (
+        Index('uq_accounts_currency', 'currency', unique=True),
+    )
+    
     def __repr__(self):
         return f"<Account(name='{self.name}', currency='{self.currency}', balance={self.balance})>"
 
@@ -41,21 +65,88 @@ class Transaction(Base):
     """Модель транзакции"""
     __tablename__ = 'transactions'
     
+    # В PostgreSQL таблица секционирована по месяцам timestamp (миграция 005, partitions.py),
+    # первичный ключ там (id, timestamp); id по-прежнему уникален благодаря последовательности
     id = Column(Integer, primary_key=True)
     account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, nullable=False, default=datetime.utcnow)
     old_balance = Column(Float, default=0.0)
     new_balance = Column(Float, default=0.0)
     change = Column(Float, default=0.0)
     source = Column(String(50), default='unknown')  # 'telegram', 'web', 'api'
-    original_text = Column(Text, nullable=True)
+    # Сырой текст OCR лежит в ocr_documents, чтобы не раздувать горячую таблицу
+    ocr_document_id = Column(Integer, ForeignKey('ocr_documents.id'), nullable=True)
+    # JSON-список промежуточных балансов, склеенных в эту запись (COALESCE_WINDOW_SECONDS)
+    intermediate_values = Column(Text, nullable=True)
     
     # Связь с аккаунтом
     account = relationship("Account", back_populates="transactions")
+    ocr_document = relationship("OcrDocument")
+    
+    __table_args__ = (
+        Index('ix_transactions_account_id_timestamp', 'account_id', 'timestamp'),
+    )
+    
+    @property
+    def original_text(self):
+        """Текст OCR скриншота (отдельный запрос к ocr_documents)"""
+        return self.ocr_document.text if self.ocr_document else None
     
     def __repr__(self):
         return f"<Transaction(account_id={self.account_id}, change={self.change}, source='{self.source}')>"
 
+class OcrDocument(Base):
+    """Сжатый текст OCR, один на уникальное содержимое (sha256)"""
+    __tablename__ = 'ocr_documents'
+    
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), nullable=False)
+    codec = Column(String(10), nullable=False)  # zlib, zstd, none
+    size = Column(Integer, nullable=False)  # длина исходного текста в байтах UTF-8
+    content = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Дедупликация по содержимому; индекс нужен и для INSERT ... ON CONFLICT (sha256)
+    __table_args__ = (
+        Index('uq_ocr_documents_sha256', 'sha256', unique=True),
+    )
+    
+    @property
+    def text(self):
+        return decode_ocr_text(self.codec, self.content)
+    
+    def __repr__(self):
+        return f"<OcrDocument(sha256='{self.sha256[:12]}', codec='{self.codec}', size={self.size})>"
+
+class TransactionCompaction(Base):
+    """Запись аудита сжатия истории: что стало с транзакциями счета за один день"""
+    __tablename__ = 'transaction_compactions'
+    
+    id = Column(Integer, primary_key=True)
+    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
+    day = Column(Date, nullable=False)
+    rows_before = Column(Integer, nullable=False)
+    rows_after = Column(Integer, nullable=False)  # 0 - день без изменений баланса удален целиком
+    old_balance = Column(Float, nullable=True)  # баланс на начало и конец дня
+    new_balance = Column(Float, nullable=True)
+    first_transaction_id = Column(Integer, nullable=False)
+    last_transaction_id = Column(Integer, nullable=False)
+    compacted_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<TransactionCompaction(account_id={self.account_id}, day={self.day}, rows={self.rows_before}->{self.rows_after})>"
+
+class ExchangeRate(Base):
+    """Последний известный курс валюты к USD; по этой таблице пересчитываются счета"""
+    __tablename__ = 'exchange_rates'
+    
+    currency = Column(String(10), primary_key=True)
+    usd_rate = Column(Float, nullable=False)  # сколько USD стоит единица валюты
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<ExchangeRate(currency='{self.currency}', usd_rate={self.usd_rate})>"
+
 class SystemInfo(Base):
     """Системная информация"""
     __tablename__ = 'system_info'
@@ -68,6 +159,32 @@ class SystemInfo(Base):
     def __repr__(self):
         return f"<SystemInfo(key='{self.key}', value='{self.value}')>"
 
+class IngestJob(Base):
+    """Задача очереди распознавания скриншотов"""
+    __tablename__ = 'ingest_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    status = Column(String(20), nullable=False, default='queued')  # queued, processing, done, failed, dead
+    source = Column(String(50), default='unknown')  # 'telegram', 'web'
+    # Скриншот (сотни КБ) грузится только по обращению: статус задачи его не читает
+    image = deferred(Column(LargeBinary, nullable=True))  # очищается после успешной обработки
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_after = Column(DateTime, default=datetime.utcnow)  # для отложенных повторов
+    locked_by = Column(String(100), nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    result = Column(Text, nullable=True)  # JSON результата распознавания
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_ingest_jobs_status_run_after', 'status', 'run_after'),
+    )
+    
+    def __repr__(self):
+        return f"<IngestJob(id={self.id}, status='{self.status}', attempts={self.attempts})>"
+
 # Функция для создания подключения к БД
 def get_database_url():
     """Получаем URL базы данных из переменных окружения Railway"""
@@ -80,10 +197,21 @@ def get_database_url():
     
     return database_url
 
+class TimedQueuePool(QueuePool):
+    """QueuePool, который измеряет ожидание свободного соединения"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
 # Создаем движок базы данных
 def create_database_engine():
     """Создаем движок SQLAlchemy"""
     database_url = get_database_url()
+    engine_options = {'echo': False}
     
     # Railway использует PostgreSQL, который может требовать SSL
     if database_url.startswith('postgresql://') and 'railway.app' in database_url:
@@ -93,23 +221,260 @@ def create_database_engine():
         else:
             database_url += '&sslmode=require'
     
-    engine = create_engine(database_url, echo=False)
+    if database_url.startswith('postgresql'):
+        # Размер пула на процесс: DB_POOL_SIZE + DB_MAX_OVERFLOW соединений
+        engine_options.update(
+            poolclass=TimedQueuePool,
+            pool_size=int(os.environ.get('DB_POOL_SIZE', '5')),
+            max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+            pool_pre_ping=True
+        )
+    elif database_url.startswith('sqlite') and ':memory:' not in database_url:
+        # Файловая SQLite и так использует QueuePool; подменяем на измеряемый
+        engine_options['poolclass'] = TimedQueuePool
+    
+    engine = create_engine(database_url, **engine_options)
     return engine
 
+# Движок и фабрика сессий создаются один раз на процесс
+_engine = None
+_session_factory = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Возвращает общий для процесса движок (с пулом соединений)"""
+    global _engine, _session_factory
+    
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_database_engine()
+                _session_factory = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
+    
+    return _engine
+
 # Создаем сессию
 def create_session():
     """Создаем сессию базы данных"""
-    engine = create_database_engine()
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    return SessionLocal()
+    get_engine()
+    return _session_factory()
 
 # Функция для создания всех таблиц
 def create_tables():
     """Создаем все таблицы в базе данных"""
-    engine = create_database_engine()
+    engine = get_engine()
     Base.metadata.create_all(bind=engine)
     print("✅ Таблицы базы данных созданы")
 
+# Уровни сжатия текстов OCR: тексты короткие, пишутся редко, читаются еще реже
+OCR_ZLIB_LEVEL = 9
+OCR_ZSTD_LEVEL = 10
+
+def encode_ocr_text(text):
+    """Готовит текст OCR к записи в ocr_documents: dict(sha256, codec, size, content) или None"""
+    if not text:
+        return None
+    raw = text.encode('utf-8')
+    if zstandard is not None:
+        codec, content = 'zstd', zstandard.ZstdCompressor(level=OCR_ZSTD_LEVEL).compress(raw)
+    else:
+        codec, content = 'zlib', zlib.compress(raw, OCR_ZLIB_LEVEL)
+    if len(content) >= len(raw):
+        # Короткие тексты сжатие только удлиняет
+        codec, content = 'none', raw
+    return {
+        'sha256': hashlib.sha256(raw).hexdigest(),
+        'codec': codec,
+        'size': len(raw),
+        'content': content
+    }
+
+def decode_ocr_text(codec, content):
+    """Распаковывает текст OCR, записанный encode_ocr_text"""
+    if codec == 'none':
+        return content.decode('utf-8')
+    if codec == 'zlib':
+        return zlib.decompress(content).decode('utf-8')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Текст OCR сжат zstd, а пакет zstandard не установлен")
+        return zstandard.ZstdDecompressor().decompress(content).decode('utf-8')
+    raise ValueError(f"Неизвестный кодек текста OCR: {codec}")
+
+def store_ocr_document(session, text, now=None):
+    """Записывает текст OCR (или находит такой же по sha256); возвращает id документа или None
+
+    ON CONFLICT DO UPDATE вместо DO NOTHING: RETURNING отдает id и тогда,
+    когда такой же текст только что записал параллельный запрос.
+    """
+    document = encode_ocr_text(text)
+    if document is None:
+        return None
+    
+    if session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    
+    documents = OcrDocument.__table__
+    statement = dialect_insert(documents).values(created_at=now or datetime.utcnow(), **document)
+    statement = statement.on_conflict_do_update(
+        index_elements=['sha256'],
+        set_={'sha256': statement.excluded.sha256}
+    ).returning(documents.c.id)
+    return session.execute(statement).scalar_one()
+
+# Запись баланса за один запрос к PostgreSQL:
+# old блокирует строку счета (FOR UPDATE) и выполняется до вставки (подзапрос в WHERE),
+# поэтому параллельные записи в одну валюту выстраиваются в очередь и видят баланс друг друга;
+# document дедуплицирует текст OCR по sha256 (при пустом тексте ничего не вставляет)
+_PG_UPSERT_BALANCE = text("""
+WITH old AS (
+    SELECT id, balance FROM accounts WHERE currency = :currency FOR UPDATE
+),
+upserted AS (
+    INSERT INTO accounts (name, currency, balance, balance_usd, last_updated)
+    SELECT :name, :currency, :balance, :balance_usd, :now
+    WHERE (SELECT count(*) FROM old) >= 0
+    ON CONFLICT (currency) DO UPDATE
+        SET balance = EXCLUDED.balance,
+            balance_usd = EXCLUDED.balance_usd,
+            last_updated = EXCLUDED.last_updated
+    RETURNING id, name, currency, balance, balance_usd, last_updated
+),
+document AS (
+    INSERT INTO ocr_documents (sha256, codec, size, content, created_at)
+    SELECT :document_sha256, :document_codec, :document_size, :document_content, :now
+    WHERE :document_sha256 IS NOT NULL
+    ON CONFLICT (sha256) DO UPDATE SET sha256 = EXCLUDED.sha256
+    RETURNING id
+),
+new_transaction AS (
+    INSERT INTO transactions (account_id, timestamp, old_balance, new_balance, change, source, ocr_document_id,
+                              intermediate_values)
+    SELECT upserted.id, :now, COALESCE(old.balance, 0), upserted.balance,
+           upserted.balance - COALESCE(old.balance, 0), :source, (SELECT id FROM document),
+           :intermediate_values
+    FROM upserted LEFT JOIN old ON old.id = upserted.id
+    RETURNING id, old_balance
+)
+SELECT upserted.id, upserted.name, upserted.currency, upserted.balance, upserted.balance_usd,
+       upserted.last_updated, new_transaction.id AS transaction_id, new_transaction.old_balance
+FROM upserted, new_transaction
+""")
+
+def upsert_account_balance(session, currency, name, balance, balance_usd, source, original_text, now=None,
+                           intermediate_values=None):
+    """Создает или обновляет счет валюты и записывает транзакцию
+
+    PostgreSQL - один запрос (CTE с INSERT ... ON CONFLICT DO UPDATE ... RETURNING).
+    SQLite не поддерживает INSERT внутри WITH: там отдельные запросы в одной транзакции.
+    На обеих БД прежний баланс - accounts.balance до обновления, прочитанный под
+    блокировкой записи (FOR UPDATE в PostgreSQL, пустой UPDATE в SQLite).
+    Текст OCR сжимается и дедуплицируется в ocr_documents, в транзакции - только ссылка.
+    intermediate_values - балансы, которые эта запись поглотила (склейка частых записей).
+    Коммит - на вызывающем. Возвращает dict счета с transaction_id и old_balance.
+    """
+    now = now or datetime.utcnow()
+    intermediate_values = json.dumps(intermediate_values) if intermediate_values else None
+    
+    if session.get_bind().dialect.name == 'postgresql':
+        document = encode_ocr_text(original_text) or {}
+        params = {
+            'currency': currency,
+            'name': name,
+            'balance': balance,
+            'balance_usd': balance_usd,
+            'now': now,
+            'source': source,
+            'intermediate_values': intermediate_values,
+            'document_sha256': document.get('sha256'),
+            'document_codec': document.get('codec'),
+            'document_size': document.get('size'),
+            'document_content': document.get('content')
+        }
+        return _normalize_balances(dict(session.execute(_PG_UPSERT_BALANCE, params).mappings().one()))
+    
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+    
+    accounts = Account.__table__
+    # В SQLite нет SELECT ... FOR UPDATE: UPDATE без изменений сразу берет блокировку
+    # записи БД и отдает баланс до обновления, параллельная запись ждет нашего коммита
+    locked = session.execute(
+        update(accounts).where(accounts.c.currency == currency)
+        .values(balance=accounts.c.balance).returning(accounts.c.balance)
+    ).first()
+    old_balance = locked.balance if locked and locked.balance is not None else 0.0
+    
+    upsert = sqlite_insert(accounts).values(
+        name=name, currency=currency, balance=balance, balance_usd=balance_usd, last_updated=now
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements=['currency'],
+        set_={
+            'balance': upsert.excluded.balance,
+            'balance_usd': upsert.excluded.balance_usd,
+            'last_updated': upsert.excluded.last_updated
+        }
+    ).returning(
+        accounts.c.id, accounts.c.name, accounts.c.currency,
+        accounts.c.balance, accounts.c.balance_usd, accounts.c.last_updated
+    )
+    account = dict(session.execute(upsert).mappings().one())
+    document_id = store_ocr_document(session, original_text, now)
+    
+    transactions = Transaction.__table__
+    new_transaction = insert(transactions).values(
+        account_id=account['id'], timestamp=now, old_balance=old_balance, new_balance=balance,
+        change=balance - old_balance, source=source, ocr_document_id=document_id,
+        intermediate_values=intermediate_values
+    ).returning(transactions.c.id)
+    
+    account['transaction_id'] = session.execute(new_transaction).scalar_one()
+    account['old_balance'] = old_balance
+    return _normalize_balances(account)
+
+def _normalize_balances(account):
+    # SQLite в RETURNING отдает целые суммы как int; наружу всегда float
+    for key in ('balance', 'balance_usd', 'old_balance'):
+        account[key] = float(account[key])
+    return account
+
+# Канал LISTEN/NOTIFY об изменениях счетов (PostgreSQL). На других БД вместо него -
+# строка версии в system_info, которую опрашивают другие процессы (events.ChangeListener)
+CHANGES_CHANNEL = 'ft_changes'
+CHANGES_VERSION_KEY = 'changes_version'
+
+def notify_change(session, change):
+    """Сообщает другим процессам об изменении данных при коммите сессии
+
+    change - dict, обязательно с version (id транзакции); к нему добавляется pid
+    процесса-автора. На PostgreSQL - pg_notify: слушатели получат его только после
+    COMMIT, а при откате не получат вовсе. На SQLite change записывается в строку
+    changes_version той же транзакцией. Коммит - на вызывающем.
+    """
+    payload = json.dumps({**change, 'pid': os.getpid()}, separators=(',', ':'), default=str)
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': CHANGES_CHANNEL, 'payload': payload})
+        return
+    
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+    
+    upsert = sqlite_insert(SystemInfo).values(key=CHANGES_VERSION_KEY, value=payload, updated_at=datetime.utcnow())
+    session.execute(upsert.on_conflict_do_update(
+        index_elements=['key'],
+        set_={'value': upsert.excluded.value, 'updated_at': upsert.excluded.updated_at}
+    ))
+
+def get_last_change():
+    """Последнее изменение из строки changes_version (dict) или None"""
+    session = create_session()
+    try:
+        value = session.query(SystemInfo.value).filter_by(key=CHANGES_VERSION_KEY).scalar()
+        return json.loads(value) if value else None
+    finally:
+        session.close()
+
 # Функция для миграции данных из JSON
 def migrate_from_json(json_file_path='finance_data.json'):
     """Мигрируем данные из старого JSON файла"""
@@ -153,7 +518,7 @@ def migrate_from_json(json_file_path='finance_data.json'):
                                 new_balance=tx_data.get('new_balance', 0),
                                 change=tx_data.get('change', 0),
                                 source=tx_data.get('source', 'migration'),
-                                original_text=tx_data.get('original_text', '')
+                                ocr_document_id=store_ocr_document(session, tx_data.get('original_text'))
                             )
                             session.add(new_transaction)
         
@@ -175,6 +540,7 @@ def migrate_from_json(json_file_path='finance_data.json'):
         session.close()
 
 # Функция для конвертации валют в USD (с актуальными курсами)
+@timed(CURRENCY_CONVERSION_SECONDS)
 def convert_to_usd(amount, currency):
     """
     Конвертирует сумму из указанной валюты в USD
@@ -187,8 +553,11 @@ def convert_to_usd(amount, currency):
     if _is_cache_valid():
         rate = _exchange_rates_cache.get(currency.upper())
         if rate is not None:
+            EXCHANGE_RATE_CACHE_TOTAL.inc(result='hit')
             return amount * rate
     
+    EXCHANGE_RATE_CACHE_TOTAL.inc(result='miss')
+    
     # Получаем свежие курсы
     try:
         _update_exchange_rates_cache()
@@ -207,9 +576,31 @@ def _is_cache_valid():
     global _cache_expiry
     return _cache_expiry and datetime.utcnow() < _cache_expiry
 
-def _update_exchange_rates_cache():
-    """Обновляет кэш курсов валют через API"""
-    global _exchange_rates_cache, _cache_expiry
+def _rates_version(rates):
+    """Идентификатор снимка курсов: одинаковый для одинаковых курсов в любом процессе"""
+    payload = json.dumps(sorted(rates.items()), separators=(',', ':'))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+def _load_shared_rates():
+    """Берет курсы из общего кэша, если их недавно получил другой процесс; True - взяли"""
+    global _exchange_rates_cache, _exchange_rates_version, _cache_expiry
+    shared = shared_cache.get(RATES_CACHE_KEY)
+    if shared is None or shared['expires_at'] <= time.time():
+        return False
+    
+    _exchange_rates_cache = dict(shared['rates'])
+    _exchange_rates_version = _rates_version(_exchange_rates_cache)
+    _cache_expiry = datetime.utcfromtimestamp(shared['expires_at'])
+    return True
+
+def _update_exchange_rates_cache(force=False):
+    """Обновляет кэш курсов валют: из общего кэша, а если там нет (или force) - через API"""
+    global _exchange_rates_cache, _exchange_rates_version, _cache_expiry
+    previous_version = _exchange_rates_version
+    
+    if not force and _load_shared_rates():
+        _after_rates_refresh(previous_version)
+        return
     
     try:
         import requests
@@ -225,9 +616,15 @@ def _update_exchange_rates_cache():
             # Сохраняем курсы в кэш (инвертируем, так как API возвращает USD к валюте)
             _exchange_rates_cache = {currency: 1/rate for currency, rate in rates.items()}
             _exchange_rates_cache['USD'] = 1.0  # USD всегда 1.0
+            _exchange_rates_version = _rates_version(_exchange_rates_cache)
             
             # Устанавливаем время истечения кэша
             _cache_expiry = datetime.utcnow() + _cache_duration
+            # Фиксированные курсы ниже в общий кэш не попадают: другие процессы сходят в API сами
+            shared_cache.set(RATES_CACHE_KEY, {
+                'rates': dict(_exchange_rates_cache),
+                'expires_at': time.time() + _cache_duration.total_seconds()
+            }, ttl=_cache_duration.total_seconds())
             
             print("✅ Курсы валют обновлены")
         else:
@@ -238,7 +635,85 @@ def _update_exchange_rates_cache():
         print(f"⚠️ Ошибка обновления курсов валют: {e}")
         # Если не удалось обновить, используем фиксированные курсы
         _exchange_rates_cache = _get_fixed_rates()
+        _exchange_rates_version = _rates_version(_exchange_rates_cache)
         _cache_expiry = datetime.utcnow() + timedelta(minutes=30)  # Короткий кэш для фиксированных курсов
+        # Приблизительными курсами счета не пересчитываем: в exchange_rates остаются последние настоящие
+        return
+    
+    _after_rates_refresh(previous_version)
+
+def _after_rates_refresh(previous_version):
+    """После обновления курсов пересчитывает счета в фоне, если курсы изменились
+
+    В фоне, а не на месте: курсы обновляются внутри convert_to_usd, то есть
+    посреди чужих запросов, и запись в БД там могла бы ждать собственное чтение.
+    """
+    if _exchange_rates_version == previous_version:
+        return
+    rates = dict(_exchange_rates_cache)
+    threading.Thread(target=_revalue_in_background, args=(rates,), name='ft-revalue', daemon=True).start()
+
+def _revalue_in_background(rates):
+    try:
+        revalued = revalue_accounts(rates)
+        print(f"💱 Балансы в USD пересчитаны по новым курсам: {revalued} счетов")
+    except Exception as e:
+        print(f"⚠️ Ошибка пересчета балансов в USD: {e}")
+        return
+    for listener in list(_revaluation_listeners):
+        listener()
+
+def revalue_accounts(rates, now=None):
+    """Сохраняет курсы в exchange_rates и пересчитывает balance_usd всех счетов
+    одним UPDATE accounts ... FROM exchange_rates; возвращает число счетов"""
+    now = now or datetime.utcnow()
+    session = create_session()
+    try:
+        if session.get_bind().dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        
+        upsert = dialect_insert(ExchangeRate)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=['currency'],
+            set_={'usd_rate': upsert.excluded.usd_rate, 'updated_at': upsert.excluded.updated_at}
+        )
+        session.execute(upsert, [
+            {'currency': currency, 'usd_rate': rate, 'updated_at': now}
+            for currency, rate in rates.items()
+        ])
+        
+        revalued = session.execute(
+            update(Account)
+            .where(Account.currency == ExchangeRate.currency)
+            .values(balance_usd=Account.balance * ExchangeRate.usd_rate),
+            execution_options={'synchronize_session': False}
+        ).rowcount
+        session.commit()
+        return revalued
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def add_revaluation_listener(callback):
+    """callback() вызывается после каждого пересчета balance_usd (например, сброс кэшей)"""
+    _revaluation_listeners.append(callback)
+
+def get_revaluation_version():
+    """Версия последнего пересчета balance_usd (для ETag) или None, если пересчетов не было
+
+    Берется из БД (время последней записи exchange_rates), а не из памяти процесса:
+    пересчет мог сделать другой воркер, и ETag должен быть одинаковым во всех процессах.
+    """
+    session = create_session()
+    try:
+        updated_at = session.query(func.max(ExchangeRate.updated_at)).scalar()
+    finally:
+        session.close()
+    return updated_at.strftime('%Y%m%d%H%M%S%f') if updated_at else None
 
 def _get_fixed_rates():
     """Возвращает фиксированные курсы валют"""
@@ -265,7 +740,7 @@ def force_update_exchange_rates():
     Возвращает True если успешно, False если ошибка
     """
     try:
-        _update_exchange_rates_cache()
+        _update_exchange_rates_cache(force=True)
         return True
     except Exception as e:
         print(f"❌ Ошибка принудительного обновления курсов: {e}")
@@ -280,6 +755,44 @@ def get_current_exchange_rates():
     
     return _exchange_rates_cache.copy()
 
+def get_exchange_rates_version():
+    """
+    Возвращает идентификатор текущего снимка курсов валют (для ETag)
+    """
+    if not _is_cache_valid():
+        _update_exchange_rates_cache()
+    
+    return _exchange_rates_version
+
+def get_cached_exchange_rates_version():
+    """
+    Идентификатор снимка курсов без запроса к API (для ETag до выполнения запроса)
+    
+    Устаревший снимок заменяется курсами из общего кэша, если их уже обновил другой
+    процесс, иначе обновляется в фоне. None - процесс еще не загружал курсы.
+    """
+    if not _is_cache_valid():
+        previous_version = _exchange_rates_version
+        if _load_shared_rates():
+            _after_rates_refresh(previous_version)
+        else:
+            _refresh_rates_in_background()
+    
+    return _exchange_rates_version
+
+def _refresh_rates_in_background():
+    """Обновляет курсы через API в отдельном потоке; одновременно идет не больше одного обновления"""
+    if not _rates_refresh_lock.acquire(blocking=False):
+        return
+    
+    def refresh():
+        try:
+            _update_exchange_rates_cache(force=True)
+        finally:
+            _rates_refresh_lock.release()
+    
+    threading.Thread(target=refresh, name='ft-rates', daemon=True).start()
+
 if __name__ == '__main__':
     # Создаем таблицы и мигрируем данные
     create_tables()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Помесячные секции таблицы transactions (декларативное секционирование PostgreSQL)
+
+Миграция 005 превращает transactions в таблицу, секционированную по диапазонам
+timestamp: transactions_YYYY_MM на каждый месяц и transactions_default для строк
+вне созданных секций. Здесь:
+- ensure_partitions - создает секции текущего и PARTITION_MONTHS_AHEAD следующих
+  месяцев (start_partition_maintenance в вебе, боте и воркере вызывает ее
+  периодически, вручную - manage.py partitions ensure);
+- archive_partitions - отсоединяет старые секции, выгружает их в CSV.gz и удаляет;
+- restore_partition - возвращает секцию из архива.
+
+На SQLite и на несекционированной таблице все функции ничего не делают.
+"""
+
+import gzip
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import text
+from models import get_engine
+
+# Сколько будущих месяцев держать готовыми заранее
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', '3'))
+# Секции старше стольких месяцев уходят в архив
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', '24'))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+# Как часто процессы проверяют, что секции на будущие месяцы созданы
+PARTITION_CHECK_INTERVAL = float(os.environ.get('PARTITION_CHECK_INTERVAL', '3600'))
+
+PARENT_TABLE = 'transactions'
+DEFAULT_PARTITION = 'transactions_default'
+PARTITION_PATTERN = re.compile(r'^transactions_(\d{4})_(\d{2})$')
+# Ключ pg_advisory_xact_lock: секции меняет один процесс за раз
+PARTITION_LOCK_ID = 4402
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def partition_name(month):
+    return f"{PARENT_TABLE}_{month:%Y_%m}"
+
+def is_partitioned(conn):
+    """True, если transactions - секционированная таблица PostgreSQL"""
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.relname = :table AND pg_table_is_visible(c.oid)
+        )
+    """), {'table': PARENT_TABLE}).scalar()
+
+def list_partitions(conn):
+    """Секции transactions по возрастанию месяца: name, start, end (для default - None), rows (оценка)"""
+    rows = conn.execute(text("""
+        SELECT c.relname, c.reltuples
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table AND pg_table_is_visible(p.oid)
+    """), {'table': PARENT_TABLE}).all()
+
+    partitions = []
+    for name, rows_estimate in rows:
+        match = PARTITION_PATTERN.match(name)
+        start = datetime(int(match.group(1)), int(match.group(2)), 1) if match else None
+        partitions.append({
+            'name': name,
+            'start': start,
+            'end': add_months(start, 1) if start else None,
+            'rows': max(0, int(rows_estimate))
+        })
+    return sorted(partitions, key=lambda partition: (partition['start'] is None, partition['start']))
+
+def _lock(conn):
+    conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {'lock_id': PARTITION_LOCK_ID})
+
+def _create_partition(conn, month, load=None):
+    """Создает отдельную таблицу секции, заполняет ее и присоединяет к transactions
+
+    Строки этого месяца, уже попавшие в transactions_default, переносятся в новую
+    секцию: иначе ATTACH PARTITION откажет. load(conn, name) - дополнительная загрузка
+    строк (восстановление из архива).
+    """
+    name = partition_name(month)
+    start, end = month, add_months(month, 1)
+    # Имена и границы формируются здесь же из дат, пользовательского ввода в DDL нет
+    bounds = f"FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+
+    conn.execute(text(f'CREATE TABLE "{name}" (LIKE {PARENT_TABLE} INCLUDING DEFAULTS)'))
+    if load:
+        load(conn, name)
+    conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end RETURNING *
+        )
+        INSERT INTO "{name}" SELECT * FROM moved
+    """), {'start': start, 'end': end})
+    # CHECK с границами секции позволяет ATTACH не сканировать таблицу повторно
+    conn.execute(text(
+        f'ALTER TABLE "{name}" ADD CONSTRAINT "{name}_bounds" '
+        f"CHECK (timestamp >= '{start:%Y-%m-%d}' AND timestamp < '{end:%Y-%m-%d}')"
+    ))
+    conn.execute(text(f'ALTER TABLE {PARENT_TABLE} ATTACH PARTITION "{name}" FOR VALUES {bounds}'))
+    conn.execute(text(f'ALTER TABLE "{name}" DROP CONSTRAINT "{name}_bounds"'))
+    return name
+
+def ensure_partitions(months_ahead=None, now=None):
+    """Создает недостающие секции текущего и months_ahead следующих месяцев; возвращает их имена"""
+    months_ahead = PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    current = month_start(now or datetime.utcnow())
+
+    with get_engine().begin() as conn:
+        if not is_partitioned(conn):
+            return []
+        _lock(conn)
+        existing = {partition['name'] for partition in list_partitions(conn)}
+
+        created = []
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            if partition_name(month) not in existing:
+                created.append(_create_partition(conn, month))
+
+    if created:
+        print(f"🗂 Созданы секции transactions: {', '.join(created)}")
+    return created
+
+_maintenance_thread = None
+_maintenance_lock = threading.Lock()
+
+def start_partition_maintenance():
+    """Запускает фоновый поток, который вызывает ensure_partitions сразу и затем
+    каждые PARTITION_CHECK_INTERVAL секунд; возвращает True, если поток работает
+
+    Запускается в каждом процессе веба, бота и воркера: секции нужны при любом
+    INGEST_MODE, а одновременные проверки разных процессов разводит advisory lock.
+    На SQLite секций нет, и поток не запускается.
+    """
+    global _maintenance_thread
+    if get_engine().dialect.name != 'postgresql':
+        return False
+
+    with _maintenance_lock:
+        if _maintenance_thread is None or not _maintenance_thread.is_alive():
+            _maintenance_thread = threading.Thread(target=_maintain_partitions, name='ft-partitions', daemon=True)
+            _maintenance_thread.start()
+    return True
+
+def _maintain_partitions():
+    while True:
+        try:
+            ensure_partitions()
+        except Exception as e:
+            print(f"❌ Ошибка создания секций transactions: {e}")
+        time.sleep(PARTITION_CHECK_INTERVAL)
+
+def _detached_tables(conn):
+    """Секции, отсоединенные прошлым archive_partitions, но еще не выгруженные (сбой посередине)"""
+    names = conn.execute(text("""
+        SELECT relname FROM pg_class
+        WHERE relkind = 'r' AND NOT relispartition AND relname LIKE :prefix AND pg_table_is_visible(oid)
+    """), {'prefix': f'{PARENT_TABLE}\\_%'}).scalars().all()
+    return [name for name in names if PARTITION_PATTERN.match(name)]
+
+def archive_candidates(partitions, older_than_months, now):
+    """Имена секций (из list_partitions), закончившихся раньше чем older_than_months месяцев
+    назад; transactions_default не архивируется никогда"""
+    cutoff = add_months(month_start(now), -older_than_months)
+    return [
+        partition['name'] for partition in partitions
+        if partition['end'] is not None and partition['end'] <= cutoff
+    ]
+
+def archive_partitions(older_than_months=None, directory=None, dry_run=False, now=None):
+    """Отсоединяет секции, закончившиеся раньше чем older_than_months месяцев назад,
+    выгружает каждую в <directory>/<секция>.csv.gz и удаляет; возвращает пути архивов
+
+    DETACH - короткая транзакция (блокирует transactions только на время смены
+    метаданных), выгрузка идет уже из отдельной таблицы. DROP - после того, как
+    архив записан на диск; упавший посередине запуск повторный доделает.
+    Архивные строки пропадают из истории баланса и графиков.
+    """
+    older_than_months = ARCHIVE_AFTER_MONTHS if older_than_months is None else older_than_months
+    directory = directory or ARCHIVE_DIR
+
+    engine = get_engine()
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            return []
+        candidates = archive_candidates(list_partitions(conn), older_than_months, now or datetime.utcnow())
+        leftovers = _detached_tables(conn)
+
+    if dry_run:
+        return [os.path.join(directory, f"{name}.csv.gz") for name in leftovers + candidates]
+
+    os.makedirs(directory, exist_ok=True)
+    for name in candidates:
+        with engine.begin() as conn:
+            _lock(conn)
+            conn.execute(text(f'ALTER TABLE {PARENT_TABLE} DETACH PARTITION "{name}"'))
+
+    archived = []
+    for name in leftovers + candidates:
+        path = os.path.join(directory, f"{name}.csv.gz")
+        with engine.begin() as conn:
+            cursor = conn.connection.cursor()
+            with gzip.open(path + '.tmp', 'wb') as archive:
+                cursor.copy_expert(f'COPY "{name}" TO STDOUT WITH (FORMAT csv, HEADER)', archive)
+            with open(path + '.tmp', 'rb') as archive:
+                os.fsync(archive.fileno())
+            os.replace(path + '.tmp', path)
+
+            conn.execute(text(f'DROP TABLE "{name}"'))
+        archived.append(path)
+        print(f"📦 Секция {name} выгружена в {path}")
+    return archived
+
+def restore_partition(path):
+    """Возвращает в transactions секцию из архива archive_partitions; возвращает имя секции"""
+    name = os.path.basename(path)[:-len('.csv.gz')] if path.endswith('.csv.gz') else ''
+    match = PARTITION_PATTERN.match(name)
+    if not match:
+        raise ValueError(f"Имя архива должно быть transactions_YYYY_MM.csv.gz: {path}")
+    month = datetime(int(match.group(1)), int(match.group(2)), 1)
+
+    def load(conn, table):
+        cursor = conn.connection.cursor()
+        with gzip.open(path, 'rb') as archive:
+            cursor.copy_expert(f'COPY "{table}" FROM STDIN WITH (FORMAT csv, HEADER)', archive)
+
+    with get_engine().begin() as conn:
+        if not is_partitioned(conn):
+            raise RuntimeError("Таблица transactions не секционирована (нужна PostgreSQL и миграция 005)")
+        _lock(conn)
+        if any(partition['name'] == name for partition in list_partitions(conn)):
+            raise RuntimeError(f"Секция {name} уже существует")
+        _create_partition(conn, month, load)
+
+    print(f"♻️ Секция {name} восстановлена из {path}")
+    return name
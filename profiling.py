@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Профилирование отдельных запросов и апдейтов бота по требованию
+
+Профиль включается только для конкретного запроса (заголовок X-Profile или
+?profile=<PROFILE_TOKEN>) либо следующего действия в чате администратора
+(команда /profile). Собирается cProfile потоков, выполнявших работу, и все
+SQL-запросы с длительностью; отчет сохраняется в PROFILE_DIR.
+"""
+
+import contextvars
+import cProfile
+import functools
+import io
+import os
+import pstats
+import re
+import secrets
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'finance-tracker-profiles'))
+# Сколько последних профилей хранить
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '50'))
+# Сколько функций и SQL-запросов попадает в текстовый отчет
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_MAX_SQL = 200
+
+PROFILE_ID_PATTERN = re.compile(r'^[\w.-]+$')
+
+_current_profile = contextvars.ContextVar('finance_tracker_profile', default=None)
+_thread_state = threading.local()
+_sql_hooks_installed = False
+_sql_hooks_lock = threading.Lock()
+
+class ProfileSession:
+    """Профиль одного запроса: cProfile по потокам и список SQL-запросов"""
+
+    def __init__(self, label):
+        self.label = label
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.profiles = []
+        self.sql = []
+        self.thread_profile = None
+        self._lock = threading.Lock()
+
+    def add_profile(self, profile):
+        with self._lock:
+            self.profiles.append(profile)
+
+    def record_sql(self, statement, duration):
+        with self._lock:
+            self.sql.append((duration, statement))
+
+    def run(self, func, *args, **kwargs):
+        """Выполняет func под cProfile текущего потока (если поток еще не профилируется)"""
+        if getattr(_thread_state, 'profiling', False):
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        _thread_state.profiling = True
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            _thread_state.profiling = False
+            self.add_profile(profile)
+
+    def report(self):
+        """Текстовый отчет: SQL по убыванию времени и функции по cumulative time"""
+        sql_total = sum(duration for duration, _ in self.sql)
+        lines = [
+            f"Профиль: {self.label}",
+            f"Начало: {self.started_at.isoformat()}Z",
+            f"Длительность: {self.duration * 1000:.1f} ms",
+            f"SQL: {len(self.sql)} запросов, {sql_total * 1000:.1f} ms",
+            '',
+            '== SQL (по времени) =='
+        ]
+        for duration, statement in sorted(self.sql, key=lambda item: item[0], reverse=True)[:PROFILE_MAX_SQL]:
+            statement = ' '.join(statement.split())
+            lines.append(f"{duration * 1000:9.2f} ms  {statement[:500]}")
+
+        stats = self.stats()
+        if stats:
+            output = io.StringIO()
+            stats.stream = output
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            lines.extend(['', '== Функции (cumulative) ==', output.getvalue()])
+        return '\n'.join(lines)
+
+    def stats(self):
+        """Объединенная статистика cProfile всех потоков или None"""
+        with self._lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def summary(self):
+        return {
+            'label': self.label,
+            'duration_ms': round(self.duration * 1000, 1),
+            'sql_count': len(self.sql),
+            'sql_ms': round(sum(duration for duration, _ in self.sql) * 1000, 1)
+        }
+
+def _install_sql_hooks():
+    """Подписывается на события SQLAlchemy один раз на процесс, при первом профиле"""
+    global _sql_hooks_installed
+    if _sql_hooks_installed:
+        return
+
+    with _sql_hooks_lock:
+        if _sql_hooks_installed:
+            return
+
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if _current_profile.get() is not None:
+                conn.info.setdefault('profile_query_started', []).append(time.perf_counter())
+
+        @event.listens_for(Engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            session = _current_profile.get()
+            started = conn.info.get('profile_query_started')
+            if session is not None and started:
+                session.record_sql(statement, time.perf_counter() - started.pop())
+
+        _sql_hooks_installed = True
+
+def start_profile(label, profile_thread=True):
+    """Включает профиль для текущего контекста; возвращает (сессия, токен контекста)
+
+    profile_thread=False - не профилировать текущий поток (цикл asyncio бота,
+    где выполняются чужие апдейты); тогда профилируется только работа в потоках.
+    """
+    _install_sql_hooks()
+    session = ProfileSession(label)
+    token = _current_profile.set(session)
+
+    if profile_thread and not getattr(_thread_state, 'profiling', False):
+        session.thread_profile = cProfile.Profile()
+        _thread_state.profiling = True
+        session.thread_profile.enable()
+    return session, token
+
+def finish_profile(session, token):
+    """Выключает профиль, сохраняет отчет и возвращает id профиля"""
+    if session.thread_profile is not None:
+        session.thread_profile.disable()
+        _thread_state.profiling = False
+        session.add_profile(session.thread_profile)
+        session.thread_profile = None
+
+    _current_profile.reset(token)
+    session.duration = time.perf_counter() - session.started
+    return save_profile(session)
+
+def current_profile():
+    return _current_profile.get()
+
+def profiled(func):
+    """Обертка для работы в потоках: под профилем, если он включен в контексте вызова"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        session = _current_profile.get()
+        if session is None:
+            return func(*args, **kwargs)
+        return session.run(func, *args, **kwargs)
+    return wrapper
+
+def save_profile(session):
+    """Сохраняет <id>.txt (отчет) и <id>.prof (pstats для snakeviz и т.п.)"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r'[^\w-]+', '_', session.label).strip('_')[:40] or 'profile'
+    profile_id = f"{session.started_at:%Y%m%d-%H%M%S}-{slug}-{secrets.token_hex(3)}"
+
+    with open(os.path.join(PROFILE_DIR, f'{profile_id}.txt'), 'w', encoding='utf-8') as f:
+        f.write(session.report())
+    stats = session.stats()
+    if stats:
+        stats.dump_stats(os.path.join(PROFILE_DIR, f'{profile_id}.prof'))
+
+    _prune_profiles()
+    print(f"⏱ Профиль {profile_id}: {session.summary()}")
+    return profile_id
+
+def _prune_profiles():
+    """Удаляет самые старые профили сверх PROFILE_KEEP"""
+    profile_ids = list_profiles()
+    for profile_id in profile_ids[PROFILE_KEEP:]:
+        for suffix in ('.txt', '.prof'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, profile_id + suffix))
+            except FileNotFoundError:
+                pass
+
+def list_profiles():
+    """id сохраненных профилей, новые первыми"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted((name[:-4] for name in os.listdir(PROFILE_DIR) if name.endswith('.txt')), reverse=True)
+
+def profile_path(profile_id, kind='txt'):
+    """Путь к файлу профиля или None, если id некорректен или файла нет"""
+    if kind not in ('txt', 'prof') or not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, f'{profile_id}.{kind}')
+    return path if os.path.exists(path) else None
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Ограничение нагрузки на распознавание скриншотов
+
+- ocr_rate_limiter - token bucket на клиента (IP в вебе, пользователь в боте):
+  OCR_RATE_LIMIT_BURST скриншотов подряд, дальше OCR_RATE_LIMIT_PER_MINUTE в минуту.
+  Состояние корзин хранится в бэкенде RATE_LIMIT_BACKEND: memory (по умолчанию,
+  свое у каждого процесса) или sqlite:///путь - общий файл для всех процессов хоста.
+  Свой бэкенд - любой объект с методом take(key, capacity, rate, now).
+- ocr_gate - не больше OCR_MAX_CONCURRENCY распознаваний в процессе одновременно.
+  Остальные ждут слот до OCR_QUEUE_TIMEOUT сек (в очереди не больше OCR_MAX_QUEUE),
+  иначе сразу получают отказ с оценкой, через сколько повторить. Ожидание слота
+  асинхронное (async with ocr_gate.slot()) и не занимает поток.
+
+take() бэкенда может ходить в файл, поэтому из корутин hit() вызывается в пуле
+потоков (run_blocking в вебе, asyncio.to_thread в боте).
+
+Отказ в обоих случаях - исключение Throttled с retry_after (сек).
+"""
+
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from metrics import Gauge, OCR_THROTTLED_TOTAL
+
+# Скриншотов в минуту на клиента (0 - без ограничения) и сколько можно прислать подряд
+OCR_RATE_LIMIT_PER_MINUTE = float(os.environ.get('OCR_RATE_LIMIT_PER_MINUTE', '20'))
+OCR_RATE_LIMIT_BURST = int(os.environ.get('OCR_RATE_LIMIT_BURST', '10'))
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+
+# Одновременных распознаваний в процессе, ожидание слота (сек) и длина очереди ожидания
+OCR_MAX_CONCURRENCY = int(os.environ.get('OCR_MAX_CONCURRENCY', '4'))
+OCR_QUEUE_TIMEOUT = float(os.environ.get('OCR_QUEUE_TIMEOUT', '10'))
+OCR_MAX_QUEUE = int(os.environ.get('OCR_MAX_QUEUE', '16'))
+
+# Как часто (в вызовах take) бэкенд выбрасывает полные корзины
+PRUNE_EVERY = 1000
+
+OCR_SLOTS_WAITING = Gauge('ft_ocr_slots_waiting', 'Распознавания, ждущие свободного слота OCR_MAX_CONCURRENCY')
+
+class Throttled(Exception):
+    """Запрос отклонен: reason - rate_limit или busy, retry_after - через сколько секунд повторить"""
+
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"{reason}: повторите через {self.retry_after} с")
+
+def _refill(tokens, updated_at, capacity, rate, now):
+    """Забирает жетон из корзины; возвращает (остаток жетонов, сколько ждать следующего)"""
+    tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+class MemoryBackend:
+    """Корзины в словаре процесса"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens, wait = _refill(tokens, updated_at, capacity, rate, now)
+            self._buckets[key] = (tokens, now)
+
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                # Корзина, которая успела наполниться, ничем не отличается от отсутствующей
+                full_after = capacity / rate
+                self._buckets = {
+                    bucket_key: value for bucket_key, value in self._buckets.items()
+                    if now - value[1] < full_after
+                }
+            return wait
+
+class SQLiteBackend:
+    """Корзины в файле SQLite: общие для всех процессов на одном хосте"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+        self._connection().execute("""
+            CREATE TABLE IF NOT EXISTS token_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Соединение на поток; транзакции открываем сами (BEGIN IMMEDIATE)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate, now):
+        conn = self._connection()
+        # IMMEDIATE сразу берет блокировку записи: чтение и запись корзины атомарны между процессами
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM token_buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated_at = row if row else (capacity, now)
+            tokens, wait = _refill(tokens, updated_at, capacity, rate, now)
+            conn.execute(
+                'INSERT INTO token_buckets (key, tokens, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at',
+                (key, tokens, now)
+            )
+
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM token_buckets WHERE updated_at < ?', (now - capacity / rate,))
+            conn.execute('COMMIT')
+            return wait
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+def create_backend(url):
+    """Бэкенд по RATE_LIMIT_BACKEND: memory или sqlite:///путь/к/файлу.db"""
+    if url == 'memory':
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    raise ValueError(f"Неизвестный RATE_LIMIT_BACKEND: {url}")
+
+class TokenBucketLimiter:
+    """Token bucket на ключ: capacity жетонов, пополнение per_minute жетонов в минуту"""
+
+    def __init__(self, backend, per_minute, capacity):
+        self.backend = backend
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, capacity)
+
+    def hit(self, key):
+        """Тратит жетон key; без жетона поднимает Throttled('rate_limit')"""
+        if self.rate <= 0:
+            return
+        try:
+            wait = self.backend.take(key, self.capacity, self.rate, time.time())
+        except Exception as e:
+            # Сломанный бэкенд не должен останавливать распознавание
+            print(f"⚠️ Ошибка ограничителя запросов: {e}")
+            return
+        if wait > 0:
+            OCR_THROTTLED_TOTAL.inc(reason='rate_limit')
+            raise Throttled('rate_limit', wait)
+
+class ConcurrencyGate:
+    """Не больше limit одновременных работ; остальные ждут в очереди ограниченное время
+
+    Очередь - concurrent.futures.Future, а не asyncio-примитивы: у каждого
+    async-представления Flask свой цикл событий (app.FinanceTrackerFlask), и
+    освободившийся слот передается ожидающему из любого цикла по порядку очереди.
+    """
+
+    def __init__(self, limit, queue_timeout, max_queue):
+        self.limit = max(1, limit)
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = deque()
+        # Скользящее среднее длительности работы (сек) - для оценки retry_after
+        self._average = None
+
+    def retry_after(self):
+        """Примерное время, за которое освободится место для еще одного запроса"""
+        with self._lock:
+            average = self._average or self.queue_timeout or 1.0
+            return average * (len(self._waiters) // self.limit + 1)
+
+    def _busy(self):
+        OCR_THROTTLED_TOTAL.inc(reason='busy')
+        return Throttled('busy', self.retry_after())
+
+    def _acquire(self):
+        """Занимает слот сразу (None) или встает в очередь (Future); False - очередь полна"""
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                return False
+            waiter = Future()
+            self._waiters.append(waiter)
+            return waiter
+
+    def _release(self):
+        """Передает слот первому живому ожидающему, а если их нет - освобождает"""
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                # Ожидающий, который уже сдался по таймауту, отменен - пропускаем
+                if waiter.set_running_or_notify_cancel():
+                    waiter.set_result(None)
+                    return
+            self._active -= 1
+
+    async def _wait(self, waiter):
+        OCR_SLOTS_WAITING.inc()
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # cancel() не удается, только если слот уже передан нам: тогда он наш
+            if waiter.cancel():
+                with self._lock:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise self._busy()
+            if isinstance(e, asyncio.CancelledError):
+                self._release()
+                raise
+        finally:
+            OCR_SLOTS_WAITING.dec()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Занимает слот (async with); если его не дождаться - Throttled('busy')"""
+        waiter = self._acquire()
+        if waiter is False:
+            raise self._busy()
+        if waiter is not None:
+            await self._wait(waiter)
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._average = elapsed if self._average is None else self._average * 0.8 + elapsed * 0.2
+            self._release()
+
+# Глобальные экземпляры
+ocr_rate_limiter = TokenBucketLimiter(create_backend(RATE_LIMIT_BACKEND), OCR_RATE_LIMIT_PER_MINUTE, OCR_RATE_LIMIT_BURST)
+ocr_gate = ConcurrencyGate(OCR_MAX_CONCURRENCY, OCR_QUEUE_TIMEOUT, OCR_MAX_QUEUE)
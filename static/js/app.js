@@ -9,10 +9,20 @@ document.addEventListener('DOMContentLoaded', function() {
     // Инициализация графиков
     initCharts();
     
-    // Автообновление каждые 30 секунд
-    setInterval(refreshAccounts, 30000);
+    // Обновляем счета по push-событиям сервера (SSE) вместо опроса каждые 30 секунд
+    subscribeToAccountUpdates();
 });
 
+// Подписка на события /api/stream: сервер сообщает об изменении счетов
+function subscribeToAccountUpdates() {
+    if (!window.EventSource) return;
+    
+    const source = new EventSource('/api/stream');
+    source.addEventListener('accounts_update', function() {
+        refreshAccounts();
+    });
+}
+
 // Инициализация формы загрузки изображения
 function initUploadForm() {
     const form = document.getElementById('uploadForm');
@@ -729,13 +739,7 @@ function createAccountChart(historyData) {
     });
 }
 
-// Обновить данные при загрузке страницы
-document.addEventListener('DOMContentLoaded', function() {
-    // Можно добавить автоматическое обновление каждые 30 секунд
-    // setInterval(refreshAccounts, 30000);
-});
-
-// Функция обновления счетов (для будущего использования)
+// Функция обновления счетов (вызывается по событию из /api/stream)
 async function refreshAccounts() {
     try {
         const response = await fetch('/api/accounts');
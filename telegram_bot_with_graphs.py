@@ -4,33 +4,65 @@ Telegram бот Finance Tracker с графиками
 """
 
 import os
+import asyncio
 import logging
+import secrets
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.error import TelegramError
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from datetime import datetime
+import time
 
 # Импортируем общую логику
 from core import finance_tracker_core
+from models import get_revaluation_version
+from events import change_listener
+from partitions import start_partition_maintenance
+from profiling import start_profile, finish_profile, profiled, profile_path
+from metrics import Counter, Gauge, Histogram, timed, start_metrics_server, CHART_RENDER_SECONDS
+from ratelimit import ocr_rate_limiter, Throttled
+from cache import shared_cache, CHART_CACHE_TTL
 
-# Настройка matplotlib для работы без GUI (headless mode)
-import matplotlib
-matplotlib.use('Agg')  # Используем backend без GUI
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import io
-from matplotlib import rcParams
+import threading
+from collections import deque
 
-# Настройка matplotlib для корректной работы
-rcParams['font.family'] = ['DejaVu Sans', 'Arial', 'sans-serif']
-rcParams['font.size'] = 10
-rcParams['figure.figsize'] = (10, 8)
-rcParams['savefig.dpi'] = 150
-rcParams['savefig.bbox'] = 'tight'
-rcParams['savefig.pad_inches'] = 0.1
+_matplotlib_configured = False
+# Графики строятся в asyncio.to_thread: первые несколько могут начаться одновременно
+_matplotlib_lock = threading.Lock()
 
-# Настройка matplotlib для русского языка
-rcParams['font.family'] = 'DejaVu Sans'
-rcParams['font.size'] = 10
+def setup_matplotlib():
+    """Импортирует и настраивает matplotlib при первом построении графика
+
+    Импорт matplotlib - самая дорогая часть старта бота, а графики нужны
+    не в каждом процессе и не сразу.
+    """
+    global _matplotlib_configured
+    if _matplotlib_configured:
+        return
+
+    with _matplotlib_lock:
+        if _matplotlib_configured:
+            return
+
+        # Настройка matplotlib для работы без GUI (headless mode)
+        import matplotlib
+        matplotlib.use('Agg')  # Используем backend без GUI
+        from matplotlib import rcParams
+
+        # Настройка matplotlib для корректной работы
+        rcParams['font.family'] = ['DejaVu Sans', 'Arial', 'sans-serif']
+        rcParams['font.size'] = 10
+        rcParams['figure.figsize'] = (10, 8)
+        rcParams['savefig.dpi'] = 150
+        rcParams['savefig.bbox'] = 'tight'
+        rcParams['savefig.pad_inches'] = 0.1
+
+        # Настройка matplotlib для русского языка
+        rcParams['font.family'] = 'DejaVu Sans'
+        rcParams['font.size'] = 10
+
+        _matplotlib_configured = True
 
 # Настройка логирования
 logging.basicConfig(
@@ -39,14 +71,200 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Метрики бота (HTTP-сервер /metrics поднимается при заданном METRICS_PORT)
+BOT_UPDATES_TOTAL = Counter('ft_bot_updates_total', 'Обработанные апдейты Telegram', ['kind'])
+BOT_UPDATES_WAITING = Gauge('ft_bot_updates_waiting', 'Апдейты в очереди своего чата')
+BOT_UPDATES_IN_FLIGHT = Gauge('ft_bot_updates_in_flight', 'Апдейты в обработке')
+BOT_UPDATE_WAIT_SECONDS = Histogram('ft_bot_update_wait_seconds', 'Ожидание апдейта в очереди своего чата до начала обработки')
+BOT_HEAVY_WORK_WAITING = Gauge('ft_bot_heavy_work_waiting', 'Тяжелые задачи (OCR, графики) в ожидании слота')
+BOT_HEAVY_WORK_RUNNING = Gauge('ft_bot_heavy_work_running', 'Тяжелые задачи в работе')
+BOT_HEAVY_WORK_WAIT_SECONDS = Histogram('ft_bot_heavy_work_wait_seconds', 'Ожидание слота тяжелой работы')
+BOT_SCREENSHOTS_TOTAL = Counter('ft_bot_screenshots_total', 'Скриншоты из бота по результату', ['result'])
+BOT_CHART_SENDS_TOTAL = Counter('ft_bot_chart_sends_total', 'Отправленные графики: по file_id или новой загрузкой', ['source'])
+
+def update_kind(update):
+    """Тип апдейта для метрик: command, photo, message, callback_query, other"""
+    if getattr(update, 'callback_query', None):
+        return 'callback_query'
+    message = getattr(update, 'message', None)
+    if message is None:
+        return 'other'
+    if message.photo:
+        return 'photo'
+    if message.text and message.text.startswith('/'):
+        return 'command'
+    return 'message'
+
+# Администраторы бота (id пользователей через запятую): им доступна команда /profile
+TELEGRAM_ADMIN_IDS = {
+    int(user_id) for user_id in os.environ.get('TELEGRAM_ADMIN_IDS', '').split(',') if user_id.strip()
+}
+# Чаты, в которых профилируется следующий апдейт (после /profile)
+pending_profiles = set()
+
+def update_label(update):
+    """Короткое описание апдейта для имени профиля"""
+    query = getattr(update, 'callback_query', None)
+    if query:
+        return f"callback {query.data}"
+    message = getattr(update, 'message', None)
+    if message and message.text:
+        return message.text.split()[0]
+    return update_kind(update)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных чатов со строгим порядком внутри одного чата
+
+    Общий лимит - семафор PTB в process_update, порядок чата - в do_process_update.
+    Пока апдейт чата обрабатывается, следующие апдейты этого чата встают в его
+    очередь (FIFO) и сразу отдают слот: очередь выполняет тот же слот, поэтому
+    один чат занимает не больше одного слота и не задерживает остальные.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chat_queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        chat_id = chat.id if chat else None
+        BOT_UPDATES_WAITING.inc()
+        measured = self._measured(update, coroutine, time.perf_counter())
+        
+        if chat_id is None:
+            await measured
+            return
+        
+        chat_queue = self._chat_queues.get(chat_id)
+        if chat_queue is not None:
+            # Чат уже обрабатывается: апдейт выполнит тот слот, после текущих
+            chat_queue.append(measured)
+            return
+        
+        chat_queue = self._chat_queues[chat_id] = deque([measured])
+        try:
+            while chat_queue:
+                try:
+                    await chat_queue[0]
+                except Exception as e:
+                    # Ошибка одного апдейта не останавливает очередь чата
+                    logger.error(f"❌ Ошибка обработки апдейта чата {chat_id}: {e}")
+                chat_queue.popleft()
+        finally:
+            del self._chat_queues[chat_id]
+            for pending in chat_queue:
+                pending.close()
+
+    async def _measured(self, update, coroutine, enqueued_at):
+        BOT_UPDATES_WAITING.dec()
+        BOT_UPDATES_IN_FLIGHT.inc()
+        BOT_UPDATE_WAIT_SECONDS.observe(time.perf_counter() - enqueued_at)
+        
+        profile = None
+        chat = getattr(update, 'effective_chat', None)
+        if chat and chat.id in pending_profiles:
+            pending_profiles.discard(chat.id)
+            # Поток цикла asyncio не профилируем: в нем идут апдейты других чатов
+            profile = start_profile(f"bot {update_label(update)}", profile_thread=False)
+        try:
+            await coroutine
+        finally:
+            if profile:
+                await send_profile_report(update, chat.id, finish_profile(*profile))
+            BOT_UPDATES_IN_FLIGHT.dec()
+            BOT_UPDATES_TOTAL.inc(kind=update_kind(update))
+            processed, _ = BOT_UPDATE_WAIT_SECONDS.snapshot()
+            if processed % 100 == 0:
+                logger.info(f"📊 Апдейты: {self.stats()}")
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        """Глубина очереди и время ожидания апдейтов"""
+        processed, total_wait = BOT_UPDATE_WAIT_SECONDS.snapshot()
+        return {
+            'waiting': BOT_UPDATES_WAITING.value(),
+            'in_flight': BOT_UPDATES_IN_FLIGHT.value(),
+            'processed': processed,
+            'avg_wait_ms': round(total_wait / processed * 1000, 1) if processed else 0.0
+        }
+
+# Общий лимит одновременной тяжелой работы (OCR, графики) - она выполняется в потоках
+BOT_HEAVY_WORK_CONCURRENCY = int(os.environ.get('BOT_HEAVY_WORK_CONCURRENCY', '2'))
+_heavy_work_semaphore = None
+
+async def run_heavy(func, *args, **kwargs):
+    """Выполняет тяжелую блокирующую функцию в потоке под общим семафором"""
+    global _heavy_work_semaphore
+    if _heavy_work_semaphore is None:
+        _heavy_work_semaphore = asyncio.Semaphore(BOT_HEAVY_WORK_CONCURRENCY)
+    
+    started = time.perf_counter()
+    BOT_HEAVY_WORK_WAITING.inc()
+    async with _heavy_work_semaphore:
+        BOT_HEAVY_WORK_WAITING.dec()
+        BOT_HEAVY_WORK_RUNNING.inc()
+        BOT_HEAVY_WORK_WAIT_SECONDS.observe(time.perf_counter() - started)
+        try:
+            return await asyncio.to_thread(profiled(func), *args, **kwargs)
+        finally:
+            BOT_HEAVY_WORK_RUNNING.dec()
+
+async def send_chart(bot, chat_id, chart_key, render, caption, reply_markup=None, before_render=None):
+    """Отправляет график; пока данные не изменились, повторно шлет уже загруженный file_id
+
+    file_id (ключ chart_file_id:<график> -> (версия данных, file_id)) и сама картинка
+    (chart:<график>:<версия>) лежат в общем кэше: их видят все процессы бота.
+    Возвращает False, если график построить не удалось.
+    """
+    version = await asyncio.to_thread(finance_tracker.get_chart_version, chart_key)
+    file_id_key = f"chart_file_id:{chart_key}"
+    
+    cached = await asyncio.to_thread(shared_cache.get, file_id_key)
+    if cached and cached[0] == version:
+        try:
+            await bot.send_photo(chat_id=chat_id, photo=cached[1], caption=caption, reply_markup=reply_markup)
+            BOT_CHART_SENDS_TOTAL.inc(source='file_id')
+            return True
+        except TelegramError as e:
+            # file_id мог устареть - просто перерисуем график
+            logger.warning(f"Не удалось отправить график {chart_key} по file_id: {e}")
+            await asyncio.to_thread(shared_cache.delete, file_id_key)
+    
+    if before_render:
+        await before_render()
+    
+    chart_cache_key = f"chart:{chart_key}:{version}"
+    chart = await asyncio.to_thread(shared_cache.get, chart_cache_key)
+    if chart is None:
+        chart_buffer = await run_heavy(render)
+        if not chart_buffer:
+            return False
+        chart = chart_buffer.getvalue()
+        await asyncio.to_thread(shared_cache.set, chart_cache_key, chart, CHART_CACHE_TTL)
+    
+    message = await bot.send_photo(chat_id=chat_id, photo=chart, caption=caption, reply_markup=reply_markup)
+    BOT_CHART_SENDS_TOTAL.inc(source='upload')
+    if message.photo:
+        await asyncio.to_thread(shared_cache.set, file_id_key, (version, message.photo[-1].file_id))
+    return True
+
 class FinanceTrackerBotWithGraphs:
     def __init__(self):
         """Инициализация бота"""
         # Используем общую логику из core.py
-        self.vision_client = finance_tracker_core.vision_client
         self.currency_patterns = finance_tracker_core.currency_patterns
         self.balance_keywords = finance_tracker_core.balance_keywords
 
+    @property
+    def vision_client(self):
+        """Клиент Google Vision (создается при первом обращении)"""
+        return finance_tracker_core.vision_client
+
     def process_image(self, image_content):
         """Обрабатываем изображение через Google Vision"""
         return finance_tracker_core.process_image(image_content)
@@ -59,6 +277,10 @@ class FinanceTrackerBotWithGraphs:
         """Исправляем формат российских чисел"""
         return finance_tracker_core.fix_russian_number_format(text, currency)
 
+    def get_accounts_snapshot(self):
+        """Получает сводку и детали по всем счетам одним вызовом"""
+        return finance_tracker_core.get_accounts_snapshot()
+
     def get_accounts_summary(self):
         """Получает сводку по всем счетам"""
         return finance_tracker_core.get_accounts_summary()
@@ -71,20 +293,56 @@ class FinanceTrackerBotWithGraphs:
         """Обновляем баланс счета в БД на основе распознанного изображения"""
         return finance_tracker_core.update_account_balance_from_image(balance_data, image_text, source)
 
+    @property
+    def ingest_mode(self):
+        """Режим обработки скриншотов: sync или queue"""
+        return finance_tracker_core.ingest_mode
+
+    def ingest_image(self, image_content, source='telegram'):
+        """Распознает скриншот и обновляет баланс"""
+        return finance_tracker_core.ingest_image(image_content, source=source)
+
+    def enqueue_image(self, image_content, source='telegram'):
+        """Ставит скриншот в очередь распознавания"""
+        return finance_tracker_core.enqueue_image(image_content, source=source)
+
+    def get_ingest_job(self, job_id):
+        """Статус задачи распознавания"""
+        return finance_tracker_core.get_ingest_job(job_id)
+
+    def get_chart_version(self, chart_key):
+        """Версия данных, из которых строится график с ключом chart_key"""
+        kind, _, account_id = chart_key.partition(':')
+        if kind == 'account_history':
+            version = finance_tracker_core.get_history_version(int(account_id))
+            start = finance_tracker_core.history_start()
+            return f"{version}-d{start:%Y%m%d}" if start else version
+        if kind == 'balance_chart':
+            # Распределение строится из accounts.balance_usd: меняется с транзакциями и
+            # с пересчетом balance_usd по новым курсам (как версия /api/accounts)
+            return f"tx{finance_tracker_core.get_data_version()}-rv{get_revaluation_version()}"
+        
+        # История в долларах зависит от транзакций и снимка курсов
+        return finance_tracker_core.balance_history_version()
+
+    @timed(CHART_RENDER_SECONDS, chart='balance')
     def create_balance_chart(self):
         """Создаем график распределения по валютам"""
         try:
+            setup_matplotlib()
+            from matplotlib.figure import Figure
             from models import create_session, Account
             
             session = create_session()
-            accounts = session.query(Account).all()
+            accounts = session.query(Account.name, Account.balance_usd).all()
             
             if not accounts:
                 session.close()
                 return None
             
-            # Создаем круговую диаграмму
-            fig, ax = plt.subplots(figsize=(10, 8))
+            # Создаем круговую диаграмму (Figure без pyplot - безопасно в потоках)
+            fig = Figure(figsize=(10, 8))
+            ax = fig.subplots()
             
             labels = []
             sizes = []
@@ -95,7 +353,6 @@ class FinanceTrackerBotWithGraphs:
                 sizes.append(account.balance_usd)
             
             if not sizes or sum(sizes) == 0:
-                plt.close(fig)
                 session.close()
                 return None
             
@@ -116,56 +373,58 @@ class FinanceTrackerBotWithGraphs:
                    ha='center', fontsize=14, fontweight='bold',
                    bbox=dict(boxstyle="round,pad=0.3", facecolor="lightblue", alpha=0.7))
             
-            plt.tight_layout()
+            fig.tight_layout()
             
             # Сохраняем в байты
             img_buffer = io.BytesIO()
-            plt.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
+            fig.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
             img_buffer.seek(0)
-            plt.close(fig)
             session.close()
             
             return img_buffer
             
         except Exception as e:
             logger.error(f"❌ Ошибка создания графика: {e}")
-            # Закрываем фигуру в случае ошибки
-            try:
-                plt.close('all')
-            except:
-                pass
             if 'session' in locals():
                 session.close()
             return None
 
+    @timed(CHART_RENDER_SECONDS, chart='account_history')
     def create_account_history_chart(self, account_id):
         """Создаем график истории счета"""
         try:
             # Получаем данные из базы данных
+            setup_matplotlib()
+            from matplotlib.figure import Figure
+            import matplotlib.dates as mdates
             from models import create_session, Account, Transaction
             
             session = create_session()
-            account = session.query(Account).filter_by(id=account_id).first()
+            account = session.query(Account.name, Account.currency).filter_by(id=account_id).first()
             
             if not account:
                 session.close()
                 return None
             
-            # Получаем транзакции для этого счета
-            transactions = session.query(Transaction).filter_by(account_id=account_id).order_by(Transaction.timestamp).all()
+            # Транзакции счета за окно HISTORY_DAYS уже по времени; нужны только дата и баланс
+            transactions = session.query(Transaction.timestamp, Transaction.new_balance).filter_by(
+                account_id=account_id
+            )
+            start = finance_tracker_core.history_start()
+            if start is not None:
+                transactions = transactions.filter(Transaction.timestamp >= start)
+            transactions = transactions.order_by(Transaction.timestamp, Transaction.id).all()
             
             if not transactions:
                 session.close()
                 return None
             
-            # Сортируем транзакции по времени
-            sorted_transactions = sorted(transactions, key=lambda x: x.timestamp)
-            
-            dates = [t.timestamp for t in sorted_transactions]
-            balances = [t.new_balance for t in sorted_transactions]
+            dates = [timestamp for timestamp, _ in transactions]
+            balances = [new_balance for _, new_balance in transactions]
             
             # Создаем один график вместо двух
-            fig, ax = plt.subplots(figsize=(12, 8))
+            fig = Figure(figsize=(12, 8))
+            ax = fig.subplots()
             
             # График баланса
             ax.plot(dates, balances, 'o-', linewidth=2, markersize=6, color='#36A2EB')
@@ -178,54 +437,46 @@ class FinanceTrackerBotWithGraphs:
             # Форматирование дат
             ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
             ax.xaxis.set_major_locator(mdates.DayLocator(interval=1))
-            plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
+            ax.tick_params(axis='x', labelrotation=45)
             
-            plt.tight_layout()
+            fig.tight_layout()
             
             # Сохраняем в байты
             img_buffer = io.BytesIO()
-            plt.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
+            fig.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
             img_buffer.seek(0)
-            plt.close(fig)
             
             session.close()
             return img_buffer
             
         except Exception as e:
             logger.error(f"❌ Ошибка создания графика истории: {e}")
-            # Закрываем фигуру в случае ошибки
-            try:
-                plt.close('all')
-            except:
-                pass
             if 'session' in locals():
                 session.close()
             return None
 
     def create_total_balance_history_chart(self):
         """Создаем график общей динамики всех счетов в USD"""
+        setup_matplotlib()
         return finance_tracker_core.create_total_balance_history_chart()
 
 # Создаем экземпляр трекера
 finance_tracker = FinanceTrackerBotWithGraphs()
 
-# Обработчики команд
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
-    # Получаем текущие данные
-    accounts_data = finance_tracker.get_accounts_summary()
-    accounts_details = finance_tracker.get_accounts_details()
+def build_main_menu():
+    """Собирает текст и клавиатуру главного меню по снимку счетов"""
+    accounts_snapshot = finance_tracker.get_accounts_snapshot()
     
     # Получаем URL веб-приложения
     web_app_url = os.environ.get('WEB_APP_URL', 'https://finance-tracker-app-production.up.railway.app')
     
     welcome_text = "💰 **Finance Tracker Bot с графиками**\n\n"
     
-    if accounts_data['accounts_count'] > 0:
-        welcome_text += f"💵 **Общий баланс: ${accounts_data['total_balance_usd']:,.2f}**\n\n"
+    if accounts_snapshot['accounts_count'] > 0:
+        welcome_text += f"💵 **Общий баланс: ${accounts_snapshot['total_balance_usd']:,.2f}**\n\n"
         welcome_text += "🏦 **Ваши счета:**\n"
         
-        for account_id, account in accounts_details.items():
+        for account_id, account in accounts_snapshot['accounts'].items():
             welcome_text += f"• {account['name']}: {account['balance']:,.2f} {account['currency']} (≈ ${account['balance_usd']:,.2f})\n"
         
         welcome_text += "\n📱 **Отправьте скриншот** для обновления баланса!"
@@ -247,10 +498,54 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📊 Общая динамика", callback_data="show_total_history")],
         [InlineKeyboardButton("🌐 Открыть веб-приложение", url=web_app_url)]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    return welcome_text, InlineKeyboardMarkup(keyboard)
+
+def build_history_keyboard(accounts_details):
+    """Собирает клавиатуру выбора счета для истории"""
+    keyboard = []
+    for account_id, account in accounts_details.items():
+        keyboard.append([InlineKeyboardButton(
+            f"📊 {account['name']} ({account['currency']})", 
+            callback_data=f"history_{account_id}"
+        )])
+    
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard)
+
+# Обработчики команд
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /start"""
+    welcome_text, reply_markup = await asyncio.to_thread(build_main_menu)
     
     await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
 
+async def send_profile_report(update, chat_id, profile_id):
+    """Отправляет администратору отчет профиля документом"""
+    path = profile_path(profile_id)
+    try:
+        with open(path, 'rb') as report:
+            await update.get_bot().send_document(
+                chat_id=chat_id,
+                document=report,
+                filename=f"{profile_id}.txt",
+                caption=f"⏱ Профиль {profile_id}"
+            )
+    except Exception as e:
+        logger.error(f"❌ Не удалось отправить профиль {profile_id}: {e}")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /profile - профилировать следующее действие (только для администраторов)"""
+    if update.effective_user.id not in TELEGRAM_ADMIN_IDS:
+        await update.message.reply_text("⛔ Команда доступна только администраторам.")
+        return
+    
+    pending_profiles.add(update.effective_chat.id)
+    await update.message.reply_text(
+        "⏱ Следующее действие в этом чате будет профилировано.\n"
+        "Нажмите нужную кнопку или отправьте команду - отчет (cProfile и SQL) придет файлом."
+    )
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     help_text = """
@@ -285,46 +580,34 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /balance - показывает график"""
-    await update.message.reply_text("🔄 Создаю график баланса...")
+    keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
     
-    chart_buffer = finance_tracker.create_balance_chart()
+    sent = await send_chart(
+        context.bot,
+        update.effective_chat.id,
+        'balance_chart',
+        finance_tracker.create_balance_chart,
+        caption="График распределения активов\n\nОтправьте скриншот для обновления баланса!",
+        reply_markup=reply_markup,
+        before_render=lambda: update.message.reply_text("🔄 Создаю график баланса...")
+    )
     
-    if chart_buffer:
-        keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=chart_buffer,
-            caption="График распределения активов\n\nОтправьте скриншот для обновления баланса!",
-            reply_markup=reply_markup
-        )
-    else:
+    if not sent:
         await update.message.reply_text("📭 У вас пока нет счетов.\n\nОтправьте скриншот банковского приложения, чтобы создать первый счет!")
 
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /history"""
-    accounts_data = finance_tracker.get_accounts_summary()
+    accounts_snapshot = await asyncio.to_thread(finance_tracker.get_accounts_snapshot)
     
-    if accounts_data['accounts_count'] == 0:
+    if accounts_snapshot['accounts_count'] == 0:
         await update.message.reply_text("📭 У вас пока нет счетов.\n\nОтправьте скриншот банковского приложения, чтобы создать первый счет!")
         return
     
-    # Получаем детали по счетам
-    accounts_details = finance_tracker.get_accounts_details()
-    
     # Создаем список счетов для выбора
-    keyboard = []
-    for account_id, account in accounts_details.items():
-        keyboard.append([InlineKeyboardButton(
-            f"📊 {account['name']} ({account['currency']})", 
-            callback_data=f"history_{account_id}"
-        )])
-    
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = build_history_keyboard(accounts_snapshot['accounts'])
     
     await update.message.reply_text(
         "📊 **Выберите счет для просмотра истории:**",
@@ -332,70 +615,120 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+def format_ingest_reply(result):
+    """Собирает ответ на распознанный скриншот: текст и клавиатуру (или None)"""
+    if result['success']:
+        main_balance = result['main_balance']
+        account = result['account']
+        
+        success_text = f"✅ **Баланс обновлен!**\n\n"
+        success_text += f"🏦 **Счет:** {account['name']}\n"
+        success_text += f"💰 **Новый баланс:** {main_balance['value']} ({main_balance['currency']})\n"
+        success_text += f"💵 **В долларах:** ${account['balance_usd']:,.2f}\n"
+        
+        if result['change'] != 0:
+            change_emoji = "📈" if result['change'] > 0 else "📉"
+            change_text = f"+{result['change']:,.2f}" if result['change'] > 0 else f"{result['change']:,.2f}"
+            success_text += f"{change_emoji} **Изменение:** {change_text} {main_balance['currency']}\n"
+        
+        # Общий баланс посчитан сразу после записи (у задачи, закрытой за упавший воркер, его нет)
+        if result.get('total_balance_usd') is not None:
+            success_text += f"\n💰 **Общий баланс:** ${result['total_balance_usd']:,.2f}"
+        
+        keyboard = [
+            [InlineKeyboardButton("💰 Показать график", callback_data="show_balance_chart")],
+            [InlineKeyboardButton("📊 История", callback_data="show_history")]
+        ]
+        return success_text, InlineKeyboardMarkup(keyboard)
+    
+    if result.get('update_failed'):
+        return f"❌ Ошибка обновления баланса: {result['error']}", None
+    
+    error_text = f"❌ **Не удалось распознать баланс**\n\n"
+    error_text += f"🔍 **Распознанный текст:**\n"
+    
+    if result.get('text_lines'):
+        for i, line in enumerate(result['text_lines'][:5]):
+            if line.strip():
+                error_text += f"{i+1}. {line}\n"
+    
+    error_text += "\n💡 **Советы:**\n"
+    error_text += "• Убедитесь, что баланс четко виден\n"
+    error_text += "• Попробуйте другой ракурс\n"
+    error_text += "• Проверьте качество изображения"
+    
+    return error_text, None
+
+# Как часто и как долго бот ждет результат задачи из очереди (INGEST_MODE=queue)
+JOB_STATUS_POLL_INTERVAL = float(os.environ.get('JOB_STATUS_POLL_INTERVAL', '1'))
+JOB_STATUS_TIMEOUT = float(os.environ.get('JOB_STATUS_TIMEOUT', '300'))
+
+async def wait_for_job(job_id, processing_msg):
+    """Ждет завершения задачи распознавания и обновляет сообщение с ее результатом"""
+    deadline = asyncio.get_running_loop().time() + JOB_STATUS_TIMEOUT
+    
+    try:
+        while asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(JOB_STATUS_POLL_INTERVAL)
+            job = await asyncio.to_thread(finance_tracker.get_ingest_job, job_id)
+            
+            if job is None:
+                await processing_msg.edit_text(f"❌ Задача #{job_id} не найдена")
+                return
+            
+            if job['status'] in ('done', 'failed'):
+                reply_text, reply_markup = format_ingest_reply(job['result'])
+                await processing_msg.edit_text(reply_text, reply_markup=reply_markup, parse_mode='Markdown')
+                return
+            
+            if job['status'] == 'dead':
+                await processing_msg.edit_text(
+                    f"❌ Не удалось обработать скриншот после {job['attempts']} попыток: {job['last_error']}"
+                )
+                return
+        
+        await processing_msg.edit_text(f"⏳ Скриншот еще в очереди (задача #{job_id}). Баланс обновится автоматически.")
+    except Exception as e:
+        logger.error(f"❌ Ошибка ожидания задачи {job_id}: {e}")
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик фотографий"""
     try:
+        try:
+            await asyncio.to_thread(ocr_rate_limiter.hit, f'tg:{update.effective_user.id}')
+        except Throttled as e:
+            BOT_SCREENSHOTS_TOTAL.inc(result='throttled')
+            await update.message.reply_text(f"⏳ Слишком много скриншотов подряд, повторите через {e.retry_after} с")
+            return
+        
         photo = update.message.photo[-1]
         processing_msg = await update.message.reply_text("🔄 Обрабатываю скриншот...")
         
         file = await context.bot.get_file(photo.file_id)
-        image_content = await file.download_as_bytearray()
-        image_bytes = bytes(image_content)
+        # BytesIO отдает буфер в process_image без лишней копии (getvalue)
+        image_buffer = io.BytesIO()
+        await file.download_to_memory(out=image_buffer)
         
-        result = finance_tracker.process_image(image_bytes)
+        if finance_tracker.ingest_mode == 'queue':
+            # Распознавание сделает worker.py; здесь только ставим в очередь
+            job = await asyncio.to_thread(finance_tracker.enqueue_image, image_buffer, source='telegram')
+            if not job['success']:
+                BOT_SCREENSHOTS_TOTAL.inc(result='error')
+                await processing_msg.edit_text(f"❌ Ошибка постановки в очередь: {job['error']}")
+                return
+            
+            BOT_SCREENSHOTS_TOTAL.inc(result='queued')
+            await processing_msg.edit_text(f"📥 Скриншот в очереди (задача #{job['job_id']}), распознаю...")
+            context.application.create_task(wait_for_job(job['job_id'], processing_msg), update=update)
+            return
         
-        if result['success']:
-            # Обновляем баланс в базе данных
-            transaction_result = finance_tracker.update_account_balance_from_image(
-                result['main_balance'], 
-                result['full_text'],
-                source='telegram'
-            )
-            
-            if transaction_result['success']:
-                main_balance = result['main_balance']
-                account = transaction_result['account']
-                
-                success_text = f"✅ **Баланс обновлен!**\n\n"
-                success_text += f"🏦 **Счет:** {account['name']}\n"
-                success_text += f"💰 **Новый баланс:** {main_balance['value']} ({main_balance['currency']})\n"
-                success_text += f"💵 **В долларах:** ${account['balance_usd']:,.2f}\n"
-                
-                if transaction_result['change'] != 0:
-                    change_emoji = "📈" if transaction_result['change'] > 0 else "📉"
-                    change_text = f"+{transaction_result['change']:,.2f}" if transaction_result['change'] > 0 else f"{transaction_result['change']:,.2f}"
-                    success_text += f"{change_emoji} **Изменение:** {change_text} {main_balance['currency']}\n"
-                
-                # Получаем общий баланс
-                accounts_summary = finance_tracker.get_accounts_summary()
-                success_text += f"\n💰 **Общий баланс:** ${accounts_summary['total_balance_usd']:,.2f}"
-                
-                keyboard = [
-                    [InlineKeyboardButton("💰 Показать график", callback_data="show_balance_chart")],
-                    [InlineKeyboardButton("📊 История", callback_data="show_history")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await processing_msg.edit_text(success_text, reply_markup=reply_markup, parse_mode='Markdown')
-            else:
-                await processing_msg.edit_text(f"❌ Ошибка обновления баланса: {transaction_result['error']}", parse_mode='Markdown')
-        else:
-            error_text = f"❌ **Не удалось распознать баланс**\n\n"
-            error_text += f"🔍 **Распознанный текст:**\n"
-            
-            if result.get('text_lines'):
-                for i, line in enumerate(result['text_lines'][:5]):
-                    if line.strip():
-                        error_text += f"{i+1}. {line}\n"
-            
-            error_text += "\n💡 **Советы:**\n"
-            error_text += "• Убедитесь, что баланс четко виден\n"
-            error_text += "• Попробуйте другой ракурс\n"
-            error_text += "• Проверьте качество изображения"
-            
-            await processing_msg.edit_text(error_text, parse_mode='Markdown')
+        result = await run_heavy(finance_tracker.ingest_image, image_buffer, source='telegram')
+        BOT_SCREENSHOTS_TOTAL.inc(result='success' if result['success'] else 'failed')
+        reply_text, reply_markup = format_ingest_reply(result)
+        await processing_msg.edit_text(reply_text, reply_markup=reply_markup, parse_mode='Markdown')
             
     except Exception as e:
+        BOT_SCREENSHOTS_TOTAL.inc(result='error')
         logger.error(f"❌ Ошибка при обработке фото: {e}")
         await update.message.reply_text(f"❌ Произошла ошибка при обработке изображения: {str(e)}")
 
@@ -405,45 +738,34 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     if query.data == "show_balance_chart":
-        await query.edit_message_text("🔄 Создаю график баланса...")
+        keyboard = [
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
         
-        chart_buffer = finance_tracker.create_balance_chart()
+        sent = await send_chart(
+            context.bot,
+            query.from_user.id,
+            'balance_chart',
+            finance_tracker.create_balance_chart,
+            caption="💰 **График распределения активов**\n\nОтправьте скриншот для обновления баланса!",
+            reply_markup=reply_markup,
+            before_render=lambda: query.edit_message_text("🔄 Создаю график баланса...")
+        )
         
-        if chart_buffer:
-            keyboard = [
-                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await context.bot.send_photo(
-                chat_id=query.from_user.id,
-                photo=chart_buffer,
-                caption="💰 **График распределения активов**\n\nОтправьте скриншот для обновления баланса!",
-                reply_markup=reply_markup
-            )
+        if sent:
             await query.message.delete()
         else:
             await query.edit_message_text("📭 У вас пока нет счетов.\n\nОтправьте скриншот банковского приложения, чтобы создать первый счет!")
     
     elif query.data == "show_history":
-        accounts_data = finance_tracker.get_accounts_summary()
+        accounts_snapshot = await asyncio.to_thread(finance_tracker.get_accounts_snapshot)
         
-        if accounts_data['accounts_count'] == 0:
+        if accounts_snapshot['accounts_count'] == 0:
             await query.edit_message_text("📭 У вас пока нет счетов.\n\nОтправьте скриншот банковского приложения, чтобы создать первый счет!")
             return
         
-        # Получаем детали по счетам
-        accounts_details = finance_tracker.get_accounts_details()
-        
-        keyboard = []
-        for account_id, account in accounts_details.items():
-            keyboard.append([InlineKeyboardButton(
-                f"📊 {account['name']} ({account['currency']})", 
-                callback_data=f"history_{account_id}"
-            )])
-        
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = build_history_keyboard(accounts_snapshot['accounts'])
         
         await query.edit_message_text(
             "📊 **Выберите счет для просмотра истории:**",
@@ -452,99 +774,70 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif query.data == "show_total_history":
-        await query.edit_message_text("🔄 Создаю график общей динамики...")
+        keyboard = [
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
         
-        chart_buffer = finance_tracker.create_total_balance_history_chart()
+        sent = await send_chart(
+            context.bot,
+            query.from_user.id,
+            'total_history',
+            finance_tracker.create_total_balance_history_chart,
+            caption="📊 **Динамика общего баланса (все счета)**\n\nОтправьте скриншот для обновления баланса!",
+            reply_markup=reply_markup,
+            before_render=lambda: query.edit_message_text("🔄 Создаю график общей динамики...")
+        )
         
-        if chart_buffer:
-            keyboard = [
-                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await context.bot.send_photo(
-                chat_id=query.from_user.id,
-                photo=chart_buffer,
-                caption="📊 **Динамика общего баланса (все счета)**\n\nОтправьте скриншот для обновления баланса!",
-                reply_markup=reply_markup
-            )
+        if sent:
             await query.message.delete()
         else:
             await query.edit_message_text("❌ Не удалось создать график общей динамики.")
     
     elif query.data.startswith("history_"):
         account_id = query.data.replace("history_", "")
-        await query.edit_message_text("🔄 Создаю график истории...")
         
-        chart_buffer = finance_tracker.create_account_history_chart(account_id)
+        # Получаем информацию о счете
+        accounts_details = await asyncio.to_thread(finance_tracker.get_accounts_details)
+        account = accounts_details.get(int(account_id))
         
-        if chart_buffer:
-            # Получаем информацию о счете
-            accounts_details = finance_tracker.get_accounts_details()
-            account = accounts_details.get(int(account_id))
-            
-            if account:
-                caption = f"📊 **История счета: {account['name']}**\n\n"
-                caption += f"💰 Текущий баланс: {account['balance']:,.2f} {account['currency']}\n"
-                caption += f"💵 В долларах: ${account['balance_usd']:,.2f}"
-                
-                keyboard = [
-                    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await context.bot.send_photo(
-                    chat_id=query.from_user.id,
-                    photo=chart_buffer,
-                    caption=caption,
-                    reply_markup=reply_markup
-                )
-                await query.message.delete()
-            else:
-                await query.edit_message_text("❌ Счет не найден.")
+        if not account:
+            await query.edit_message_text("❌ Счет не найден.")
+            return
+        
+        caption = f"📊 **История счета: {account['name']}**\n\n"
+        caption += f"💰 Текущий баланс: {account['balance']:,.2f} {account['currency']}\n"
+        caption += f"💵 В долларах: ${account['balance_usd']:,.2f}"
+        
+        keyboard = [
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        sent = await send_chart(
+            context.bot,
+            query.from_user.id,
+            f'account_history:{int(account_id)}',
+            lambda: finance_tracker.create_account_history_chart(account_id),
+            caption=caption,
+            reply_markup=reply_markup,
+            before_render=lambda: query.edit_message_text("🔄 Создаю график истории...")
+        )
+        
+        if sent:
+            await query.message.delete()
         else:
             await query.edit_message_text("❌ Не удалось создать график истории для этого счета.")
     
     elif query.data == "back_to_main":
         # Получаем текущие данные для обновления главного меню
-        accounts_data = finance_tracker.get_accounts_summary()
-        accounts_details = finance_tracker.get_accounts_details()
-        
-        # Получаем URL веб-приложения
-        web_app_url = os.environ.get('WEB_APP_URL', 'https://finance-tracker-app-production.up.railway.app')
-        
-        welcome_text = "💰 **Finance Tracker Bot с графиками**\n\n"
-        
-        if accounts_data['accounts_count'] > 0:
-            welcome_text += f"💵 **Общий баланс: ${accounts_data['total_balance_usd']:,.2f}**\n\n"
-            welcome_text += "🏦 **Ваши счета:**\n"
-            
-            for account_id, account in accounts_details.items():
-                welcome_text += f"• {account['name']}: {account['balance']:,.2f} {account['currency']} (≈ ${account['balance_usd']:,.2f})\n"
-            
-            welcome_text += "\n📱 **Отправьте скриншот** для обновления баланса!"
-        else:
-            welcome_text += "📭 У вас пока нет счетов.\n\n📱 **Отправьте скриншот** банковского приложения, чтобы создать первый счет!"
-        
-        welcome_text += "\n\n📊 **Команды:**\n"
-        welcome_text += "/balance - показать график распределения\n"
-        welcome_text += "/history - показать историю счетов\n"
-        welcome_text += "/help - справка"
-        
-        # Добавляем ссылку на веб-приложение
-        welcome_text += f"\n\n🌐 **Веб-приложение:**\n"
-        welcome_text += f"Для красивого интерфейса с графиками: {web_app_url}"
+        welcome_text, reply_markup = await asyncio.to_thread(build_main_menu)
         
         # Отправляем новое сообщение вместо редактирования
         await context.bot.send_message(
             chat_id=query.from_user.id,
             text=welcome_text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("📊 История счетов", callback_data="show_history")],
-                [InlineKeyboardButton("📈 График распределения", callback_data="show_balance_chart")],
-                [InlineKeyboardButton("📊 Общая динамика", callback_data="show_total_history")],
-                [InlineKeyboardButton("🌐 Открыть веб-приложение", url=web_app_url)]
-            ]),
+            reply_markup=reply_markup,
             parse_mode='Markdown'
         )
         
@@ -571,6 +864,56 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"❌ Ошибка в error_handler: {e}")
 
+def build_application(bot_token):
+    """Создает Application с настройками из окружения"""
+    builder = Application.builder().token(bot_token)
+    
+    # Апдейты разных чатов обрабатываются параллельно, одного чата - строго по очереди
+    builder.concurrent_updates(ChatOrderedUpdateProcessor(
+        int(os.environ.get('TELEGRAM_CONCURRENT_UPDATES', '32'))
+    ))
+    
+    # Свой адрес Bot API, например локальный фейковый сервер для тестов
+    api_base_url = os.environ.get('TELEGRAM_API_BASE_URL')
+    if api_base_url:
+        builder.base_url(f"{api_base_url.rstrip('/')}/bot")
+        builder.base_file_url(f"{api_base_url.rstrip('/')}/file/bot")
+    
+    application = builder.build()
+    
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("balance", balance_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_error_handler(error_handler)
+    
+    return application
+
+def run_webhook(application, webhook_base_url):
+    """Запускает бота в режиме webhook: Telegram сам присылает апдейты на наш HTTP-сервер"""
+    url_path = os.environ.get('TELEGRAM_WEBHOOK_PATH', 'telegram').strip('/')
+    secret_token = os.environ.get('TELEGRAM_WEBHOOK_SECRET')
+    
+    if not secret_token:
+        # Без секрета любой, кто узнает URL, сможет слать поддельные апдейты
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("⚠️ TELEGRAM_WEBHOOK_SECRET не задан, сгенерирован временный секрет")
+    
+    logger.info(f"🚀 Запуск Telegram бота в режиме webhook: {webhook_base_url.rstrip('/')}/{url_path}")
+    application.run_webhook(
+        listen=os.environ.get('TELEGRAM_WEBHOOK_LISTEN', '0.0.0.0'),
+        port=int(os.environ.get('TELEGRAM_WEBHOOK_PORT', os.environ.get('PORT', '8443'))),
+        url_path=url_path,
+        webhook_url=f"{webhook_base_url.rstrip('/')}/{url_path}",
+        secret_token=secret_token,
+        max_connections=int(os.environ.get('TELEGRAM_WEBHOOK_MAX_CONNECTIONS', '40')),
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=False
+    )
+
 def main():
     """Основная функция"""
     bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
@@ -581,18 +924,20 @@ def main():
         print("Пример: export TELEGRAM_BOT_TOKEN='your_bot_token_here'")
         return
     
-    application = Application.builder().token(bot_token).build()
+    application = build_application(bot_token)
+    start_metrics_server()
+    # Записи веб-приложения и воркеров сбрасывают кэш снимка счетов бота
+    change_listener.start()
+    # Секции transactions на будущие месяцы нужны и без воркера (INGEST_MODE=sync)
+    start_partition_maintenance()
     
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("balance", balance_command))
-    application.add_handler(CommandHandler("history", history_command))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_error_handler(error_handler)
+    webhook_base_url = os.environ.get('TELEGRAM_WEBHOOK_URL')
+    if webhook_base_url:
+        run_webhook(application, webhook_base_url)
+        return
     
     logger.info("🚀 Запуск Telegram бота Finance Tracker с графиками...")
     application.run_polling()
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
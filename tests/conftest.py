@@ -0,0 +1,73 @@
+"""
+Общие фикстуры тестов Finance Tracker
+
+Тесты работают на временной SQLite (DATABASE_URL задается до импорта модулей
+приложения) с фиксированными курсами валют, без сети и без Google Vision.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+_database_dir = tempfile.mkdtemp(prefix='ft-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_database_dir, 'test.db')}"
+# Настройки по умолчанию, независимо от окружения разработчика
+os.environ['COALESCE_WINDOW_SECONDS'] = '0'
+# Данные seed.py лежат в 2023 году: окно истории не ограничиваем
+os.environ['HISTORY_DAYS'] = '0'
+os.environ['CACHE_BACKEND'] = 'memory'
+os.environ['RATE_LIMIT_BACKEND'] = 'memory'
+os.environ.pop('TELEGRAM_BOT_TOKEN', None)
+
+def pin_fixed_exchange_rates():
+    """Фиксированные курсы на год вперед: convert_to_usd не ходит в API"""
+    import models
+    models._exchange_rates_cache = models._get_fixed_rates()
+    models._exchange_rates_version = models._rates_version(models._exchange_rates_cache)
+    models._cache_expiry = datetime.utcnow() + timedelta(days=365)
+
+@pytest.fixture(scope='session', autouse=True)
+def database():
+    """Схема создается один раз на прогон"""
+    from models import create_tables
+    create_tables()
+    yield
+    shutil.rmtree(_database_dir, ignore_errors=True)
+
+@pytest.fixture(autouse=True)
+def clean_state(database):
+    """Каждый тест начинает с пустых таблиц, пустых кэшей и фиксированных курсов"""
+    from models import Base, get_engine
+    from cache import shared_cache, MemoryCache
+    from ratelimit import ocr_rate_limiter, MemoryBackend
+    from core import finance_tracker_core
+
+    pin_fixed_exchange_rates()
+    shared_cache.backend = MemoryCache()
+    ocr_rate_limiter.backend = MemoryBackend()
+    finance_tracker_core.invalidate_accounts_snapshot()
+    yield
+    with get_engine().begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    finance_tracker_core.invalidate_accounts_snapshot()
+
+@pytest.fixture
+def core():
+    from core import finance_tracker_core
+    return finance_tracker_core
+
+@pytest.fixture
+def write_balance(core):
+    """Записывает баланс счета так же, как после распознавания скриншота"""
+    def write(currency, value, text='Баланс', source='test'):
+        return core.update_account_balance_from_image({'currency': currency, 'value': value}, text, source)
+    return write
@@ -0,0 +1,73 @@
+"""Снимок счетов (user-026): один запрос, кэш и защита от правки по месту"""
+
+import pytest
+
+def test_snapshot_contains_totals_and_details(core, write_balance):
+    write_balance('USD', 100)
+    write_balance('EUR', 50)
+
+    snapshot = core.get_accounts_snapshot()
+
+    assert snapshot['accounts_count'] == 2
+    assert snapshot['total_balance_usd'] == pytest.approx(100 + 50 * 1.08)
+    by_currency = {account['currency']: account for account in snapshot['accounts'].values()}
+    assert by_currency['USD']['balance'] == 100
+    assert by_currency['EUR']['balance_usd'] == pytest.approx(54)
+    assert core.get_accounts_summary() == {
+        'total_balance_usd': snapshot['total_balance_usd'],
+        'accounts_count': 2
+    }
+
+def test_snapshot_is_cached_until_write(core, write_balance):
+    write_balance('USD', 100)
+    first = core.get_accounts_snapshot()
+
+    assert core.get_accounts_snapshot() is first
+
+    write_balance('USD', 120)
+    second = core.get_accounts_snapshot()
+    assert second is not first
+    assert [account['balance'] for account in second['accounts'].values()] == [120]
+
+def test_snapshot_is_read_only(core, write_balance):
+    write_balance('USD', 100)
+    snapshot = core.get_accounts_snapshot()
+    account_id = next(iter(snapshot['accounts']))
+
+    with pytest.raises(TypeError):
+        snapshot['total_balance_usd'] = 0
+    with pytest.raises(TypeError):
+        snapshot['accounts'][account_id] = {}
+    with pytest.raises(TypeError):
+        snapshot['accounts'][account_id]['balance'] = 0
+
+    cached = core.get_accounts_snapshot()
+    assert cached['total_balance_usd'] == 100
+    assert core.get_accounts_details()[account_id]['balance'] == 100
+
+def test_reader_does_not_store_snapshot_older_than_write(core, write_balance, monkeypatch):
+    write_balance('USD', 100)
+    core.invalidate_accounts_snapshot()
+    build = core._build_accounts_snapshot
+
+    def build_then_write(session):
+        # Чтение уже прошло, а запись успевает до того, как читатель положит снимок
+        snapshot = build(session)
+        monkeypatch.setattr(core, '_build_accounts_snapshot', build)
+        write_balance('USD', 200)
+        return snapshot
+    monkeypatch.setattr(core, '_build_accounts_snapshot', build_then_write)
+
+    assert core.get_accounts_snapshot()['total_balance_usd'] == 100
+    assert core.get_accounts_snapshot()['total_balance_usd'] == 200
+
+def test_write_succeeds_when_snapshot_rebuild_fails(core, write_balance, monkeypatch):
+    def broken(session):
+        raise RuntimeError('снимок не построился')
+    monkeypatch.setattr(core, '_build_accounts_snapshot', broken)
+
+    result = write_balance('USD', 100)
+
+    assert result['success'] and result['account']['balance'] == 100
+    monkeypatch.undo()
+    assert core.get_accounts_snapshot()['total_balance_usd'] == 100
@@ -0,0 +1,84 @@
+"""ASGI точка входа (user-027): Flask-запросы параллельно в пуле потоков, цикл событий свободен"""
+
+import asyncio
+import threading
+import time
+
+import httpx
+
+from app import app as flask_app
+import asgi
+from asgi import app as asgi_app
+from core import finance_tracker_core
+
+SLOW_SECONDS = 0.5
+
+async def _get(client, path):
+    started = time.perf_counter()
+    response = await client.get(path)
+    return response, time.perf_counter() - started
+
+async def _slow_requests_with_health(path, count):
+    transport = httpx.ASGITransport(app=asgi_app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+        slow = [asyncio.ensure_future(_get(client, path)) for _ in range(count)]
+        await asyncio.sleep(0.1)
+        health, health_seconds = await _get(client, '/health')
+        results = await asyncio.gather(*slow)
+    return results, health, health_seconds
+
+def test_sync_views_run_in_parallel(monkeypatch):
+    def slow_accounts():
+        time.sleep(SLOW_SECONDS)
+        return []
+    monkeypatch.setattr(finance_tracker_core, 'get_accounts_for_api', slow_accounts)
+
+    started = time.perf_counter()
+    results, health, health_seconds = asyncio.run(_slow_requests_with_health('/api/accounts', 4))
+    elapsed = time.perf_counter() - started
+
+    assert [response.status_code for response, _ in results] == [200] * 4
+    # В одном общем потоке четыре запроса заняли бы 4 * SLOW_SECONDS
+    assert elapsed < 2.5 * SLOW_SECONDS
+    assert health.status_code == 200
+    assert health_seconds < SLOW_SECONDS / 2
+
+def test_async_views_do_not_hold_the_event_loop(monkeypatch):
+    def slow_job(job_id):
+        time.sleep(SLOW_SECONDS)
+        return None
+    monkeypatch.setattr(finance_tracker_core, 'get_ingest_job', slow_job)
+
+    results, health, health_seconds = asyncio.run(_slow_requests_with_health('/api/jobs/1', 4))
+
+    assert [response.status_code for response, _ in results] == [404] * 4
+    assert health.status_code == 200
+    assert health_seconds < SLOW_SECONDS / 2
+
+def test_async_view_gets_own_loop_in_request_thread():
+    async def view():
+        return threading.get_ident(), asyncio.get_running_loop()
+
+    first_thread, first_loop = flask_app.async_to_sync(view)()
+    _, second_loop = flask_app.async_to_sync(view)()
+
+    assert first_thread == threading.get_ident()
+    assert first_loop is not second_loop
+
+def test_adapter_passes_request_and_streams_response():
+    def wsgi_app(environ, start_response):
+        start_response('201 Created', [('Content-Type', 'text/plain'), ('X-Seen', environ['HTTP_X_TAG'])])
+        yield environ['REQUEST_METHOD'].encode() + b' ' + environ['PATH_INFO'].encode('latin1')
+        yield b'?' + environ['QUERY_STRING'].encode() + b' ' + environ['wsgi.input'].read()
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=asgi.PooledWsgiApp(wsgi_app, 2))
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await client.post('/путь?a=1', content=b'x' * 100_000,
+                                     headers=[('X-Tag', 'one'), ('X-Tag', 'two')])
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 201
+    assert response.headers['x-seen'] == 'one,two'
+    assert response.content == 'POST /путь'.encode('utf-8') + b'?a=1 ' + b'x' * 100_000
@@ -0,0 +1,163 @@
+"""История общего баланса (user-043): один проход по колонкам вместо запроса на каждый день"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from models import create_session, convert_to_usd, get_engine, Account, Transaction
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import seed
+
+def reference_history():
+    """Прежний алгоритм: на конец каждого дня с транзакциями - последние балансы всех счетов"""
+    session = create_session()
+    try:
+        transactions = session.query(Transaction).order_by(Transaction.timestamp, Transaction.id).all()
+        accounts = session.query(Account).order_by(Account.id).all()
+        last_known_balances = {}
+        history = {}
+        for transaction in transactions:
+            last_known_balances[transaction.account_id] = transaction.new_balance
+            history[transaction.timestamp.strftime('%Y-%m-%d')] = round(sum(
+                convert_to_usd(last_known_balances.get(account.id, 0), account.currency) for account in accounts
+            ), 2)
+        return [{'date': date, 'balance': balance} for date, balance in sorted(history.items())]
+    finally:
+        session.close()
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(get_engine(), 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(get_engine(), 'before_cursor_execute', self)
+
+def test_history_matches_per_day_algorithm(core):
+    seed.seed_database(accounts=3, transactions=40, days=15, seed=5)
+
+    history = core.build_balance_history()
+
+    assert history['success']
+    assert history['history'] == reference_history()
+    assert len(history['history']) > 10
+
+def test_history_costs_one_query_regardless_of_days(core):
+    seed.seed_database(accounts=2, transactions=5, days=3)
+    with StatementCounter() as short:
+        core.build_balance_history()
+
+    seed.seed_database(accounts=2, transactions=200, days=100, reset=True)
+    with StatementCounter() as long:
+        core.build_balance_history()
+
+    assert long.count == short.count == 1
+
+def test_last_transaction_of_the_day_wins(core):
+    session = create_session()
+    try:
+        account = Account(name='Chase (USD)', currency='USD', balance=30, balance_usd=30)
+        session.add(account)
+        session.flush()
+        for timestamp, balance in [('2026-01-01 09:00', 10), ('2026-01-01 18:00', 20), ('2026-01-03 12:00', 30)]:
+            session.add(Transaction(account_id=account.id, timestamp=datetime.fromisoformat(timestamp),
+                                    old_balance=0, new_balance=balance, change=balance))
+        session.commit()
+    finally:
+        session.close()
+
+    assert core.build_balance_history()['history'] == [
+        {'date': '2026-01-01', 'balance': 20},
+        {'date': '2026-01-03', 'balance': 30},
+    ]
+
+def test_without_transactions_history_is_current_total(core):
+    assert core.build_balance_history() == {'success': True, 'history': []}
+
+    session = create_session()
+    try:
+        session.add(Account(name='Chase (USD)', currency='USD', balance=42, balance_usd=42))
+        session.commit()
+    finally:
+        session.close()
+
+    history = core.build_balance_history()['history']
+    assert [point['balance'] for point in history] == [42]
+
+def test_accounts_api_reports_last_transaction_time(core, write_balance):
+    write_balance('USD', 10)
+    write_balance('EUR', 10)
+
+    session = create_session()
+    try:
+        last = dict(session.query(Transaction.account_id, Transaction.timestamp).order_by(Transaction.id))
+    finally:
+        session.close()
+
+    accounts = core.get_accounts_for_api()['accounts']
+    assert {account['id']: account['last_updated'] for account in accounts} == {
+        account_id: timestamp.isoformat() for account_id, timestamp in last.items()
+    }
+
+def add_transactions(account, changes):
+    """Пишет транзакции счета: changes - [(время, старый баланс, новый баланс)]"""
+    session = create_session()
+    try:
+        for timestamp, old_balance, new_balance in changes:
+            session.add(Transaction(account_id=account, timestamp=timestamp, old_balance=old_balance,
+                                    new_balance=new_balance, change=new_balance - old_balance))
+        session.commit()
+    finally:
+        session.close()
+
+def test_history_window_starts_from_account_balances(core, monkeypatch):
+    monkeypatch.setattr(core, 'history_days', 30)
+    start = core.history_start()
+    session = create_session()
+    try:
+        usd = Account(name='Chase (USD)', currency='USD', balance=40, balance_usd=40)
+        idle = Account(name='Revolut (EUR)', currency='EUR', balance=7, balance_usd=convert_to_usd(7, 'EUR'))
+        session.add_all([usd, idle])
+        session.commit()
+        usd_id, idle_id = usd.id, idle.id
+    finally:
+        session.close()
+    add_transactions(usd_id, [(start - timedelta(days=5), 0, 10), (start + timedelta(days=1), 10, 25),
+                              (start + timedelta(days=3), 25, 40)])
+    add_transactions(idle_id, [(start - timedelta(days=60), 0, 7)])
+
+    with StatementCounter() as statements:
+        history = core.build_balance_history()['history']
+
+    # Транзакции до окна не читаются; в окне счета начинают с балансов на его начало
+    eur = convert_to_usd(7, 'EUR')
+    assert history == [
+        {'date': (start + timedelta(days=1)).strftime('%Y-%m-%d'), 'balance': round(25 + eur, 2)},
+        {'date': (start + timedelta(days=3)).strftime('%Y-%m-%d'), 'balance': round(40 + eur, 2)},
+    ]
+    assert statements.count == 2
+    assert core.balance_history_version().endswith(f"-d{start:%Y%m%d}")
+
+def test_history_window_without_transactions_is_current_total(core, monkeypatch):
+    monkeypatch.setattr(core, 'history_days', 30)
+    session = create_session()
+    try:
+        account = Account(name='Chase (USD)', currency='USD', balance=12, balance_usd=12)
+        session.add(account)
+        session.commit()
+        account_id = account.id
+    finally:
+        session.close()
+    add_transactions(account_id, [(core.history_start() - timedelta(days=1), 0, 12)])
+
+    assert [point['balance'] for point in core.build_balance_history()['history']] == [12]
@@ -0,0 +1,80 @@
+"""Генератор данных и набор бенчмарков (user-040)"""
+
+import json
+import os
+import sys
+from argparse import Namespace
+
+import pytest
+
+from models import create_session, Account, Transaction, OcrDocument
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import seed
+import run
+
+def fingerprint():
+    """Сгенерированные данные без id: счета и транзакции с хэшами текстов OCR"""
+    session = create_session()
+    try:
+        accounts = session.query(Account.currency, Account.name, Account.balance).order_by(Account.currency).all()
+        transactions = session.query(
+            Account.currency, Transaction.timestamp, Transaction.old_balance, Transaction.new_balance,
+            Transaction.source, OcrDocument.sha256
+        ).join(Account).join(OcrDocument).order_by(Account.currency, Transaction.timestamp).all()
+        return [tuple(row) for row in accounts], [tuple(row) for row in transactions]
+    finally:
+        session.close()
+
+def test_seed_is_deterministic():
+    summary = seed.seed_database(accounts=3, transactions=20, days=10, seed=7)
+    first = fingerprint()
+    seed.seed_database(accounts=3, transactions=20, days=10, seed=7, reset=True)
+    same = fingerprint()
+    seed.seed_database(accounts=3, transactions=20, days=10, seed=8, reset=True)
+
+    assert summary == {'accounts': 3, 'transactions': 60, 'days': 10, 'seed': 7}
+    assert first == same
+    assert fingerprint() != first
+
+def test_seeded_accounts_match_their_history():
+    seed.seed_database(accounts=2, transactions=15, days=5, chunk_size=4)
+
+    accounts, transactions = fingerprint()
+    assert [currency for currency, _, _ in accounts] == ['RUB', 'USD']
+    for currency, _, balance in accounts:
+        history = [row for row in transactions if row[0] == currency]
+        assert len(history) == 15
+        assert history[-1][3] == balance
+        # Каждая транзакция начинается с баланса предыдущей
+        assert all(previous[3] == current[2] for previous, current in zip(history, history[1:]))
+
+def test_seed_refuses_non_empty_database(write_balance):
+    write_balance('USD', 10)
+
+    with pytest.raises(RuntimeError):
+        seed.seed_database(accounts=1, transactions=1)
+    with pytest.raises(ValueError):
+        seed.seed_database(accounts=len(seed.CURRENCIES) + 1, reset=True)
+
+def test_ocr_corpus_is_recognizable(core):
+    corpus = seed.make_ocr_corpus(50, seed=3)
+
+    assert corpus == seed.make_ocr_corpus(50, seed=3)
+    assert all(core.extract_balance_from_text(lines) for lines in corpus)
+
+def test_suite_reports_timings_and_compares(tmp_path):
+    args = Namespace(accounts=2, transactions=20, days=5, seed=1, reset=False, repeat=2, corpus=5, skip_charts=True)
+
+    data, results = run.run_suite(args)
+
+    assert data['transactions'] == 40
+    names = [item['name'] for item in results]
+    assert 'get_accounts_for_api' in names and 'GET /api/accounts' in names
+    assert all(item['min_ms'] <= item['median_ms'] <= item['p95_ms'] for item in results)
+
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'results': [dict(item, median_ms=item['median_ms'] * 2 or 1) for item in results]}))
+    run.compare(results, str(baseline))
+    assert all('ratio' in item for item in results if item['median_ms'])
@@ -0,0 +1,242 @@
+"""Telegram-бот: режим webhook (user-033), порядок апдейтов по чатам (user-034), повтор графиков по file_id (user-035)"""
+
+import asyncio
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest
+
+import models
+import telegram_bot_with_graphs as bot
+
+BOT_TOKEN = '123456:TEST'
+
+class FakeApplication:
+    """Запоминает параметры run_webhook вместо запуска HTTP-сервера"""
+
+    def __init__(self):
+        self.webhook = None
+
+    def run_webhook(self, **kwargs):
+        self.webhook = kwargs
+
+@pytest.fixture
+def webhook_env(monkeypatch):
+    for name in ('TELEGRAM_WEBHOOK_PATH', 'TELEGRAM_WEBHOOK_SECRET', 'TELEGRAM_WEBHOOK_PORT',
+                 'TELEGRAM_WEBHOOK_MAX_CONNECTIONS', 'PORT'):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+def test_webhook_uses_configured_secret(webhook_env):
+    webhook_env.setenv('TELEGRAM_WEBHOOK_SECRET', 'configured-secret')
+    webhook_env.setenv('TELEGRAM_WEBHOOK_PATH', '/hooks/tg/')
+    webhook_env.setenv('TELEGRAM_WEBHOOK_MAX_CONNECTIONS', '80')
+    application = FakeApplication()
+
+    bot.run_webhook(application, 'https://bot.example.com/')
+
+    assert application.webhook['secret_token'] == 'configured-secret'
+    assert application.webhook['url_path'] == 'hooks/tg'
+    assert application.webhook['webhook_url'] == 'https://bot.example.com/hooks/tg'
+    assert application.webhook['max_connections'] == 80
+    assert application.webhook['port'] == 8443
+
+def test_webhook_without_secret_gets_random_one(webhook_env):
+    webhook_env.setenv('PORT', '8080')
+    first, second = FakeApplication(), FakeApplication()
+
+    bot.run_webhook(first, 'https://bot.example.com')
+    bot.run_webhook(second, 'https://bot.example.com')
+
+    assert len(first.webhook['secret_token']) >= 32
+    assert first.webhook['secret_token'] != second.webhook['secret_token']
+    assert first.webhook['port'] == 8080
+
+def test_application_uses_custom_bot_api_url(monkeypatch):
+    monkeypatch.setenv('TELEGRAM_API_BASE_URL', 'http://127.0.0.1:8081/')
+    monkeypatch.setenv('TELEGRAM_CONCURRENT_UPDATES', '4')
+
+    application = bot.build_application(BOT_TOKEN)
+
+    assert application.bot.base_url == f'http://127.0.0.1:8081/bot{BOT_TOKEN}'
+    assert isinstance(application.update_processor, bot.ChatOrderedUpdateProcessor)
+    assert application.update_processor.max_concurrent_updates == 4
+
+def chat_update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), message=None, callback_query=None)
+
+def test_updates_of_one_chat_run_in_order_and_chats_in_parallel():
+    finished = []
+
+    async def handle(name, seconds):
+        await asyncio.sleep(seconds)
+        finished.append(name)
+
+    async def scenario():
+        processor = bot.ChatOrderedUpdateProcessor(8)
+        await asyncio.gather(
+            processor.process_update(chat_update(1), handle('first in chat 1', 0.2)),
+            processor.process_update(chat_update(1), handle('second in chat 1', 0)),
+            processor.process_update(chat_update(2), handle('chat 2', 0.05)),
+        )
+        return processor
+
+    processor = asyncio.run(scenario())
+
+    assert finished == ['chat 2', 'first in chat 1', 'second in chat 1']
+    # Очереди чатов без апдейтов удаляются
+    assert processor._chat_queues == {}
+    # Лимит слотов - семафор PTB: финальный process_update не переопределен
+    assert 'process_update' not in bot.ChatOrderedUpdateProcessor.__dict__
+
+def test_failed_update_does_not_stop_chat_queue():
+    finished = []
+
+    async def fail():
+        raise RuntimeError('обработчик упал')
+
+    async def handle(name):
+        finished.append(name)
+
+    async def scenario():
+        processor = bot.ChatOrderedUpdateProcessor(2)
+        await asyncio.gather(
+            processor.process_update(chat_update(1), fail()),
+            processor.process_update(chat_update(1), handle('after failure')),
+        )
+
+    asyncio.run(scenario())
+
+    assert finished == ['after failure']
+
+def test_queued_chat_does_not_take_slots_of_other_chats():
+    started = []
+
+    async def handle(name, seconds):
+        started.append(name)
+        await asyncio.sleep(seconds)
+
+    async def scenario():
+        processor = bot.ChatOrderedUpdateProcessor(2)
+        busy_chat = [processor.process_update(chat_update(1), handle(f'chat 1 #{number}', 0.1)) for number in range(5)]
+        tasks = [asyncio.ensure_future(update) for update in busy_chat]
+        await asyncio.sleep(0.01)
+        other_started = time.perf_counter()
+        await processor.process_update(chat_update(2), handle('chat 2', 0))
+        other_seconds = time.perf_counter() - other_started
+        await asyncio.gather(*tasks)
+        return other_seconds
+
+    other_seconds = asyncio.run(scenario())
+
+    # Очередь чата 1 занимает один слот из двух: чат 2 не ждет ее целиком
+    assert other_seconds < 0.1
+    assert started.index('chat 2') == 1
+
+def test_heavy_work_is_limited(monkeypatch):
+    monkeypatch.setattr(bot, '_heavy_work_semaphore', None)
+    monkeypatch.setattr(bot, 'BOT_HEAVY_WORK_CONCURRENCY', 2)
+    running, peak = [], []
+    lock = threading.Lock()
+
+    def render():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return threading.current_thread().name
+
+    async def scenario():
+        return await asyncio.gather(*(bot.run_heavy(render) for _ in range(6)))
+
+    threads = asyncio.run(scenario())
+
+    assert max(peak) == 2
+    # Работа идет в потоках, а не в цикле событий
+    assert threading.main_thread().name not in threads
+
+class FakeBot:
+    """send_photo без Telegram: загруженному графику выдается новый file_id"""
+
+    def __init__(self):
+        self.sent = []
+        self.reject_file_ids = False
+
+    async def send_photo(self, chat_id, photo, caption=None, reply_markup=None):
+        if isinstance(photo, str) and self.reject_file_ids:
+            raise BadRequest('Wrong file identifier/http url specified')
+        self.sent.append(photo)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f'file-{len(self.sent)}')])
+
+@pytest.fixture
+def charts(monkeypatch):
+    """Версия данных графика задается тестом; render считает построения"""
+    monkeypatch.setattr(bot, '_heavy_work_semaphore', None)
+    state = SimpleNamespace(version='v1', renders=0)
+    monkeypatch.setattr(bot.finance_tracker, 'get_chart_version', lambda chart_key: state.version)
+
+    def render():
+        state.renders += 1
+        return io.BytesIO(f'png {state.version}'.encode())
+    state.render = render
+    return state
+
+def send(fake_bot, charts):
+    return asyncio.run(bot.send_chart(fake_bot, 1, 'balance', charts.render, 'Баланс'))
+
+def test_unchanged_chart_is_resent_by_file_id(charts):
+    fake_bot = FakeBot()
+
+    assert send(fake_bot, charts) and send(fake_bot, charts)
+
+    assert fake_bot.sent == [b'png v1', 'file-1']
+    assert charts.renders == 1
+
+def test_new_data_renders_chart_again(charts):
+    fake_bot = FakeBot()
+    send(fake_bot, charts)
+    charts.version = 'v2'
+
+    send(fake_bot, charts)
+    send(fake_bot, charts)
+
+    assert fake_bot.sent == [b'png v1', b'png v2', 'file-2']
+    assert charts.renders == 2
+
+def test_rejected_file_id_falls_back_to_upload(charts):
+    fake_bot = FakeBot()
+    send(fake_bot, charts)
+    fake_bot.reject_file_ids = True
+
+    assert send(fake_bot, charts)
+
+    # Картинка той же версии берется из кэша, заново не строится
+    assert fake_bot.sent == [b'png v1', b'png v1']
+    assert charts.renders == 1
+    assert bot.shared_cache.get('chart_file_id:balance') == ('v1', 'file-2')
+
+def test_account_chart_version_ignores_other_accounts(write_balance):
+    usd = write_balance('USD', 10)['account']['id']
+    version = bot.finance_tracker.get_chart_version(f'account_history:{usd}')
+    total_version = bot.finance_tracker.get_chart_version('total_history')
+
+    write_balance('EUR', 10)
+
+    assert bot.finance_tracker.get_chart_version(f'account_history:{usd}') == version
+    assert bot.finance_tracker.get_chart_version('total_history') != total_version
+
+def test_balance_chart_version_follows_revaluation(write_balance, monkeypatch):
+    write_balance('EUR', 10)
+    version = bot.finance_tracker.get_chart_version('balance_chart')
+
+    # Новый снимок курсов без пересчета balance_usd график распределения не меняет
+    monkeypatch.setattr(models, '_exchange_rates_version', 'other-rates')
+    assert bot.finance_tracker.get_chart_version('balance_chart') == version
+
+    models.revalue_accounts({'EUR': 2.0, 'USD': 1.0})
+    assert bot.finance_tracker.get_chart_version('balance_chart') != version
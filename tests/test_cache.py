@@ -0,0 +1,141 @@
+"""Общий кэш (user-049): бэкенды memory/sqlite/redis, фасад и общие курсы валют"""
+
+import os
+import socket
+import sys
+import time
+
+import pytest
+import requests
+
+import cache
+import models
+from cache import Cache, MemoryCache, RedisCache, SQLiteCache, create_backend
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import fake_redis
+
+VALUE = {'rates': {'EUR': 1.08}, 'chart': b'\x89PNG', 'version': ('tx1', 'fx2')}
+
+@pytest.fixture(scope='module')
+def redis_port():
+    server, port = fake_redis.start()
+    yield port
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def redis_url(redis_port):
+    RedisCache(f'redis://127.0.0.1:{redis_port}/0').command('FLUSHDB')
+    return f'redis://127.0.0.1:{redis_port}/0'
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryCache()
+    if request.param == 'sqlite':
+        return SQLiteCache(str(tmp_path / 'cache.db'))
+    return RedisCache(request.getfixturevalue('redis_url'))
+
+def test_backend_round_trip(backend):
+    assert backend.get('key') is None
+
+    backend.set('key', VALUE)
+    assert backend.get('key') == VALUE
+    backend.delete('key')
+    assert backend.get('key') is None
+
+def test_backend_ttl(backend):
+    backend.set('short', 1, ttl=0.05)
+    backend.set('long', 2, ttl=60)
+    time.sleep(0.1)
+
+    assert backend.get('short') is None
+    assert backend.get('long') == 2
+
+def test_memory_cache_evicts_least_recently_used():
+    backend = MemoryCache(max_entries=2)
+    backend.set('a', 1)
+    backend.set('b', 2)
+    backend.get('a')
+    backend.set('c', 3)
+
+    assert (backend.get('a'), backend.get('b'), backend.get('c')) == (1, None, 3)
+
+def test_sqlite_cache_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    SQLiteCache(path).set('history:tx1', VALUE)
+
+    assert SQLiteCache(path).get('history:tx1') == VALUE
+
+def test_redis_databases_are_separate(redis_url, redis_port):
+    first, second = RedisCache(redis_url), RedisCache(f'redis://:secret@127.0.0.1:{redis_port}/2')
+    first.set('key', 1)
+    second.set('key', 2)
+
+    assert (first.get('key'), second.get('key')) == (1, 2)
+
+def test_redis_reconnects_after_dropped_connection(redis_url):
+    backend = RedisCache(redis_url)
+    backend.set('key', 1)
+    backend._local.sock.shutdown(socket.SHUT_RDWR)
+
+    assert backend.get('key') == 1
+
+def test_create_backend():
+    assert isinstance(create_backend('memory'), MemoryCache)
+    assert isinstance(create_backend('redis://127.0.0.1:6390/1'), RedisCache)
+    with pytest.raises(ValueError):
+        create_backend('memcached://127.0.0.1')
+
+def test_facade_prefixes_keys_and_stores_selectively():
+    backend = MemoryCache()
+    facade = Cache(backend, prefix='test:')
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'success': len(calls) > 1}
+
+    assert facade.get_or_set('history:1', compute, store_if=lambda result: result['success']) == {'success': False}
+    assert facade.get_or_set('history:1', compute, store_if=lambda result: result['success']) == {'success': True}
+    assert facade.get_or_set('history:1', compute) == {'success': True}
+    assert len(calls) == 2
+    assert backend.get('test:history:1') == {'success': True}
+    assert facade.get_or_set('empty', lambda: None) is None
+    assert backend.get('test:empty') is None
+
+def test_unreachable_backend_is_a_miss():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    facade = Cache(RedisCache(f'redis://127.0.0.1:{port}/0', timeout=0.2))
+    errors = cache.CACHE_REQUESTS_TOTAL.value(namespace='chart', result='error')
+
+    facade.set('chart:1', b'png')
+    facade.delete('chart:1')
+    assert facade.get_or_set('chart:1', lambda: b'png') == b'png'
+    assert cache.CACHE_REQUESTS_TOTAL.value(namespace='chart', result='error') == errors + 1
+
+def test_rates_from_another_process_are_reused(monkeypatch):
+    def must_not_call(*args, **kwargs):
+        raise AssertionError('курсы есть в общем кэше - API не нужен')
+    monkeypatch.setattr(requests, 'get', must_not_call)
+    monkeypatch.setattr(models, '_revalue_in_background', lambda rates: None)
+    monkeypatch.setattr(models, '_cache_expiry', None)
+    models.shared_cache.set(models.RATES_CACHE_KEY, {
+        'rates': {'USD': 1.0, 'EUR': 2.0}, 'expires_at': time.time() + 60
+    })
+
+    assert models.convert_to_usd(10, 'EUR') == 20.0
+
+def test_fixed_fallback_rates_are_not_shared(monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise requests.ConnectionError('нет сети')
+    monkeypatch.setattr(requests, 'get', unavailable)
+
+    models._update_exchange_rates_cache(force=True)
+
+    assert models._exchange_rates_cache == models._get_fixed_rates()
+    assert models.shared_cache.get(models.RATES_CACHE_KEY) is None
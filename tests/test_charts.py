@@ -0,0 +1,89 @@
+"""График общей динамики (user-036): форматы, размер в пикселях и спарклайн"""
+
+import io
+from datetime import date, timedelta
+
+import pytest
+from PIL import Image
+
+from app import app as flask_app
+from core import finance_tracker_core
+
+HISTORY = [
+    {'date': (date(2026, 1, 1) + timedelta(days=day)).isoformat(), 'balance': 1000.0 + day * 10}
+    for day in range(30)
+]
+
+@pytest.fixture
+def history(monkeypatch):
+    """Тридцать дней истории без записей в БД; renders считает построения графика"""
+    renders = []
+    create_chart = finance_tracker_core.create_total_balance_history_chart
+
+    def counted(*args):
+        renders.append(args)
+        return create_chart(*args)
+    monkeypatch.setattr(finance_tracker_core, 'get_balance_history',
+                        lambda version=None: {'success': True, 'history': list(HISTORY)})
+    monkeypatch.setattr(finance_tracker_core, 'create_total_balance_history_chart', counted)
+    return renders
+
+@pytest.fixture
+def client():
+    return flask_app.test_client()
+
+def test_sparkline_is_downsampled_keeping_the_ends(history):
+    sparkline = finance_tracker_core.get_balance_sparkline(5)
+
+    assert sparkline['values'] == [1000.0, 1070.0, 1140.0, 1220.0, 1290.0]
+    assert (sparkline['start'], sparkline['end']) == ('2026-01-01', '2026-01-30')
+    assert (sparkline['min'], sparkline['max'], sparkline['current']) == (1000.0, 1290.0, 1290.0)
+    assert len(finance_tracker_core.get_balance_sparkline()['values']) == 30
+
+def test_sparkline_endpoint(client, history):
+    response = client.get('/api/charts/total_history?format=sparkline&width=10')
+
+    assert response.status_code == 200
+    assert len(response.get_json()['values']) == 10
+    assert history == []
+
+def test_png_has_requested_pixel_size(client, history):
+    response = client.get('/api/charts/total_history?format=png&width=600&height=300')
+
+    assert response.mimetype == 'image/png'
+    assert Image.open(io.BytesIO(response.data)).size == (600, 300)
+
+def test_webp_height_follows_width(client, history):
+    response = client.get('/api/charts/total_history?format=webp&width=300')
+
+    assert response.mimetype == 'image/webp'
+    image = Image.open(io.BytesIO(response.data))
+    assert image.format == 'WEBP'
+    assert image.size == (300, 200)
+
+def test_svg_keeps_text_as_text(client, history):
+    response = client.get('/api/charts/total_history?format=svg&width=600&height=400')
+
+    assert response.mimetype == 'image/svg+xml'
+    assert b'<svg' in response.data
+    assert 'Динамика общего баланса'.encode('utf-8') in response.data
+
+def test_same_chart_is_rendered_once(client, history):
+    for _ in range(2):
+        assert client.get('/api/charts/total_history?format=svg&width=300').status_code == 200
+    client.get('/api/charts/total_history?format=svg&width=400')
+
+    assert [args[1] for args in history] == [300, 400]
+
+@pytest.mark.parametrize('query', ['format=gif', 'width=50', 'width=abc', 'dpi=1000', 'format=png&height=5000'])
+def test_invalid_parameters_are_rejected(client, history, query):
+    response = client.get(f'/api/charts/total_history?{query}')
+
+    assert response.status_code == 400
+    assert not response.get_json()['success']
+    assert history == []
+
+def test_no_history_is_404(client):
+    response = client.get('/api/charts/total_history?format=svg')
+
+    assert response.status_code == 404
@@ -0,0 +1,102 @@
+"""Склейка частых записей баланса (user-047): отложенная запись последнего баланса валюты"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import telegram_bot_with_graphs as bot
+from models import create_session, Transaction
+
+def _transactions():
+    session = create_session()
+    try:
+        return session.query(Transaction.new_balance, Transaction.intermediate_values).order_by(Transaction.id).all()
+    finally:
+        session.close()
+
+@pytest.fixture
+def window(core, monkeypatch):
+    """Окно склейки больше времени теста: запись уходит в БД по flush_pending_writes"""
+    monkeypatch.setattr(core, '_coalesce_window', 60)
+    yield
+    core.flush_pending_writes()
+
+def test_without_window_every_write_is_a_transaction(core, write_balance):
+    assert core._coalesce_window == 0
+    write_balance('USD', 10)
+    write_balance('USD', 20)
+
+    assert [row.new_balance for row in _transactions()] == [10, 20]
+
+def test_one_chat_burst_becomes_one_transaction(core, write_balance, window, monkeypatch):
+    monkeypatch.setattr(bot, '_heavy_work_semaphore', None)
+    write_balance('USD', 5)
+    results = []
+
+    async def handle(value):
+        results.append(await bot.run_heavy(bot.finance_tracker.update_account_balance_from_image,
+                                           {'currency': 'USD', 'value': value}, 'Баланс'))
+
+    async def scenario():
+        # Скриншоты одного чата: бот обрабатывает их строго по очереди
+        processor = bot.ChatOrderedUpdateProcessor(4)
+        chat = SimpleNamespace(effective_chat=SimpleNamespace(id=1), message=None, callback_query=None)
+        await asyncio.gather(*(processor.process_update(chat, handle(value)) for value in (10, 20, 30, 40)))
+
+    asyncio.run(scenario())
+    assert len(_transactions()) == 1
+
+    core.flush_pending_writes()
+
+    rows = _transactions()
+    assert len(rows) == 2
+    assert rows[1].new_balance == 40
+    assert json.loads(rows[1].intermediate_values) == [10, 20, 30]
+    assert [result['change'] for result in results] == [5, 10, 10, 10]
+    assert all(result['pending'] for result in results)
+    assert core.get_accounts_snapshot()['total_balance_usd'] == 40
+
+def test_buffered_write_is_flushed_by_timer(core, write_balance, monkeypatch):
+    monkeypatch.setattr(core, '_coalesce_window', 0.05)
+    write_balance('USD', 5)
+
+    assert write_balance('USD', 10)['pending']
+    core._pending_writes['USD']['timer'].join()
+
+    assert [row.new_balance for row in _transactions()] == [5, 10]
+    assert core._pending_writes == {}
+
+def test_first_balance_of_currency_is_written_at_once(core, write_balance, window):
+    result = write_balance('USD', 10)
+
+    assert 'pending' not in result
+    assert [row.new_balance for row in _transactions()] == [10]
+
+def test_direct_write_takes_over_buffered_balance(core, write_balance, window):
+    write_balance('USD', 5)
+    write_balance('USD', 10)
+    written = []
+
+    # Запись с on_write (задача очереди) идет сразу и забирает отложенный баланс
+    result = core.update_account_balance_from_image(
+        {'currency': 'USD', 'value': 20}, 'Баланс', 'test', on_write=lambda session, result: written.append(result)
+    )
+
+    assert result['success'] and written
+    rows = _transactions()
+    assert [row.new_balance for row in rows] == [5, 20]
+    assert json.loads(rows[1].intermediate_values) == [10]
+    core.flush_pending_writes()
+    assert len(_transactions()) == 2
+
+def test_currencies_are_buffered_separately(core, write_balance, window):
+    write_balance('USD', 1)
+    write_balance('EUR', 2)
+    write_balance('USD', 3)
+    write_balance('EUR', 4)
+
+    core.flush_pending_writes()
+
+    assert sorted(row.new_balance for row in _transactions()) == [1, 2, 3, 4]
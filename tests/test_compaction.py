@@ -0,0 +1,144 @@
+"""Сжатие старой истории (user-045): план по дням счета и возобновляемый запуск пачками"""
+
+import os
+import sys
+from collections import namedtuple
+from datetime import date, datetime
+
+import pytest
+
+import compaction
+from models import create_session, Account, OcrDocument, SystemInfo, Transaction, TransactionCompaction
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import seed
+
+Row = namedtuple('Row', 'id account_id timestamp old_balance new_balance ocr_document_id')
+NOW = seed.TIMELINE_END
+
+def row(id, account_id, timestamp, old_balance, new_balance):
+    return Row(id, account_id, datetime.fromisoformat(timestamp), old_balance, new_balance, None)
+
+def test_plan_keeps_single_change_of_a_day():
+    assert compaction.plan_compaction([row(1, 1, '2024-01-01 10:00', 0, 5)]) == ([], [], [])
+
+def test_plan_collapses_day_into_last_transaction():
+    rows = [row(1, 1, '2024-01-01 09:00', 10, 12), row(2, 1, '2024-01-01 12:00', 12, 12),
+            row(3, 1, '2024-01-01 18:00', 12, 15), row(4, 1, '2024-01-02 10:00', 15, 20)]
+
+    delete_ids, updates, audits = compaction.plan_compaction(rows)
+
+    assert delete_ids == [1, 2]
+    assert updates == [{'id': 3, 'old_balance': 10, 'change': 5}]
+    assert audits == [{
+        'account_id': 1, 'day': date(2024, 1, 1), 'rows_before': 3, 'rows_after': 1,
+        'old_balance': 10, 'new_balance': 15, 'first_transaction_id': 1, 'last_transaction_id': 3
+    }]
+
+def test_plan_drops_days_without_net_change():
+    rows = [row(1, 1, '2024-01-01 09:00', 10, 12), row(2, 1, '2024-01-01 18:00', 12, 10),
+            row(3, 2, '2024-01-01 09:00', 7, 7)]
+
+    delete_ids, updates, audits = compaction.plan_compaction(rows)
+
+    assert sorted(delete_ids) == [1, 2, 3]
+    assert updates == []
+    assert [(audit['account_id'], audit['rows_after']) for audit in audits] == [(1, 0), (2, 0)]
+
+def history_rows():
+    session = create_session()
+    try:
+        return session.query(
+            Transaction.id, Transaction.account_id, Transaction.timestamp, Transaction.old_balance, Transaction.new_balance
+        ).order_by(Transaction.account_id, Transaction.timestamp, Transaction.id).all()
+    finally:
+        session.close()
+
+def count(model):
+    session = create_session()
+    try:
+        return session.query(model).count()
+    finally:
+        session.close()
+
+@pytest.fixture
+def seeded():
+    seed.seed_database(accounts=2, transactions=150, days=40, seed=3)
+    return history_rows()
+
+def test_compaction_keeps_history_and_balance_chains(core, seeded):
+    history = core.build_balance_history()['history']
+
+    totals = compaction.compact_history(retention_days=10, batch_days=7, now=NOW)
+
+    rows = history_rows()
+    assert totals['rows_deleted'] == len(seeded) - len(rows) > 0
+    assert totals['batches'] == 5
+    # Остаются только точки с изменениями, и их значения прежние
+    compacted = core.build_balance_history()['history']
+    assert all(point in history for point in compacted)
+    assert compacted[-1] == history[-1]
+    for previous, current in zip(rows, rows[1:]):
+        if previous.account_id == current.account_id:
+            assert current.old_balance == previous.new_balance
+    # Свежие дни не тронуты
+    recent = datetime(2023, 12, 22)
+    assert [r for r in rows if r.timestamp >= recent] == [r for r in seeded if r.timestamp >= recent]
+    assert count(TransactionCompaction) == totals['days_compacted']
+
+def test_orphaned_ocr_documents_are_removed(seeded):
+    totals = compaction.compact_history(retention_days=10, now=NOW)
+
+    session = create_session()
+    try:
+        referenced = session.query(Transaction.ocr_document_id).distinct().count()
+    finally:
+        session.close()
+    assert totals['documents_deleted'] > 0
+    assert count(OcrDocument) == referenced
+
+def test_dry_run_changes_nothing(seeded):
+    totals = compaction.compact_history(retention_days=10, now=NOW, dry_run=True)
+
+    assert totals['rows_deleted'] > 0
+    assert history_rows() == seeded
+    assert count(SystemInfo) == 0
+
+def test_rerun_resumes_at_cursor(seeded):
+    first = compaction.compact_history(retention_days=20, now=NOW)
+    session = create_session()
+    try:
+        assert compaction.get_cursor(session) == date(2023, 12, 12)
+    finally:
+        session.close()
+
+    second = compaction.compact_history(retention_days=10, batch_days=30, now=NOW)
+
+    assert first['compacted_until'] == '2023-12-12' and second['compacted_until'] == '2023-12-22'
+    # Второй запуск начал с курсора: одна пачка на десять новых дней
+    assert second['batches'] == 1
+    assert compaction.compact_history(retention_days=10, now=NOW)['batches'] == 0
+
+def test_compaction_refreshes_cached_history(core):
+    session = create_session()
+    try:
+        account = Account(name='Chase (USD)', currency='USD', balance=12, balance_usd=12)
+        session.add(account)
+        session.flush()
+        # Второй день - повторный скриншот без изменения баланса: сжатие его удалит
+        for timestamp, old_balance, new_balance in [('2023-11-01 10:00', 0, 12), ('2023-11-02 10:00', 12, 12),
+                                                    ('2023-12-30 10:00', 12, 12)]:
+            session.add(Transaction(account_id=account.id, timestamp=datetime.fromisoformat(timestamp),
+                                    old_balance=old_balance, new_balance=new_balance, change=new_balance - old_balance))
+        session.commit()
+    finally:
+        session.close()
+    data_version = core.get_data_version()
+    assert len(core.get_balance_history()['history']) == 3
+
+    compaction.compact_history(retention_days=10, now=NOW)
+
+    # Последний id транзакции тот же, но версия истории другая: кэш не отдает старую историю
+    assert core.get_data_version() == data_version
+    assert [point['date'] for point in core.get_balance_history()['history']] == ['2023-11-01', '2023-12-30']
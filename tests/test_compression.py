@@ -0,0 +1,98 @@
+"""Сжатие ответов и JSON на orjson (user-030)"""
+
+import gzip
+import io
+import json
+
+import brotli
+import pytest
+from flask.json.provider import DefaultJSONProvider
+
+import app as app_module
+from app import app as flask_app
+from core import finance_tracker_core
+
+OCR_TEXT_LINES = [f'Операция {number}: -{number},00 ₽' for number in range(120)]
+
+@pytest.fixture
+def client():
+    return flask_app.test_client()
+
+@pytest.fixture
+def accounts(write_balance):
+    # Достаточно счетов, чтобы ответ превысил COMPRESS_MIN_SIZE
+    for currency in ('USD', 'EUR', 'RUB', 'AED', 'IDR'):
+        write_balance(currency, 100)
+
+def test_gzip_when_brotli_is_not_accepted(client, accounts):
+    plain = client.get('/api/accounts')
+    response = client.get('/api/accounts', headers={'Accept-Encoding': 'gzip'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == plain.data
+    assert len(response.data) < len(plain.data)
+
+def test_brotli_is_preferred(client, accounts):
+    plain = client.get('/api/accounts')
+    response = client.get('/api/accounts', headers={'Accept-Encoding': 'gzip, br'})
+
+    assert response.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(response.data) == plain.data
+    assert response.get_etag()[0] == plain.get_etag()[0] + '-br'
+
+def test_without_accept_encoding_body_is_plain(client, accounts):
+    response = client.get('/api/accounts')
+
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json()['success']
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get('/health', headers={'Accept-Encoding': 'gzip, br'})
+
+    assert len(response.get_data()) < app_module.COMPRESS_MIN_SIZE
+    assert 'Content-Encoding' not in response.headers
+
+def test_streams_are_not_compressed(client, monkeypatch):
+    import events
+    monkeypatch.setattr(events.change_listener, 'start', lambda: None)
+
+    response = client.get('/api/stream', headers={'Accept-Encoding': 'gzip'}, buffered=False)
+    try:
+        assert 'Content-Encoding' not in response.headers
+        assert next(iter(response.response)) == b'retry: 5000\n\n'
+    finally:
+        response.close()
+
+def test_orjson_provider_matches_default_json():
+    payload = {'name': 'Счет', 'balance': 1.5, 'ids': [1, 2], 'empty': None}
+
+    with flask_app.app_context():
+        assert isinstance(flask_app.json, app_module.OrjsonProvider)
+        body = flask_app.json.response(payload).get_data()
+        default = DefaultJSONProvider(flask_app).dumps(payload)
+
+    # UTF-8 без \u-экранирования, но те же данные
+    assert 'Счет'.encode('utf-8') in body
+    assert json.loads(body) == json.loads(default)
+
+def test_include_text_false_drops_ocr_text(client, monkeypatch):
+    def process_image(image_content):
+        return {
+            'success': True,
+            'main_balance': {'value': 150.0, 'currency': 'USD', 'original_text': '$150.00'},
+            'full_text': '\n'.join(OCR_TEXT_LINES),
+            'text_lines': list(OCR_TEXT_LINES)
+        }
+    monkeypatch.setattr(finance_tracker_core, 'process_image', process_image)
+
+    def upload(include_text):
+        return client.post('/api/process_image', data={
+            'image': (io.BytesIO(b'png'), 's.png'), 'include_text': include_text
+        }).get_json()
+
+    full, short = upload('1'), upload('0')
+
+    assert full['text_lines'] == OCR_TEXT_LINES
+    assert 'text_lines' not in short and 'full_text' not in short
+    assert short['account']['balance'] == 150.0
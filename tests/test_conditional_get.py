@@ -0,0 +1,123 @@
+"""Условные GET (user-029): строгий ETag по версии данных и 304 до тяжелого запроса"""
+
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+import models
+from app import app as flask_app
+from core import finance_tracker_core
+
+@pytest.fixture
+def client():
+    return flask_app.test_client()
+
+@pytest.fixture
+def accounts_calls(monkeypatch):
+    """Считает вызовы тяжелой части /api/accounts"""
+    calls = []
+    get_accounts_for_api = finance_tracker_core.get_accounts_for_api
+
+    def counted():
+        calls.append(1)
+        return get_accounts_for_api()
+    monkeypatch.setattr(finance_tracker_core, 'get_accounts_for_api', counted)
+    return calls
+
+def etag_of(response):
+    etag, weak = response.get_etag()
+    assert etag and not weak
+    return etag
+
+def test_not_modified_skips_the_query(client, accounts_calls, write_balance):
+    write_balance('USD', 10)
+    response = client.get('/api/accounts')
+    etag = etag_of(response)
+
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    not_modified = client.get('/api/accounts', headers={'If-None-Match': f'"{etag}"'})
+
+    assert not_modified.status_code == 304
+    assert not_modified.data == b''
+    assert etag_of(not_modified) == etag
+    assert len(accounts_calls) == 1
+
+def test_write_changes_the_etag(client, write_balance):
+    write_balance('USD', 10)
+    etag = etag_of(client.get('/api/accounts'))
+    write_balance('USD', 20)
+
+    response = client.get('/api/accounts', headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 200
+    assert etag_of(response) != etag
+    assert response.get_json()['accounts'][0]['balance'] == 20
+
+def test_compressed_etag_is_accepted(client, write_balance):
+    # Тело больше порога сжатия
+    for currency in ('USD', 'EUR', 'RUB', 'AED', 'IDR'):
+        write_balance(currency, 100)
+    response = client.get('/api/accounts', headers={'Accept-Encoding': 'gzip'})
+    etag = etag_of(response)
+
+    assert etag.endswith('-gzip')
+    not_modified = client.get('/api/accounts', headers={'If-None-Match': f'"{etag}"', 'Accept-Encoding': 'gzip'})
+    assert not_modified.status_code == 304
+    # 304 подтверждает тот вариант, что лежит в кэше клиента
+    assert etag_of(not_modified) == etag
+
+def test_async_view_answers_not_modified(client, monkeypatch, write_balance):
+    write_balance('USD', 10)
+    etag = etag_of(client.get('/api/balance_history'))
+
+    def must_not_run(version=None):
+        raise AssertionError('история строится несмотря на совпавший ETag')
+    monkeypatch.setattr(finance_tracker_core, 'get_balance_history', must_not_run)
+
+    assert client.get('/api/balance_history', headers={'If-None-Match': f'"{etag}"'}).status_code == 304
+
+def test_history_etag_follows_exchange_rates(client, monkeypatch, write_balance):
+    write_balance('EUR', 10)
+    etag = etag_of(client.get('/api/balance_history'))
+
+    monkeypatch.setattr(models, '_exchange_rates_version', 'other-rates')
+    assert etag_of(client.get('/api/balance_history')) != etag
+
+def test_exchange_rates_may_be_cached(client):
+    response = client.get('/api/exchange_rates')
+
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'private, max-age=300'
+    assert etag_of(response) == f"api_exchange_rates-fx{models.get_exchange_rates_version()}"
+
+def test_failed_payload_gets_no_etag(client, monkeypatch):
+    monkeypatch.setattr(finance_tracker_core, 'get_accounts_for_api', lambda: {'success': False, 'error': 'БД недоступна'})
+
+    response = client.get('/api/accounts')
+
+    assert response.get_json()['success'] is False
+    assert response.get_etag() == (None, None)
+    assert 'private, no-cache' not in response.headers.get('Cache-Control', '')
+
+def test_exchange_rates_etag_does_not_wait_for_api(client, monkeypatch):
+    etag = etag_of(client.get('/api/exchange_rates'))
+    refreshes = []
+    def must_not_call(*args, **kwargs):
+        raise AssertionError('проверка ETag не должна ходить в API курсов')
+    monkeypatch.setattr(requests, 'get', must_not_call)
+    monkeypatch.setattr(models, '_refresh_rates_in_background', lambda: refreshes.append(1))
+    monkeypatch.setattr(models, '_cache_expiry', datetime.utcnow() - timedelta(seconds=1))
+
+    response = client.get('/api/exchange_rates', headers={'If-None-Match': f'"{etag}"'})
+
+    assert response.status_code == 304
+    # Устаревшие курсы обновляются в фоне
+    assert refreshes == [1]
+
+def test_exchange_rates_without_snapshot_get_no_etag(client, monkeypatch):
+    monkeypatch.setattr('app.get_cached_exchange_rates_version', lambda: None)
+
+    response = client.get('/api/exchange_rates', headers={'If-None-Match': '"api_exchange_rates-fxNone"'})
+
+    assert response.status_code == 200
+    assert response.get_etag() == (None, None)
@@ -0,0 +1,259 @@
+"""События об изменениях счетов: SSE-поток (user-028) и уведомления между процессами (user-050)"""
+
+import asyncio
+import os
+
+import pytest
+
+import events
+import models
+from app import app as flask_app
+from asgi import app as asgi_app
+from core import finance_tracker_core
+from models import create_session, get_last_change, notify_change
+
+OTHER_PID = os.getpid() + 1
+
+class StopPolling(Exception):
+    pass
+
+@pytest.fixture(autouse=True)
+def fresh_process_broker(monkeypatch):
+    """Брокер процесса еще ничего не отправлял, а подписки не запускают фоновый опрос БД"""
+    monkeypatch.setattr(events.event_broker, '_last_version', None)
+    # id транзакций в очищенных таблицах начинаются заново: свои версии прошлых тестов не нужны
+    monkeypatch.setattr(events.change_listener, '_own_versions', events.collections.deque(maxlen=events.OWN_VERSIONS_KEPT))
+    monkeypatch.setattr(events.change_listener, 'start', lambda: None)
+
+@pytest.fixture
+def broker(monkeypatch):
+    """Отдельный брокер со своим (не запущенным) слушателем и одним подписчиком"""
+    monkeypatch.setattr(events, 'change_listener', events.ChangeListener())
+    broker = events.EventBroker()
+    broker._subscribers.add(events.ThreadSubscription())
+    return broker
+
+@pytest.fixture
+def updates_since(monkeypatch):
+    """Подменяет чтение изменившихся счетов: запоминает since"""
+    calls = []
+
+    def get_account_updates_since(since, exclude_versions=()):
+        calls.append((since, sorted(exclude_versions)))
+        return {'type': 'accounts_update', 'version': since + 1, 'accounts': []}
+    monkeypatch.setattr(finance_tracker_core, 'get_account_updates_since', get_account_updates_since)
+    return calls
+
+def test_format_sse():
+    frame = events.format_sse({'type': 'accounts_update', 'version': 3, 'name': 'Счет'})
+
+    assert frame == 'event: accounts_update\ndata: {"type":"accounts_update","version":3,"name":"Счет"}\n\n'.encode('utf-8')
+
+def test_publish_skips_stale_versions(broker):
+    subscription = next(iter(broker._subscribers))
+
+    for version in (2, 1, 2, 3):
+        broker.publish({'version': version})
+    # События без версии (не о данных) не отбрасываются
+    broker.publish({'type': 'ping'})
+
+    received = [subscription.get(timeout=0) for _ in range(3)]
+    assert received == [{'version': 2}, {'version': 3}, {'type': 'ping'}]
+    assert subscription.queue.empty()
+
+def test_slow_subscriber_drops_events_beyond_queue_size(broker):
+    subscription = next(iter(broker._subscribers))
+
+    for version in range(1, events.SSE_QUEUE_SIZE + 10):
+        broker.publish({'version': version})
+    assert subscription.queue.qsize() == events.SSE_QUEUE_SIZE
+
+def test_balance_write_is_published(write_balance):
+    subscription = events.event_broker.subscribe()
+    try:
+        write_balance('USD', 10)
+        write_balance('EUR', 10)
+    finally:
+        events.event_broker.unsubscribe(subscription)
+
+    first, second = subscription.get(timeout=0), subscription.get(timeout=0)
+    assert first['type'] == 'accounts_update'
+    assert [account['currency'] for account in first['accounts']] == ['USD']
+    assert second['version'] > first['version']
+    assert second['total_balance_usd'] == 10 + 10 * models._get_fixed_rates()['EUR']
+
+def test_wsgi_stream_delivers_events():
+    client = flask_app.test_client()
+    response = client.get('/api/stream', buffered=False)
+    chunks = iter(response.response)
+
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['X-Accel-Buffering'] == 'no'
+    assert next(chunks) == b'retry: 5000\n\n'
+    events.event_broker.publish({'type': 'accounts_update', 'version': 1})
+    assert next(chunks) == events.format_sse({'type': 'accounts_update', 'version': 1})
+
+    response.close()
+    assert events.event_broker.subscribers_count() == 0
+
+def test_asgi_stream_delivers_events_until_disconnect():
+    event = {'type': 'accounts_update', 'version': 1}
+
+    async def scenario():
+        sent = []
+        disconnect = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 2:
+                # Подписка уже есть: событие уходит в поток
+                events.event_broker.publish(event)
+            elif len(sent) == 3:
+                disconnect.set()
+
+        scope = {'type': 'http', 'path': '/api/stream', 'method': 'GET', 'headers': []}
+        await asyncio.wait_for(asgi_app(scope, receive, send), 2)
+        return sent
+
+    sent = asyncio.run(scenario())
+
+    assert sent[0]['status'] == 200
+    assert (b'content-type', b'text/event-stream; charset=utf-8') in sent[0]['headers']
+    assert [message['body'] for message in sent[1:]] == [b'retry: 5000\n\n', events.format_sse(event)]
+    assert events.event_broker.subscribers_count() == 0
+
+def test_notify_change_is_visible_after_commit_only():
+    session = create_session()
+    try:
+        notify_change(session, {'version': 7, 'account_id': 1})
+        assert get_last_change() is None
+        session.commit()
+    finally:
+        session.close()
+
+    assert get_last_change() == {'version': 7, 'account_id': 1, 'pid': os.getpid()}
+
+def test_rolled_back_change_is_not_visible():
+    session = create_session()
+    try:
+        notify_change(session, {'version': 7, 'account_id': 1})
+        session.rollback()
+    finally:
+        session.close()
+
+    assert get_last_change() is None
+
+def test_balance_write_records_change(write_balance):
+    result = write_balance('USD', 10)
+
+    change = get_last_change()
+    assert change['account_id'] == result['account']['id']
+    assert change['pid'] == os.getpid()
+    assert change['version'] >= 1
+
+def poll(monkeypatch, listener, changes):
+    """Прогоняет _poll по списку последовательных значений строки изменений"""
+    changes = iter(changes)
+
+    def get_change():
+        change = next(changes, None)
+        if change is None:
+            raise StopPolling()
+        return change
+    monkeypatch.setattr(models, 'get_last_change', get_change)
+    monkeypatch.setattr(events.time, 'sleep', lambda seconds: None)
+    dispatched = []
+    listener.add_callback(dispatched.append)
+    with pytest.raises(StopPolling):
+        listener._poll()
+    return dispatched
+
+def test_poll_dispatches_advanced_versions(monkeypatch):
+    listener = events.ChangeListener()
+    listener.mark_own(2)
+    listener.mark_own(5)
+
+    dispatched = poll(monkeypatch, listener, [
+        {'version': 1, 'pid': OTHER_PID},
+        {'version': 2, 'pid': os.getpid()},
+        {'version': 3, 'pid': OTHER_PID},
+        {'version': 3, 'pid': OTHER_PID},
+        {'version': 5, 'pid': os.getpid()},
+    ])
+
+    # Первый опрос - пропущенное неизвестно; версия 2 целиком своя, 3 не менялась;
+    # перед своей пятой была чужая четвертая
+    assert dispatched == [
+        {},
+        {'version': 3, 'pid': OTHER_PID, 'since': 2},
+        {'version': 5, 'pid': os.getpid(), 'since': 3},
+    ]
+
+def test_poll_without_changes_row_reads_from_start(monkeypatch):
+    dispatched = poll(monkeypatch, events.ChangeListener(), [{}, {}, {'version': 4, 'pid': OTHER_PID}])
+
+    assert dispatched == [{}, {'version': 4, 'pid': OTHER_PID, 'since': 0}]
+
+def test_on_change_reads_since_listener_version(broker, updates_since):
+    broker._on_change({'version': 5, 'since': 3})
+    broker._on_change({'version': 9})
+
+    # Уведомление LISTEN без since - одна транзакция
+    assert updates_since == [(3, []), (8, [])]
+
+def test_on_change_excludes_only_own_versions(broker, updates_since):
+    events.change_listener.mark_own(2)
+    events.change_listener.mark_own(7)
+    broker.publish({'type': 'accounts_update', 'version': 7})
+
+    # Своя седьмая уже отправлена, но перед ней была чужая шестая
+    broker._on_change({'version': 7, 'since': 5})
+
+    assert updates_since == [(5, [7])]
+    assert len(broker._subscribers.pop().queue.queue) == 2
+
+def test_on_change_skips_versions_not_newer_than_since(broker, updates_since):
+    broker._on_change({'version': 4, 'since': 4})
+
+    assert updates_since == []
+
+def test_reconnect_reads_since_last_sent_version(broker, updates_since):
+    # Пропущенные изменения неизвестны, а отправленного еще не было - читать не от чего
+    broker._on_change({})
+    broker.publish({'type': 'accounts_update', 'version': 6})
+    broker._on_change({})
+
+    assert updates_since == [(6, [])]
+
+def test_on_change_without_subscribers_does_not_read(broker, updates_since):
+    broker._subscribers.clear()
+
+    broker._on_change({'version': 5})
+    assert updates_since == []
+
+def test_foreign_write_before_own_write_is_published(write_balance):
+    # Чужая запись - мимо core этого процесса: ее версия не отмечена как своя
+    session = create_session()
+    try:
+        models.upsert_account_balance(session, 'EUR', 'Европейский счет', 10, 10.8, 'bot', 'Баланс')
+        session.commit()
+    finally:
+        session.close()
+    subscription = events.ThreadSubscription()
+    events.event_broker._subscribers.add(subscription)
+    try:
+        own = write_balance('USD', 5)
+        version = finance_tracker_core.get_data_version()
+        # Опрос увидел только последнюю (свою) версию
+        events.event_broker._on_change({'version': version, 'pid': os.getpid(), 'since': 0})
+    finally:
+        events.event_broker._subscribers.discard(subscription)
+
+    own_event, foreign_event = subscription.queue.get_nowait(), subscription.queue.get_nowait()
+    assert [account['currency'] for account in own_event['accounts']] == ['USD']
+    assert [account['currency'] for account in foreign_event['accounts']] == ['EUR']
+    assert own['success'] and subscription.queue.empty()
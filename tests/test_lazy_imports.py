@@ -0,0 +1,62 @@
+"""Отложенная инициализация (user-037): тяжелые модули - при первом использовании и один раз"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import telegram_bot_with_graphs as bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_startup_does_not_import_matplotlib_or_vision():
+    code = (
+        "import sys, app, telegram_bot_with_graphs; "
+        "print(sorted(name for name in ('matplotlib', 'google.cloud.vision', 'requests') if name in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=ROOT, env=dict(os.environ), capture_output=True, text=True, check=True
+    ).stdout
+    assert output.strip().splitlines()[-1] == '[]'
+
+def test_matplotlib_is_configured_once_under_concurrency(monkeypatch):
+    import matplotlib
+    calls = []
+
+    def slow_use(backend):
+        calls.append(backend)
+        time.sleep(0.05)
+
+    monkeypatch.setattr(bot, '_matplotlib_configured', False)
+    monkeypatch.setattr(matplotlib, 'use', slow_use)
+
+    threads = [threading.Thread(target=bot.setup_matplotlib) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ['Agg']
+    assert bot._matplotlib_configured
+
+def test_vision_client_is_created_once(core, monkeypatch):
+    created = []
+
+    def init_vision_client():
+        created.append(threading.get_ident())
+        time.sleep(0.05)
+        return 'client'
+
+    monkeypatch.setattr(core, '_vision_client_ready', False)
+    monkeypatch.setattr(core, '_vision_client', None)
+    monkeypatch.setattr(core, '_init_vision_client', init_vision_client)
+
+    threads = [threading.Thread(target=lambda: core.vision_client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert core.vision_client == 'client'
+    assert len(created) == 1
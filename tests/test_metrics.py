@@ -0,0 +1,100 @@
+"""Метрики Prometheus (user-038): типы метрик, формат вывода и инструментирование"""
+
+import socket
+import urllib.request
+
+import pytest
+
+import metrics
+from app import app as flask_app
+from metrics import Counter, Gauge, Histogram, timed, render_metrics
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    """Метрики теста не остаются в реестре процесса"""
+    monkeypatch.setattr(metrics, '_registry', dict(metrics._registry))
+
+def test_counter_and_gauge_by_labels():
+    counter = Counter('test_events_total', 'События', ['kind'])
+    gauge = Gauge('test_queue_depth', 'Глубина очереди')
+
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    assert counter.value(kind='a') == 3
+    assert counter.value(kind='b') == 0
+    assert gauge.value() == 1
+    with pytest.raises(ValueError):
+        counter.inc(other='a')
+    with pytest.raises(ValueError):
+        Counter('test_events_total', 'Повторная регистрация')
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram('test_seconds', 'Длительность', ['route'], buckets=(0.1, 1.0))
+
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(value, route='/a"b')
+
+    lines = histogram.render()
+    assert lines == [
+        '# HELP test_seconds Длительность',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{route="/a\\"b",le="0.1"} 1',
+        'test_seconds_bucket{route="/a\\"b",le="1.0"} 3',
+        'test_seconds_bucket{route="/a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{route="/a\\"b"} 4.05',
+        'test_seconds_count{route="/a\\"b"} 4',
+    ]
+    assert histogram.snapshot(route='/a"b') == (4, 4.05)
+
+def test_timed_labels_by_function_name():
+    histogram = Histogram('test_method_seconds', 'Методы', ['method'])
+
+    @timed(histogram, name_label='method')
+    def load():
+        raise RuntimeError('ошибка тоже измеряется')
+
+    with pytest.raises(RuntimeError):
+        load()
+    assert histogram.snapshot(method='load')[0] == 1
+
+def test_web_requests_are_counted_by_route():
+    client = flask_app.test_client()
+    client.get('/api/jobs/12345')
+
+    response = client.get('/metrics')
+
+    assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+    body = response.get_data(as_text=True)
+    assert 'ft_http_requests_total{method="GET",endpoint="/api/jobs/<int:job_id>",status="404"}' in body
+    assert 'ft_http_request_seconds_count{endpoint="/api/jobs/<int:job_id>"}' in body
+
+def test_database_work_is_measured(core):
+    calls = metrics.DB_METHOD_SECONDS.snapshot(method='get_data_version')[0]
+    checkouts = metrics.DB_POOL_CHECKOUT_SECONDS.snapshot()[0]
+
+    core.get_data_version()
+
+    assert metrics.DB_METHOD_SECONDS.snapshot(method='get_data_version')[0] == calls + 1
+    assert metrics.DB_POOL_CHECKOUT_SECONDS.snapshot()[0] > checkouts
+
+def test_metrics_server_for_processes_without_web(monkeypatch):
+    monkeypatch.delenv('METRICS_PORT', raising=False)
+    assert metrics.start_metrics_server() is None
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = metrics.start_metrics_server(port, addr='127.0.0.1')
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            body = response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert body == render_metrics()
+    assert '# TYPE ft_db_method_seconds histogram' in body
@@ -0,0 +1,89 @@
+"""Миграции Alembic на SQLite: схема после head совпадает с моделями"""
+
+import os
+
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, text
+
+from models import Base, decode_ocr_text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def alembic_config():
+    config = Config(os.path.join(ROOT, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(ROOT, 'migrations'))
+    return config
+
+def schema_diff(url):
+    engine = create_engine(url)
+    try:
+        with engine.connect() as conn:
+            return compare_metadata(MigrationContext.configure(conn), Base.metadata)
+    finally:
+        engine.dispose()
+
+def test_head_matches_models(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'migrations.db'}"
+    monkeypatch.setenv('DATABASE_URL', url)
+
+    command.upgrade(alembic_config(), 'head')
+
+    assert schema_diff(url) == []
+
+def test_ocr_migration_moves_text_to_shared_documents(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'migrations.db'}"
+    monkeypatch.setenv('DATABASE_URL', url)
+    config = alembic_config()
+    command.upgrade(config, '003')
+    long_text = 'Баланс\n' * 50
+
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO accounts (id, name, currency, balance, balance_usd) VALUES (1, 'a', 'USD', 2, 2)"))
+        for transaction_id, original_text in enumerate([long_text, '$5', long_text, None], start=1):
+            conn.execute(text(
+                "INSERT INTO transactions (id, account_id, timestamp, new_balance, original_text) "
+                "VALUES (:id, 1, '2024-01-01 10:00:00', 1, :text)"
+            ), {'id': transaction_id, 'text': original_text})
+
+    command.upgrade(config, '004')
+    with engine.connect() as conn:
+        links = conn.execute(text("SELECT ocr_document_id FROM transactions ORDER BY id")).scalars().all()
+        documents = {row.id: decode_ocr_text(row.codec, row.content)
+                     for row in conn.execute(text("SELECT id, codec, content FROM ocr_documents"))}
+    # Одинаковые тексты - один документ, пустой текст - без документа
+    assert links[0] == links[2] and links[3] is None
+    assert [documents[link] for link in links[:3]] == [long_text, '$5', long_text]
+    assert len(documents) == 2
+
+    command.downgrade(config, '003')
+    with engine.connect() as conn:
+        texts = conn.execute(text("SELECT original_text FROM transactions ORDER BY id")).scalars().all()
+    engine.dispose()
+    assert texts == [long_text, '$5', long_text, None]
+
+def test_partition_migration_fills_missing_timestamps(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'migrations.db'}"
+    monkeypatch.setenv('DATABASE_URL', url)
+    config = alembic_config()
+    command.upgrade(config, '004')
+
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO accounts (id, name, currency, balance, balance_usd) VALUES (1, 'a', 'USD', 2, 2)"))
+        conn.execute(text("INSERT INTO transactions (id, account_id, timestamp, new_balance) VALUES (1, 1, '2024-01-01 10:00:00', 1)"))
+        conn.execute(text("INSERT INTO transactions (id, account_id, timestamp, new_balance) VALUES (2, 1, NULL, 2)"))
+
+    command.upgrade(config, '005')
+    with engine.connect() as conn:
+        timestamps = conn.execute(text("SELECT timestamp FROM transactions ORDER BY id")).scalars().all()
+    assert timestamps == ['2024-01-01 10:00:00', '2024-01-01 10:00:00']
+
+    # Откат возвращает nullable, повторный подъем снова проходит
+    command.downgrade(config, '004')
+    command.upgrade(config, 'head')
+    engine.dispose()
+    assert schema_diff(url) == []
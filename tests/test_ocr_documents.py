@@ -0,0 +1,69 @@
+"""Тексты OCR в ocr_documents (user-042): сжатие и дедупликация по sha256"""
+
+import hashlib
+
+import pytest
+from sqlalchemy.orm import joinedload
+
+import models
+from models import create_session, decode_ocr_text, encode_ocr_text, store_ocr_document, OcrDocument, Transaction
+
+LONG_TEXT = '\n'.join(['Сбербанк', 'Баланс', '250 000,00 ₽'] + ['Главная', 'Платежи', 'История'] * 20)
+
+def test_long_text_is_compressed():
+    document = encode_ocr_text(LONG_TEXT)
+
+    assert document['codec'] == ('zstd' if models.zstandard else 'zlib')
+    assert document['size'] == len(LONG_TEXT.encode('utf-8'))
+    assert len(document['content']) < document['size']
+    assert document['sha256'] == hashlib.sha256(LONG_TEXT.encode('utf-8')).hexdigest()
+    assert decode_ocr_text(document['codec'], document['content']) == LONG_TEXT
+
+def test_short_text_is_stored_as_is():
+    document = encode_ocr_text('$5')
+
+    assert document['codec'] == 'none'
+    assert decode_ocr_text('none', document['content']) == '$5'
+    assert encode_ocr_text('') is None and encode_ocr_text(None) is None
+
+def test_zstd_round_trip(monkeypatch):
+    pytest.importorskip('zstandard')
+    document = encode_ocr_text(LONG_TEXT)
+
+    assert document['codec'] == 'zstd'
+    assert decode_ocr_text('zstd', document['content']) == LONG_TEXT
+
+def test_zstd_text_without_zstandard_is_an_error(monkeypatch):
+    monkeypatch.setattr(models, 'zstandard', None)
+
+    assert encode_ocr_text(LONG_TEXT)['codec'] == 'zlib'
+    with pytest.raises(RuntimeError):
+        decode_ocr_text('zstd', b'...')
+    with pytest.raises(ValueError):
+        decode_ocr_text('lz4', b'...')
+
+def test_same_text_is_stored_once():
+    session = create_session()
+    try:
+        first = store_ocr_document(session, LONG_TEXT)
+        assert store_ocr_document(session, LONG_TEXT) == first
+        assert store_ocr_document(session, LONG_TEXT + '!') != first
+        assert store_ocr_document(session, '') is None
+        session.commit()
+        assert session.query(OcrDocument).count() == 2
+    finally:
+        session.close()
+
+def test_transactions_share_documents(write_balance):
+    write_balance('USD', 10, text=LONG_TEXT)
+    write_balance('USD', 20, text=LONG_TEXT)
+    write_balance('USD', 30, text='')
+
+    session = create_session()
+    try:
+        transactions = session.query(Transaction).options(joinedload(Transaction.ocr_document)).order_by(Transaction.id).all()
+        assert [transaction.original_text for transaction in transactions] == [LONG_TEXT, LONG_TEXT, None]
+        assert transactions[0].ocr_document_id == transactions[1].ocr_document_id
+        assert session.query(OcrDocument).count() == 1
+    finally:
+        session.close()
@@ -0,0 +1,89 @@
+"""Помесячные секции transactions (user-044): даты секций, список секций и выбор для архива"""
+
+from datetime import datetime
+
+import pytest
+
+from partitions import (
+    DEFAULT_PARTITION, add_months, archive_candidates, archive_partitions, ensure_partitions,
+    is_partitioned, list_partitions, month_start, partition_name
+)
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+class FakeConnection:
+    """Отвечает на запрос к pg_inherits заранее заданными строками (relname, reltuples)"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, statement, params=None):
+        self.queries.append((str(statement), params))
+        return FakeResult(self.rows)
+
+@pytest.mark.parametrize('month, count, expected', [
+    (datetime(2024, 1, 1), 1, datetime(2024, 2, 1)),
+    (datetime(2024, 12, 1), 1, datetime(2025, 1, 1)),
+    (datetime(2024, 1, 1), -1, datetime(2023, 12, 1)),
+    (datetime(2024, 3, 1), -24, datetime(2022, 3, 1)),
+    (datetime(2024, 11, 1), 14, datetime(2026, 1, 1)),
+    (datetime(2024, 5, 1), 0, datetime(2024, 5, 1)),
+])
+def test_add_months(month, count, expected):
+    assert add_months(month, count) == expected
+
+def test_month_start_and_partition_name():
+    assert month_start(datetime(2024, 2, 29, 23, 59)) == datetime(2024, 2, 1)
+    assert partition_name(datetime(2024, 2, 1)) == 'transactions_2024_02'
+
+def test_list_partitions_parses_names_and_sorts():
+    conn = FakeConnection([
+        ('transactions_2024_03', 120.0),
+        (DEFAULT_PARTITION, 3.0),
+        ('transactions_2023_12', -1.0),
+        ('transactions_2024_01', 50.0),
+    ])
+
+    partitions = list_partitions(conn)
+
+    assert [partition['name'] for partition in partitions] == [
+        'transactions_2023_12', 'transactions_2024_01', 'transactions_2024_03', DEFAULT_PARTITION
+    ]
+    assert partitions[0] == {
+        'name': 'transactions_2023_12',
+        'start': datetime(2023, 12, 1),
+        'end': datetime(2024, 1, 1),
+        # reltuples = -1 у никогда не анализированной таблицы
+        'rows': 0
+    }
+    assert partitions[-1]['start'] is None and partitions[-1]['end'] is None
+    assert conn.queries[0][1] == {'table': 'transactions'}
+
+def test_archive_candidates_keep_recent_months_and_default():
+    partitions = list_partitions(FakeConnection([
+        ('transactions_2022_01', 1.0),
+        ('transactions_2022_02', 1.0),
+        ('transactions_2022_03', 1.0),
+        ('transactions_2024_03', 1.0),
+        (DEFAULT_PARTITION, 1.0),
+    ]))
+
+    # 2024-03-15 минус 24 месяца - 2022-03-01: архивируются секции, закончившиеся до этой даты
+    assert archive_candidates(partitions, 24, datetime(2024, 3, 15)) == ['transactions_2022_01', 'transactions_2022_02']
+    assert archive_candidates(partitions, 0, datetime(2024, 3, 15)) == [
+        'transactions_2022_01', 'transactions_2022_02', 'transactions_2022_03'
+    ]
+    assert archive_candidates([], 24, datetime(2024, 3, 15)) == []
+
+def test_functions_do_nothing_on_sqlite():
+    from models import get_engine
+    with get_engine().connect() as conn:
+        assert not is_partitioned(conn)
+    assert ensure_partitions() == []
+    assert archive_partitions(dry_run=True) == []
@@ -0,0 +1,197 @@
+"""Секционирование transactions на настоящей PostgreSQL (user-044): миграция 005 и partitions.py,
+и сжатие истории (user-045) при параллельной записи
+
+Нужен сервер PostgreSQL: TEST_POSTGRES_URL - адрес базы, в которой можно создавать
+и удалять базы, например postgresql://postgres@localhost/postgres. Без переменной
+тесты пропускаются.
+"""
+
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from alembic import command
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+
+import compaction
+import models
+import partitions
+from partitions import add_months, month_start, partition_name
+from test_migrations import alembic_config
+
+TEST_POSTGRES_URL = os.environ.get('TEST_POSTGRES_URL')
+
+pytestmark = pytest.mark.skipif(not TEST_POSTGRES_URL, reason='нужна PostgreSQL: TEST_POSTGRES_URL')
+
+@pytest.fixture
+def postgres_url(monkeypatch):
+    """Отдельная пустая база на тест; models работает с ней вместо SQLite"""
+    admin = create_engine(TEST_POSTGRES_URL, isolation_level='AUTOCOMMIT')
+    name = f"ft_test_{uuid.uuid4().hex[:12]}"
+    with admin.connect() as conn:
+        conn.execute(text(f'CREATE DATABASE "{name}"'))
+    url = make_url(TEST_POSTGRES_URL).set(database=name).render_as_string(hide_password=False)
+
+    monkeypatch.setenv('DATABASE_URL', url)
+    monkeypatch.setattr(models, '_engine', None)
+    monkeypatch.setattr(models, '_session_factory', None)
+    yield url
+
+    if models._engine is not None:
+        models._engine.dispose()
+    with admin.connect() as conn:
+        conn.execute(text(f'DROP DATABASE "{name}" WITH (FORCE)'))
+    admin.dispose()
+
+def rows(sql, **params):
+    with models.get_engine().connect() as conn:
+        return conn.execute(text(sql), params).all()
+
+def add_transactions(account_id, timestamps):
+    with models.get_engine().begin() as conn:
+        for timestamp in timestamps:
+            conn.execute(text(
+                "INSERT INTO transactions (account_id, timestamp, old_balance, new_balance, change) "
+                "VALUES (:account_id, :timestamp, 0, 1, 1)"
+            ), {'account_id': account_id, 'timestamp': timestamp})
+
+def add_account(currency='USD', balance=1):
+    with models.get_engine().begin() as conn:
+        return conn.execute(text(
+            "INSERT INTO accounts (name, currency, balance, balance_usd) VALUES (:name, :currency, :balance, :balance) "
+            "RETURNING id"
+        ), {'name': f'Счет {currency}', 'currency': currency, 'balance': balance}).scalar()
+
+def test_migration_005_moves_rows_into_monthly_partitions(postgres_url):
+    config = alembic_config()
+    command.upgrade(config, '004')
+    account_id = add_account()
+    add_transactions(account_id, [datetime(2024, 1, 5), datetime(2024, 3, 10), None, datetime(2024, 3, 12)])
+    before = rows("SELECT id, account_id, new_balance FROM transactions ORDER BY id")
+
+    command.upgrade(config, 'head')
+
+    with models.get_engine().connect() as conn:
+        assert partitions.is_partitioned(conn)
+        names = [partition['name'] for partition in partitions.list_partitions(conn)]
+    current = month_start(datetime.utcnow())
+    assert names[0] == 'transactions_2024_01'
+    assert partition_name(add_months(current, 3)) in names and names[-1] == 'transactions_default'
+    assert rows("SELECT id, account_id, new_balance FROM transactions ORDER BY id") == before
+    # Строка без времени получила время предыдущей транзакции и лежит в ее секции
+    assert rows("SELECT timestamp FROM transactions_2024_03 ORDER BY id") == [
+        (datetime(2024, 3, 10),), (datetime(2024, 3, 10),), (datetime(2024, 3, 12),)
+    ]
+
+    # Последовательность id перешла к новой таблице
+    session = models.create_session()
+    try:
+        result = models.upsert_account_balance(session, 'USD', 'Счет USD', 5, 5, 'test', 'Баланс')
+        session.commit()
+    finally:
+        session.close()
+    assert result['transaction_id'] > before[-1].id
+    assert rows("SELECT count(*) FROM transactions_default") == [(0,)]
+
+    command.downgrade(config, '004')
+    with models.get_engine().connect() as conn:
+        assert not partitions.is_partitioned(conn)
+    assert rows("SELECT count(*) FROM transactions") == [(len(before) + 1,)]
+    command.upgrade(config, 'head')
+    assert rows("SELECT count(*) FROM transactions") == [(len(before) + 1,)]
+
+def test_ensure_partitions_moves_rows_out_of_default(postgres_url):
+    command.upgrade(alembic_config(), 'head')
+    account_id = add_account()
+    future = add_months(month_start(datetime.utcnow()), 8) + timedelta(days=2)
+    add_transactions(account_id, [future])
+    assert rows("SELECT count(*) FROM transactions_default") == [(1,)]
+
+    created = partitions.ensure_partitions(months_ahead=8)
+
+    assert created[-1] == partition_name(month_start(future)) and len(created) == 5
+    assert rows(f"SELECT count(*) FROM {created[-1]}") == [(1,)]
+    assert rows("SELECT count(*) FROM transactions_default") == [(0,)]
+    assert partitions.ensure_partitions(months_ahead=8) == []
+
+def test_archive_and_restore_round_trip(postgres_url, tmp_path):
+    command.upgrade(alembic_config(), 'head')
+    account_id = add_account()
+    add_transactions(account_id, [datetime(2020, 1, 3), datetime(2020, 1, 20), datetime.utcnow()])
+    partitions.ensure_partitions(months_ahead=0, now=datetime(2020, 1, 1))
+    old = rows("SELECT id, timestamp FROM transactions_2020_01 ORDER BY id")
+    assert len(old) == 2
+
+    archived = partitions.archive_partitions(older_than_months=24, directory=str(tmp_path))
+
+    assert archived == [str(tmp_path / 'transactions_2020_01.csv.gz')]
+    assert rows("SELECT count(*) FROM transactions") == [(1,)]
+
+    assert partitions.restore_partition(archived[0]) == 'transactions_2020_01'
+    assert rows("SELECT id, timestamp FROM transactions_2020_01 ORDER BY id") == old
+    assert rows("SELECT count(*) FROM transactions") == [(3,)]
+
+def test_windowed_history_reads_only_recent_partitions(postgres_url, core, monkeypatch):
+    command.upgrade(alembic_config(), 'head')
+    current = month_start(datetime.utcnow())
+    partitions.ensure_partitions(months_ahead=14, now=add_months(current, -12))
+    account_id = add_account(balance=1)
+    add_transactions(account_id, [add_months(current, -11), add_months(current, -6), datetime.utcnow()])
+    monkeypatch.setattr(core, 'history_days', 30)
+
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(models.get_engine(), 'before_cursor_execute', capture)
+    try:
+        history = core.build_balance_history()['history']
+    finally:
+        event.remove(models.get_engine(), 'before_cursor_execute', capture)
+
+    assert [point['balance'] for point in history] == [1]
+    statement, parameters = next(
+        (statement, parameters) for statement, parameters in statements if 'transactions.new_balance' in statement
+    )
+    with models.get_engine().connect() as conn:
+        plan = '\n'.join(conn.exec_driver_sql(f"EXPLAIN {statement}", parameters).scalars())
+    # Секции старше окна отсечены планировщиком
+    assert partition_name(current) in plan
+    assert partition_name(add_months(current, -6)) not in plan
+    assert partition_name(add_months(current, -11)) not in plan
+
+def test_compaction_keeps_document_reused_by_concurrent_write(postgres_url):
+    command.upgrade(alembic_config(), 'head')
+    account_id = add_account()
+    session = models.create_session()
+    try:
+        document_id = models.store_ocr_document(session, 'Баланс 1')
+        for timestamp, balance in [(datetime(2024, 1, 1, 9), 1), (datetime(2024, 1, 1, 18), 2)]:
+            session.add(models.Transaction(account_id=account_id, timestamp=timestamp, old_balance=balance - 1,
+                                           new_balance=balance, change=1,
+                                           ocr_document_id=document_id if balance == 1 else None))
+        session.commit()
+    finally:
+        session.close()
+
+    # Запись баланса уже нашла документ по sha256, но еще не закоммитила транзакцию
+    writer = models.create_session()
+    assert models.store_ocr_document(writer, 'Баланс 1') == document_id
+    totals = {}
+    compactor = threading.Thread(target=lambda: totals.update(
+        compaction.compact_history(retention_days=10, now=datetime(2024, 2, 1))
+    ))
+    compactor.start()
+    compactor.join(0.5)
+    assert compactor.is_alive()
+
+    writer.add(models.Transaction(account_id=account_id, timestamp=datetime.utcnow(), old_balance=2,
+                                  new_balance=3, change=1, ocr_document_id=document_id))
+    writer.commit()
+    writer.close()
+    compactor.join(10)
+
+    assert totals['rows_deleted'] == 1 and totals['documents_deleted'] == 0
+    assert rows("SELECT id FROM ocr_documents") == [(document_id,)]
@@ -0,0 +1,112 @@
+"""Профилирование по требованию (user-039): веб-запросы по токену и апдейты бота по /profile"""
+
+import asyncio
+import pstats
+from types import SimpleNamespace
+
+import pytest
+
+import app as app_module
+import profiling
+import telegram_bot_with_graphs as bot
+from app import app as flask_app
+
+TOKEN = 'profile-secret'
+
+@pytest.fixture(autouse=True)
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(app_module, 'PROFILE_TOKEN', TOKEN)
+    return tmp_path
+
+@pytest.fixture
+def client():
+    return flask_app.test_client()
+
+def test_requests_without_token_are_not_profiled(client):
+    assert 'X-Profile-Id' not in client.get('/api/accounts').headers
+    assert 'X-Profile-Id' not in client.get('/api/accounts', headers={'X-Profile': 'wrong'}).headers
+    assert client.get('/api/profiles').status_code == 403
+    assert profiling.list_profiles() == []
+
+def test_profiled_request_records_sql_and_functions(client, write_balance):
+    write_balance('USD', 10)
+
+    response = client.get(f'/api/accounts?profile={TOKEN}')
+
+    profile_id = response.headers['X-Profile-Id']
+    assert response.headers['X-Profile-Url'] == f'/api/profiles/{profile_id}'
+    assert client.get('/api/profiles', headers={'X-Profile': TOKEN}).get_json()['profiles'] == [profile_id]
+    report = client.get(f'/api/profiles/{profile_id}', headers={'X-Profile': TOKEN}).get_data(as_text=True)
+    assert report.startswith('Профиль: GET /api/accounts')
+    assert 'FROM accounts' in report
+    assert 'get_accounts_for_api' in report
+
+def test_work_in_blocking_pool_is_profiled(client, write_balance):
+    write_balance('USD', 10)
+
+    profile_id = client.get('/api/balance_history', headers={'X-Profile': TOKEN}).headers['X-Profile-Id']
+
+    report = open(profiling.profile_path(profile_id), encoding='utf-8').read()
+    # История строится в потоке blocking_executor, а не в потоке запроса
+    assert 'build_balance_history' in report
+    assert 'FROM transactions' in report
+
+def test_pstats_download(client, profile_dir):
+    profile_id = client.get('/api/accounts', headers={'X-Profile': TOKEN}).headers['X-Profile-Id']
+
+    response = client.get(f'/api/profiles/{profile_id}?format=prof', headers={'X-Profile': TOKEN})
+
+    assert response.status_code == 200
+    downloaded = profile_dir / 'downloaded.prof'
+    downloaded.write_bytes(response.data)
+    assert pstats.Stats(str(downloaded)).total_calls > 0
+
+def test_unknown_or_unsafe_profile_id(client):
+    assert profiling.profile_path('../etc/passwd') is None
+    assert profiling.profile_path('missing', kind='py') is None
+    assert client.get('/api/profiles/missing', headers={'X-Profile': TOKEN}).status_code == 404
+
+def test_only_newest_profiles_are_kept(monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_KEEP', 2)
+
+    profile_ids = []
+    for label in ('first', 'second', 'third'):
+        profile_ids.append(profiling.finish_profile(*profiling.start_profile(label)))
+
+    assert len(profiling.list_profiles()) == 2
+    assert profiling.profile_path(profile_ids[-1]) is not None
+
+class FakeBot:
+    def __init__(self):
+        self.documents = []
+
+    async def send_document(self, chat_id, document, filename, caption):
+        self.documents.append((chat_id, filename, document.read().decode('utf-8')))
+
+def test_bot_profiles_next_update_of_the_chat(monkeypatch, write_balance):
+    write_balance('USD', 10)
+    monkeypatch.setattr(bot, '_heavy_work_semaphore', None)
+    monkeypatch.setattr(bot, 'pending_profiles', {7})
+    fake_bot = FakeBot()
+    update = SimpleNamespace(
+        effective_chat=SimpleNamespace(id=7), callback_query=None,
+        message=SimpleNamespace(text='/balance', photo=None), get_bot=lambda: fake_bot
+    )
+
+    async def handle():
+        await bot.run_heavy(bot.finance_tracker_core.get_accounts_for_api)
+
+    async def scenario():
+        processor = bot.ChatOrderedUpdateProcessor(4)
+        await processor.process_update(update, handle())
+        await processor.process_update(update, handle())
+
+    asyncio.run(scenario())
+
+    # Профилируется только следующий апдейт после /profile
+    assert bot.pending_profiles == set()
+    [(chat_id, filename, report)] = fake_bot.documents
+    assert chat_id == 7 and filename.endswith('.txt')
+    assert report.startswith('Профиль: bot /balance')
+    assert 'FROM accounts' in report
@@ -0,0 +1,180 @@
+"""Ограничение распознаваний (user-048): token bucket, бэкенды и очередь слотов OCR"""
+
+import asyncio
+import io
+import threading
+import time
+
+import httpx
+import pytest
+
+import app as app_module
+from asgi import app as asgi_app
+from core import finance_tracker_core
+from ratelimit import ConcurrencyGate, MemoryBackend, SQLiteBackend, Throttled, TokenBucketLimiter
+
+class FailingBackend:
+    def take(self, key, capacity, rate, now):
+        raise OSError('диск недоступен')
+
+def test_memory_bucket_allows_burst_then_refills():
+    backend = MemoryBackend()
+    rate = 60 / 60.0
+
+    assert [backend.take('ip:1', 3, rate, 100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert backend.take('ip:1', 3, rate, 100.0) == pytest.approx(1.0)
+    # Другой клиент не затронут
+    assert backend.take('ip:2', 3, rate, 100.0) == 0.0
+    # Через секунду накопился один жетон
+    assert backend.take('ip:1', 3, rate, 101.0) == 0.0
+
+def test_sqlite_bucket_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'ratelimit.db')
+    first, second = SQLiteBackend(path), SQLiteBackend(path)
+
+    assert first.take('tg:7', 2, 1.0, 100.0) == 0.0
+    assert second.take('tg:7', 2, 1.0, 100.0) == 0.0
+    assert first.take('tg:7', 2, 1.0, 100.0) > 0
+
+def test_limiter_raises_with_retry_after():
+    limiter = TokenBucketLimiter(MemoryBackend(), per_minute=6, capacity=1)
+    limiter.hit('ip:1')
+
+    with pytest.raises(Throttled) as raised:
+        limiter.hit('ip:1')
+    assert raised.value.reason == 'rate_limit'
+    assert raised.value.retry_after == 10
+
+def test_limiter_fails_open_when_backend_breaks():
+    limiter = TokenBucketLimiter(FailingBackend(), per_minute=1, capacity=1)
+    for _ in range(3):
+        limiter.hit('ip:1')
+
+def test_gate_hands_slot_to_waiter_in_order():
+    gate = ConcurrencyGate(limit=1, queue_timeout=2, max_queue=4)
+    order = []
+
+    async def work(name, seconds):
+        async with gate.slot():
+            order.append(name)
+            await asyncio.sleep(seconds)
+
+    async def scenario():
+        first = asyncio.ensure_future(work('first', 0.2))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(first, work('second', 0), work('third', 0))
+
+    asyncio.run(scenario())
+    assert order == ['first', 'second', 'third']
+
+def test_gate_rejects_on_timeout_and_full_queue():
+    gate = ConcurrencyGate(limit=1, queue_timeout=0.1, max_queue=1)
+
+    async def hold():
+        async with gate.slot():
+            await asyncio.sleep(0.5)
+
+    async def try_slot():
+        async with gate.slot():
+            return 'ok'
+
+    async def scenario():
+        holder = asyncio.ensure_future(hold())
+        await asyncio.sleep(0.05)
+        waiting = asyncio.ensure_future(try_slot())
+        await asyncio.sleep(0.01)
+        # Очередь из одного места уже занята - отказ сразу
+        with pytest.raises(Throttled) as raised:
+            await try_slot()
+        assert raised.value.reason == 'busy'
+        # Ожидающий не дождался слота за queue_timeout
+        with pytest.raises(Throttled):
+            await waiting
+        await holder
+        # После отказов и освобождения слот снова свободен
+        assert await try_slot() == 'ok'
+
+    asyncio.run(scenario())
+
+def test_gate_waiter_in_another_event_loop_gets_slot():
+    gate = ConcurrencyGate(limit=1, queue_timeout=2, max_queue=4)
+    held = threading.Event()
+    result = []
+
+    async def hold():
+        async with gate.slot():
+            held.set()
+            await asyncio.sleep(0.2)
+
+    async def wait_for_slot():
+        async with gate.slot():
+            result.append(time.perf_counter())
+
+    holder = threading.Thread(target=asyncio.run, args=(hold(),))
+    holder.start()
+    held.wait()
+    started = time.perf_counter()
+    asyncio.run(wait_for_slot())
+    holder.join()
+
+    assert result and 0.1 < result[0] - started < 1.5
+
+def _upload(client, address):
+    return client.post('/api/process_image', data={'image': (io.BytesIO(b'png'), 's.png')},
+                       headers={'X-Forwarded-For': address})
+
+def test_upload_rate_limit_returns_429(monkeypatch):
+    monkeypatch.setattr(app_module, 'ocr_rate_limiter', TokenBucketLimiter(MemoryBackend(), 1, 1))
+    monkeypatch.setattr(finance_tracker_core, 'ingest_image', lambda *args: {'success': True})
+    client = app_module.app.test_client()
+
+    assert _upload(client, '10.0.0.1').status_code == 200
+    response = _upload(client, '10.0.0.1')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '60'
+    assert response.get_json()['retry_after'] == 60
+    # Ключ - адрес клиента из X-Forwarded-For
+    assert _upload(client, '10.0.0.2').status_code == 200
+
+def test_rate_limit_is_checked_before_body_is_parsed(monkeypatch):
+    monkeypatch.setattr(app_module, 'ocr_rate_limiter', TokenBucketLimiter(MemoryBackend(), 1, 1))
+    monkeypatch.setattr(finance_tracker_core, 'ingest_image', lambda *args: {'success': True})
+    parsed = []
+    uploaded_image = app_module.uploaded_image
+    monkeypatch.setattr(app_module, 'uploaded_image', lambda: parsed.append(1) or uploaded_image())
+    client = app_module.app.test_client()
+
+    assert _upload(client, '10.0.0.1').status_code == 200
+    response = _upload(client, '10.0.0.1')
+
+    assert response.status_code == 429
+    assert response.headers['Connection'] == 'close'
+    assert parsed == [1]
+
+def test_saturated_gate_does_not_delay_health(monkeypatch):
+    def slow_ingest(*args):
+        time.sleep(0.6)
+        return {'success': True}
+    monkeypatch.setattr(app_module, 'ocr_gate', ConcurrencyGate(limit=1, queue_timeout=5, max_queue=1))
+    monkeypatch.setattr(finance_tracker_core, 'ingest_image', slow_ingest)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            uploads = [
+                asyncio.ensure_future(client.post('/api/process_image', files={'image': ('s.png', b'png')}))
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0.2)
+            started = time.perf_counter()
+            health = await client.get('/health')
+            health_seconds = time.perf_counter() - started
+            responses = await asyncio.gather(*uploads)
+        return health, health_seconds, responses
+
+    health, health_seconds, responses = asyncio.run(scenario())
+
+    assert health.status_code == 200
+    assert health_seconds < 0.3
+    # Один распознается, один ждет слот, третьему сразу 503: очередь из одного места
+    assert sorted(response.status_code for response in responses) == [200, 200, 503]
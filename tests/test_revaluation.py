@@ -0,0 +1,86 @@
+"""Пересчет balance_usd по курсам (user-046): один UPDATE, версия в БД, без пересчета по запасным курсам"""
+
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+import models
+from app import app as flask_app
+
+class RatesResponse:
+    status_code = 200
+
+    def json(self):
+        # API отдает, сколько единиц валюты стоит 1 USD
+        return {'rates': {'USD': 1.0, 'EUR': 0.5, 'RUB': 100.0}}
+
+@pytest.fixture
+def revaluations(monkeypatch):
+    """Подменяет фоновый пересчет: запоминает курсы, с которыми он был запущен"""
+    calls = []
+    started = threading.Event()
+
+    def revalue_in_background(rates):
+        calls.append(rates)
+        started.set()
+    monkeypatch.setattr(models, '_revalue_in_background', revalue_in_background)
+    return calls, started
+
+def test_revalue_accounts_updates_balance_usd(write_balance):
+    write_balance('EUR', 100)
+    write_balance('RUB', 1000)
+
+    assert models.revalue_accounts({'EUR': 2.0, 'RUB': 0.01, 'USD': 1.0}) == 2
+
+    session = models.create_session()
+    try:
+        balances = dict(session.query(models.Account.currency, models.Account.balance_usd))
+    finally:
+        session.close()
+    assert balances == {'EUR': 200.0, 'RUB': 10.0}
+
+def test_revaluation_version_comes_from_database(write_balance):
+    assert models.get_revaluation_version() is None
+
+    models.revalue_accounts({'EUR': 2.0}, now=datetime(2026, 1, 1))
+    first = models.get_revaluation_version()
+    # Пересчет в другом процессе виден этому процессу: состояние только в БД
+    models.revalue_accounts({'EUR': 3.0}, now=datetime(2026, 1, 1) + timedelta(hours=1))
+
+    assert first is not None
+    assert models.get_revaluation_version() != first
+
+def test_accounts_etag_changes_after_revaluation(write_balance):
+    write_balance('EUR', 100)
+    client = flask_app.test_client()
+    etag = client.get('/api/accounts').headers['ETag'].strip('"')
+
+    assert client.get('/api/accounts', headers={'If-None-Match': etag}).status_code == 304
+    models.revalue_accounts({'EUR': 2.0})
+    response = client.get('/api/accounts', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['accounts'][0]['balance_usd'] == 200.0
+
+def test_fixed_rate_fallback_does_not_revalue(monkeypatch, revaluations):
+    calls, _ = revaluations
+
+    def unavailable(*args, **kwargs):
+        raise requests.ConnectionError('нет сети')
+    monkeypatch.setattr(requests, 'get', unavailable)
+    monkeypatch.setattr(models, '_exchange_rates_version', 'api-rates')
+
+    models._update_exchange_rates_cache(force=True)
+
+    assert models._exchange_rates_cache == models._get_fixed_rates()
+    assert calls == []
+
+def test_api_refresh_revalues_with_new_rates(monkeypatch, revaluations):
+    calls, started = revaluations
+    monkeypatch.setattr(requests, 'get', lambda *args, **kwargs: RatesResponse())
+
+    models._update_exchange_rates_cache(force=True)
+
+    assert started.wait(2)
+    assert calls == [{'USD': 1.0, 'EUR': 2.0, 'RUB': 0.01}]
@@ -0,0 +1,87 @@
+"""Загрузка изображений (user-031): лимит размера, сброс на диск и одно копирование"""
+
+import asyncio
+import io
+import json
+import tempfile
+
+import pytest
+
+import app as app_module
+from app import app as flask_app
+from asgi import app as asgi_app
+from core import finance_tracker_core
+
+@pytest.fixture
+def received_streams(monkeypatch):
+    """Подменяет распознавание: запоминает поток файла, который получило ядро"""
+    streams = []
+
+    def ingest_image(image, source='web', include_text=True):
+        streams.append((image, image._rolled, finance_tracker_core.read_image_content(image)))
+        return {'success': True}
+    monkeypatch.setattr(finance_tracker_core, 'ingest_image', ingest_image)
+    return streams
+
+def upload(data):
+    return flask_app.test_client().post('/api/process_image', data={'image': (io.BytesIO(data), 's.png')})
+
+def test_small_upload_stays_in_memory(received_streams):
+    assert upload(b'png' * 100).status_code == 200
+
+    _, rolled, content = received_streams[0]
+    assert not rolled
+    assert content == b'png' * 100
+
+def test_large_upload_spools_to_disk(received_streams):
+    data = b'x' * (app_module.UPLOAD_SPOOL_THRESHOLD + 1)
+
+    assert upload(data).status_code == 200
+    _, rolled, content = received_streams[0]
+    assert rolled
+    assert content == data
+
+def test_oversized_upload_gets_json_413(received_streams, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'MAX_CONTENT_LENGTH', 1024 * 1024)
+    monkeypatch.setattr(app_module, 'MAX_UPLOAD_BYTES', 1024 * 1024)
+
+    response = upload(b'x' * (1024 * 1024 + 1))
+
+    assert response.status_code == 413
+    assert response.get_json() == {'success': False, 'error': 'Файл слишком большой (максимум 1 МБ)'}
+    assert received_streams == []
+
+def test_asgi_rejects_by_content_length_without_reading_body():
+    async def receive():
+        raise AssertionError('тело не должно читаться')
+
+    async def scenario():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': '/api/process_image', 'query_string': b'',
+            'headers': [(b'content-length', str(app_module.MAX_UPLOAD_BYTES + 1).encode('latin1'))]
+        }
+        await asgi_app(scope, receive, send)
+        return sent
+
+    start, body = asyncio.run(scenario())
+
+    assert start['status'] == 413
+    assert json.loads(body['body'])['success'] is False
+
+def test_read_image_content_copies_at_most_once(core):
+    data = b'image-bytes'
+    buffer = io.BytesIO(data)
+
+    assert core.read_image_content(data) is data
+    assert core.read_image_content(bytearray(data)) == data
+    assert core.read_image_content(memoryview(data)) == data
+    assert core.read_image_content(buffer) == data
+    with tempfile.TemporaryFile() as file:
+        file.write(data)
+        # Позиция после записи - в конце: читается все равно с начала
+        assert core.read_image_content(file) == data
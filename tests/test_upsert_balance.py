@@ -0,0 +1,65 @@
+"""Запись баланса одним upsert (user-041): один счет на валюту, old_balance - баланс счета до записи"""
+
+import threading
+
+from models import create_session, Account, Transaction, upsert_account_balance
+
+def write(currency, balance):
+    session = create_session()
+    try:
+        row = upsert_account_balance(session, currency, f'Счет {currency}', balance, balance, 'test', 'Баланс')
+        session.commit()
+        return row
+    finally:
+        session.close()
+
+def test_first_write_creates_account_from_zero():
+    row = write('USD', 100)
+
+    assert row['balance'] == 100.0
+    assert row['old_balance'] == 0.0
+    assert isinstance(row['transaction_id'], int)
+
+def test_old_balance_is_account_balance_before_update():
+    write('USD', 100)
+    # Баланс счета разошелся с последней транзакцией (ручная правка, архив истории)
+    session = create_session()
+    session.query(Account).filter_by(currency='USD').update({'balance': 150.0})
+    session.query(Transaction).delete()
+    session.commit()
+    session.close()
+
+    row = write('USD', 200)
+
+    assert row['old_balance'] == 150.0
+    session = create_session()
+    try:
+        transaction = session.query(Transaction).filter_by(id=row['transaction_id']).one()
+        assert (transaction.old_balance, transaction.new_balance, transaction.change) == (150.0, 200.0, 50.0)
+    finally:
+        session.close()
+
+def test_concurrent_writes_keep_one_account_and_unbroken_chain():
+    def worker(offset):
+        for index in range(10):
+            write('EUR', offset * 100 + index)
+
+    threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    session = create_session()
+    try:
+        assert session.query(Account).filter_by(currency='EUR').count() == 1
+        chain = session.query(Transaction.old_balance, Transaction.new_balance).order_by(Transaction.id).all()
+        final_balance = session.query(Account.balance).filter_by(currency='EUR').scalar()
+    finally:
+        session.close()
+
+    assert len(chain) == 40
+    assert chain[0].old_balance == 0.0
+    for previous, current in zip(chain, chain[1:]):
+        assert current.old_balance == previous.new_balance
+    assert chain[-1].new_balance == final_balance
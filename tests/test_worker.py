@@ -0,0 +1,174 @@
+"""Очередь распознавания (user-032): захват задач, повторы, dead-letter и повтор после падения"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.orm import undefer
+
+import worker
+from models import create_session, IngestJob, Transaction
+
+RECOGNIZED = {
+    'success': True,
+    'main_balance': {'value': 150.0, 'currency': 'USD', 'original_text': '$150.00'},
+    'full_text': 'Balance\n$150.00',
+    'text_lines': ['Balance', '$150.00']
+}
+
+@pytest.fixture
+def recognize(core, monkeypatch):
+    """Подменяет Google Vision: каждый вызов распознает $150 и считается"""
+    calls = []
+
+    def process_image(image_content):
+        calls.append(image_content)
+        return {**RECOGNIZED, 'text_lines': list(RECOGNIZED['text_lines'])}
+    monkeypatch.setattr(core, 'process_image', process_image)
+    return calls
+
+def enqueue(core, image=b'screenshot'):
+    return core.enqueue_image(image, source='test')['job_id']
+
+def job_row(job_id):
+    session = create_session()
+    try:
+        return session.query(IngestJob).options(undefer(IngestJob.image)).filter_by(id=job_id).one()
+    finally:
+        session.close()
+
+def update_job(job_id, **values):
+    session = create_session()
+    try:
+        session.query(IngestJob).filter_by(id=job_id).update(values)
+        session.commit()
+    finally:
+        session.close()
+
+def abandon(job_id):
+    """Делает вид, что воркер задачи упал JOB_LOCK_TIMEOUT секунд назад"""
+    update_job(job_id, locked_at=datetime.utcnow() - timedelta(seconds=worker.JOB_LOCK_TIMEOUT + 1))
+
+def transactions_count():
+    session = create_session()
+    try:
+        return session.query(Transaction).count()
+    finally:
+        session.close()
+
+def test_claim_is_exclusive(core):
+    job_id = enqueue(core)
+
+    claim = worker.claim_job('w1')
+    assert claim['id'] == job_id
+    assert claim['attempts'] == 1
+    assert claim['image'] == b'screenshot'
+    assert claim['written'] is None
+    assert worker.claim_job('w2') is None
+
+def test_successful_job_is_done_and_drops_image(core, recognize):
+    job_id = enqueue(core)
+    claim = worker.claim_job('w1')
+
+    result = worker.process_job(claim, 'w1')
+    assert worker.finish_job(job_id, result, 'w1', claim['attempts']) == 'done'
+
+    job = core.get_ingest_job(job_id)
+    assert job['result']['account']['balance'] == 150.0
+    assert 'full_text' not in job['result']
+    assert job_row(job_id).image is None
+    assert transactions_count() == 1
+
+def test_retryable_error_is_requeued_with_backoff(core):
+    job_id = enqueue(core)
+    claim = worker.claim_job('w1')
+
+    status = worker.finish_job(job_id, {'success': False, 'error': 'timeout'}, 'w1', claim['attempts'])
+
+    assert status == 'queued'
+    job = job_row(job_id)
+    assert job.run_after > datetime.utcnow()
+    assert job.last_error == 'timeout'
+    # Задержка еще не прошла
+    assert worker.claim_job('w1') is None
+
+def test_final_answer_is_not_retried(core):
+    job_id = enqueue(core)
+    claim = worker.claim_job('w1')
+
+    assert worker.finish_job(job_id, {'success': False, 'error': 'Текст не найден'}, 'w1', claim['attempts']) == 'failed'
+
+def test_last_attempt_goes_to_dead(core):
+    job_id = enqueue(core)
+    update_job(job_id, attempts=4)
+    claim = worker.claim_job('w1')
+
+    assert worker.finish_job(job_id, {'success': False, 'error': 'timeout'}, 'w1', claim['attempts']) == 'dead'
+    assert job_row(job_id).image == b'screenshot'
+
+def test_abandoned_job_is_reclaimed_while_attempts_remain(core):
+    job_id = enqueue(core)
+    worker.claim_job('w1')
+    abandon(job_id)
+
+    claim = worker.claim_job('w2')
+    assert claim['id'] == job_id
+    assert claim['attempts'] == 2
+    assert job_row(job_id).locked_by == 'w2'
+
+def test_abandoned_job_without_attempts_goes_to_dead(core):
+    job_id = enqueue(core)
+    update_job(job_id, attempts=4)
+    worker.claim_job('w1')
+    abandon(job_id)
+
+    assert worker.claim_job('w2') is None
+    job = job_row(job_id)
+    assert job.status == 'dead'
+    assert job.attempts == 5
+    assert job.locked_by is None
+
+def test_retry_after_crash_does_not_write_balance_twice(core, recognize):
+    job_id = enqueue(core)
+    first = worker.claim_job('w1')
+    worker.process_job(first, 'w1')
+    # Воркер упал после записи баланса, но до finish_job
+    abandon(job_id)
+
+    second = worker.claim_job('w2')
+    assert second['written']['account']['balance'] == 150.0
+    assert second['image'] is None
+    result = worker.process_job(second, 'w2')
+
+    assert worker.finish_job(job_id, result, 'w2', second['attempts']) == 'done'
+    assert len(recognize) == 1
+    assert transactions_count() == 1
+    assert core.get_ingest_job(job_id)['result']['total_balance_usd'] == 150.0
+
+def test_write_of_a_lost_claim_is_rolled_back(core, recognize):
+    job_id = enqueue(core)
+    slow = worker.claim_job('w1')
+    abandon(job_id)
+    fresh = worker.claim_job('w2')
+
+    # Первый воркер не упал, а просто не успел: его запись и итог не применяются
+    result = worker.process_job(slow, 'w1')
+    assert not result['success']
+    assert transactions_count() == 0
+    assert worker.finish_job(job_id, result, 'w1', slow['attempts']) == 'lost'
+
+    result = worker.process_job(fresh, 'w2')
+    assert worker.finish_job(job_id, result, 'w2', fresh['attempts']) == 'done'
+    assert transactions_count() == 1
+
+def test_abandoned_written_job_without_attempts_is_done(core, recognize):
+    job_id = enqueue(core)
+    update_job(job_id, attempts=4)
+    claim = worker.claim_job('w1')
+    worker.process_job(claim, 'w1')
+    abandon(job_id)
+
+    assert worker.claim_job('w2') is None
+    job = job_row(job_id)
+    assert job.status == 'done'
+    assert job.image is None
+    assert transactions_count() == 1
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Воркер очереди распознавания скриншотов (таблица ingest_jobs)
+
+Забирает задачи через SELECT ... FOR UPDATE SKIP LOCKED (PostgreSQL), поэтому
+процессов-воркеров можно запускать сколько угодно:
+    python worker.py --processes 4
+
+На SQLite (локально, в тестах) FOR UPDATE не поддерживается; там задачу
+закрепляет условный UPDATE ... WHERE status = 'queued'.
+
+Задача, воркер которой упал, через JOB_LOCK_TIMEOUT забирается снова, пока не
+исчерпаны попытки, а потом уходит в dead. Баланс записывается вместе с отметкой
+в задаче одной транзакцией БД (mark_written), поэтому повтор после падения не
+создает вторую транзакцию счета.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import or_, and_
+from models import create_session, IngestJob
+from partitions import start_partition_maintenance
+from metrics import Counter, Histogram, start_metrics_server
+
+WORKER_JOBS_TOTAL = Counter('ft_worker_jobs_total', 'Обработанные задачи распознавания по итоговому статусу', ['status'])
+WORKER_JOB_SECONDS = Histogram('ft_worker_job_seconds', 'Время обработки задачи распознавания')
+
+# Пауза между опросами пустой очереди (сек)
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', '1'))
+# Задача в статусе processing дольше этого (сек) считается брошенной упавшим воркером
+JOB_LOCK_TIMEOUT = int(os.environ.get('JOB_LOCK_TIMEOUT', '300'))
+# База экспоненциальной задержки между повторами (сек)
+JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', '5'))
+
+_stopping = False
+
+def _request_stop(signum, frame):
+    global _stopping
+    _stopping = True
+
+def is_retryable(result):
+    """Ошибка Vision/сети - повторяем; «текст или баланс не найден» - окончательный ответ"""
+    return 'text_lines' not in result and result.get('error') != 'Текст не найден'
+
+def written_result(job_result):
+    """Результат задачи, если ее баланс уже записан (отметка mark_written), иначе None"""
+    if not job_result:
+        return None
+    result = json.loads(job_result)
+    return result if result.get('success') and result.get('balance_written') else None
+
+def _settle_abandoned(session, stale_before, now):
+    """Брошенные воркерами задачи без оставшихся попыток: done, если баланс успели
+    записать, иначе dead - на новый круг они не идут"""
+    abandoned = session.query(IngestJob).filter(
+        IngestJob.status == 'processing',
+        IngestJob.locked_at < stale_before,
+        IngestJob.attempts >= IngestJob.max_attempts
+    ).with_for_update(skip_locked=True).all()
+
+    for job in abandoned:
+        if written_result(job.result):
+            job.status = 'done'
+            job.image = None
+            job.last_error = None
+        else:
+            job.status = 'dead'
+            job.last_error = f'Воркер не завершил задачу за {JOB_LOCK_TIMEOUT} с, попытки исчерпаны'
+        job.locked_by = None
+        job.locked_at = None
+        job.updated_at = now
+        WORKER_JOBS_TOTAL.inc(status=job.status)
+        print(f"⚠️ Брошенная задача {job.id}: {job.status}")
+    return len(abandoned)
+
+def claim_job(worker_id):
+    """Закрепляет за воркером одну готовую к обработке задачу
+
+    Возвращает словарь id, attempts (номер этой попытки), image, source и written -
+    результат прошлой попытки, если она успела записать баланс, - или None.
+    """
+    session = create_session()
+    try:
+        now = datetime.utcnow()
+        stale_before = now - timedelta(seconds=JOB_LOCK_TIMEOUT)
+
+        if _settle_abandoned(session, stale_before, now):
+            session.commit()
+
+        job = session.query(IngestJob).filter(or_(
+            and_(IngestJob.status == 'queued', IngestJob.run_after <= now),
+            and_(
+                IngestJob.status == 'processing',
+                IngestJob.locked_at < stale_before,
+                IngestJob.attempts < IngestJob.max_attempts
+            )
+        )).order_by(IngestJob.id).with_for_update(skip_locked=True).limit(1).first()
+
+        if not job:
+            session.rollback()
+            return None
+
+        # Условный UPDATE защищает от двойного захвата там, где нет FOR UPDATE (SQLite)
+        claimed = session.query(IngestJob).filter(
+            IngestJob.id == job.id,
+            IngestJob.status == job.status,
+            IngestJob.attempts == job.attempts
+        ).update({
+            'status': 'processing',
+            'attempts': IngestJob.attempts + 1,
+            'locked_by': worker_id,
+            'locked_at': now,
+            'updated_at': now
+        }, synchronize_session=False)
+        claim = {
+            'id': job.id,
+            'attempts': job.attempts + 1,
+            'source': job.source,
+            'written': written_result(job.result)
+        }
+        session.commit()
+
+        if not claimed:
+            return None
+
+        # Скриншот (отложенная колонка) читаем только у задачи, которую удалось захватить
+        # и баланс которой еще не записан
+        claim['image'] = None if claim['written'] else session.query(IngestJob.image).filter_by(id=claim['id']).scalar()
+        return claim
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _owned_by(job_id, worker_id, attempts):
+    """Условие «задача все еще закреплена за этой попыткой этого воркера»"""
+    return and_(
+        IngestJob.id == job_id,
+        IngestJob.status == 'processing',
+        IngestJob.locked_by == worker_id,
+        IngestJob.attempts == attempts
+    )
+
+def mark_written(job_id, worker_id, attempts):
+    """on_write для записи баланса: в той же транзакции БД отмечает, что баланс задачи записан
+
+    Повтор задачи после падения воркера видит отметку и не пишет баланс второй раз.
+    Если задачу уже перехватил другой воркер (наша попытка сочтена брошенной),
+    исключение откатывает запись: баланс запишет новый владелец.
+    """
+    def mark(session, result):
+        account = result['account']
+        written = {
+            **result,
+            'main_balance': {'value': account['balance'], 'currency': account['currency']},
+            'balance_written': True
+        }
+        marked = session.query(IngestJob).filter(_owned_by(job_id, worker_id, attempts)).update({
+            'result': json.dumps(written, ensure_ascii=False)
+        }, synchronize_session=False)
+        if not marked:
+            raise RuntimeError(f'Задача {job_id} перехвачена другим воркером')
+    return mark
+
+def finish_job(job_id, result, worker_id, attempts):
+    """Сохраняет результат: done/failed, повтор с задержкой или dead (dead-letter)
+
+    Возвращает итоговый статус или lost, если задачу уже перехватил другой воркер.
+    """
+    session = create_session()
+    try:
+        job = session.query(IngestJob).filter(_owned_by(job_id, worker_id, attempts)).with_for_update().first()
+        now = datetime.utcnow()
+
+        if job is None:
+            session.rollback()
+            return 'lost'
+
+        if result.get('success') or not is_retryable(result):
+            job.status = 'done' if result.get('success') else 'failed'
+            job.image = None
+        elif job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_after = now + timedelta(seconds=JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+        else:
+            # Попытки исчерпаны: задача остается в таблице вместе с изображением для разбора
+            job.status = 'dead'
+
+        job.result = json.dumps(result, ensure_ascii=False)
+        job.last_error = None if result.get('success') else result.get('error')
+        job.locked_by = None
+        job.locked_at = None
+        job.updated_at = now
+        session.commit()
+
+        return job.status
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def process_job(claim, worker_id):
+    """Распознает задачу и записывает баланс (если прошлая попытка не успела); возвращает результат"""
+    from core import finance_tracker_core
+
+    if claim['written']:
+        # Прошлая попытка записала баланс и упала до finish_job: повторять нечего
+        return {**claim['written'], 'total_balance_usd': finance_tracker_core.get_accounts_summary()['total_balance_usd']}
+
+    try:
+        result = finance_tracker_core.ingest_image(
+            claim['image'],
+            source=claim['source'],
+            on_write=mark_written(claim['id'], worker_id, claim['attempts'])
+        )
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+
+    # Полный текст OCR в результате задачи не храним, для ответа хватает первых строк
+    result.pop('full_text', None)
+    if 'text_lines' in result:
+        result['text_lines'] = result['text_lines'][:20]
+    return result
+
+def run_worker(worker_id, metrics_port=None):
+    """Цикл одного процесса-воркера"""
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+    print(f"🚀 Воркер {worker_id} запущен")
+    start_partition_maintenance()
+
+    while not _stopping:
+        try:
+            claimed = claim_job(worker_id)
+        except Exception as e:
+            print(f"❌ Ошибка получения задачи: {e}")
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+
+        if not claimed:
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+
+        started = time.perf_counter()
+        result = process_job(claimed, worker_id)
+        WORKER_JOB_SECONDS.observe(time.perf_counter() - started)
+
+        status = finish_job(claimed['id'], result, worker_id, claimed['attempts'])
+        WORKER_JOBS_TOTAL.inc(status=status)
+        print(f"{'✅' if status == 'done' else '⚠️'} Задача {claimed['id']}: {status}")
+
+    print(f"🛑 Воркер {worker_id} остановлен")
+
+def main():
+    parser = argparse.ArgumentParser(description='Воркер очереди распознавания Finance Tracker')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('WORKER_PROCESSES', '1')),
+                        help='Количество процессов-воркеров')
+    args = parser.parse_args()
+
+    base_id = f"{socket.gethostname()}:{os.getpid()}"
+    # Каждому процессу свой порт метрик: METRICS_PORT, METRICS_PORT + 1, ...
+    metrics_port = int(os.environ['METRICS_PORT']) if os.environ.get('METRICS_PORT') else None
+
+    if args.processes <= 1:
+        run_worker(base_id, metrics_port)
+        return
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(f"{base_id}:{index}", metrics_port + index if metrics_port else None)
+        )
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    # Родитель пересылает SIGTERM детям и ждет их завершения
+    signal.signal(signal.SIGTERM, lambda signum, frame: [p.terminate() for p in processes])
+    for process in processes:
+        process.join()
+
+if __name__ == '__main__':
+    main()